@@ -0,0 +1,66 @@
+import select
+import socket
+from typing import List, Tuple
+
+import protocol
+
+DEFAULT_BATCH_SIZE = 32
+
+
+class BatchedDatagramSocket:
+    """
+    Wraps a UDP socket to receive the datagrams that are ready in batches, and send the replies together.
+    The datagrams are received with recvfrom_into into preallocated buffers, so no bytes object is created per packet.
+    A received datagram is a memoryview into those buffers, and is only valid until the next receive_batch call.
+    """
+    def __init__(self, sock: socket.socket, batch_size: int = DEFAULT_BATCH_SIZE,
+                 buffer_size: int = protocol.MAX_DATAGRAM_SIZE):
+        self.sock = sock
+        self.sock.setblocking(False)
+        # One buffer for the whole batch, split into a slot for each datagram
+        self.buffer = memoryview(bytearray(batch_size * buffer_size))
+        self.slots = [self.buffer[i * buffer_size:(i + 1) * buffer_size] for i in range(batch_size)]
+        # The replies that were queued since the last flush
+        self.pending: List[Tuple[bytes, tuple]] = []
+
+    def fileno(self) -> int:
+        return self.sock.fileno()
+
+    def wait_readable(self, timeout: float = None) -> bool:
+        """Wait until there is a datagram to receive, return False if the timeout passed first."""
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def receive_batch(self) -> List[Tuple[memoryview, tuple]]:
+        """Receive the datagrams that are ready, up to the batch size, without blocking."""
+        batch = []
+        for slot in self.slots:
+            try:
+                size, addr = self.sock.recvfrom_into(slot)
+            except (BlockingIOError, InterruptedError):
+                break
+            except ConnectionError:
+                # An ICMP error for an earlier datagram we sent, skip it
+                continue
+            batch.append((slot[:size], addr))
+        return batch
+
+    def queue(self, data: bytes, addr: tuple):
+        """Queue a reply to be sent on the next flush."""
+        self.pending.append((data, addr))
+
+    def flush(self):
+        """Send all the queued replies back to back."""
+        pending = self.pending
+        self.pending = []
+        for data, addr in pending:
+            while True:
+                try:
+                    self.sock.sendto(data, addr)
+                    break
+                except (BlockingIOError, InterruptedError):
+                    # The send buffer is full, wait for room in it
+                    select.select([], [self.sock], [])
+                except OSError:
+                    # The reply cannot be sent, drop it like a lost datagram
+                    break
@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Zone memory benchmark
+Compares the memory a zone takes as the original dict based entries in a list,
+as __slots__ DomainEntry objects in a DomainList, and as a ColumnarDomainList,
+and what a ZoneReloader holding each of them takes, with what it keeps for incremental reloads
+"""
+
+import gc
+import os
+import tempfile
+import time
+import tracemalloc
+from sys import argv
+from typing import List
+
+from server import DomainList, DomainEntry, ZoneReloader, parse_options
+from columnar import ColumnarDomainList
+
+
+class LegacyDomainEntry:
+    """The domain entry as it was before __slots__: an instance __dict__ and the type as a string"""
+    TYPE_NS = "NS"
+    TYPE_A = "A"
+
+    def __init__(self, domain: str, ip: str, entry_type: str, expire_time: float = None):
+        self.domain = domain.strip()
+        self.ip = ip.strip()
+        self.entry_type = entry_type.strip()
+        self.expire_time = expire_time
+
+
+def zone_lines(records: int) -> List[str]:
+    """Synthetic zone lines, with a few shared nameservers like a real zone"""
+    lines = []
+    for i in range(records):
+        if i % 50 == 0:
+            lines.append(f".zone{i}.bench.com,10.0.0.{i % 4}:53,NS\n")
+        else:
+            lines.append(f"host{i}.bench.com,10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255},A\n")
+    return lines
+
+
+def build_legacy(lines: List[str]):
+    domains = []
+    for line in lines:
+        parts = line.split(',')
+        domains.append(LegacyDomainEntry(parts[0], parts[1], parts[2]))
+    return domains
+
+
+def build_indexed(lines: List[str]):
+    domain_list = DomainList()
+    for line in lines:
+        parts = line.split(',')
+        domain_list.add(DomainEntry(parts[0], parts[1], parts[2]))
+    return domain_list
+
+
+def build_columnar(lines: List[str]):
+    domain_list = ColumnarDomainList()
+    for line in lines:
+        parts = line.split(',')
+        domain_list.add(DomainEntry(parts[0], parts[1], parts[2]))
+    return domain_list
+
+
+def write_zone_file(lines: List[str]) -> str:
+    """Write the zone lines to a temporary zone file, and return its path"""
+    fd, path = tempfile.mkstemp(suffix=".txt")
+    with os.fdopen(fd, 'w') as file:
+        file.writelines(lines)
+    return path
+
+
+def measure(name: str, build, lines: List[str]):
+    """Print how much memory the built structure holds after the temporaries are freed"""
+    gc.collect()
+    tracemalloc.start()
+    start = time.time()
+    structure = build(lines)
+    elapsed = time.time() - start
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<22} {current / len(lines):>8.1f} B/record  {current / 2 ** 20:>8.1f} MiB  "
+          f"peak {peak / 2 ** 20:>8.1f} MiB  build {elapsed:.2f}s")
+    del structure
+
+
+def main():
+    options = parse_options(argv[1:])
+    records = int(options.get("--records", 200000))
+    lines = zone_lines(records)
+    print(f"{records} records")
+    measure("legacy list", build_legacy, lines)
+    measure("DomainList (__slots__)", build_indexed, lines)
+    measure("ColumnarDomainList", build_columnar, lines)
+    # The reloader reads the zone from a file
+    zone_path = write_zone_file(lines)
+    try:
+        measure("ZoneReloader", lambda _: ZoneReloader(zone_path), lines)
+        measure("ZoneReloader columnar", lambda _: ZoneReloader(zone_path, columnar=True), lines)
+    finally:
+        os.remove(zone_path)
+
+
+if __name__ == "__main__":
+    main()
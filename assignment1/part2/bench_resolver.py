@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+"""
+Resolver latency benchmark
+Starts a chain of servers on synthetic zones and the resolver with the helpers of test_dns.py,
+replays a mix of queries from many client processes, and prints the QPS, latency percentiles and loss as JSON
+"""
+
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from sys import argv
+from typing import Dict, List, Tuple
+
+import protocol
+from server import parse_options
+from test_dns import DNSClient, start_server, start_resolver
+
+# The server of zone depth k listens on BENCH_PORT + k
+BENCH_PORT = 12500
+BENCH_RESOLVER_PORT = 12600
+# Long enough that nothing expires during a run
+BENCH_CACHE_TIME = 3600
+# How long to wait for the answers of the last queries of a run before counting them as lost
+DRAIN_TIME = 1.0
+
+
+def zone_suffix(depth: int) -> str:
+    """Return the suffix of the names served at an NS depth: bench, l1.bench, l2.l1.bench, ..."""
+    return ".".join([f"l{level}" for level in range(depth, 0, -1)] + ["bench"])
+
+
+def write_zones(directory: str, records: int, max_depth: int) -> List[str]:
+    """
+    Write a zone file for each depth, with the given number of A records,
+    and an NS record that delegates the next depth to the next server
+    """
+    paths = []
+    for depth in range(max_depth + 1):
+        path = os.path.join(directory, f"bench_zone{depth}.txt")
+        suffix = zone_suffix(depth)
+        with open(path, 'w') as file:
+            for i in range(records):
+                file.write(f"host{i}.{suffix},10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255},A\n")
+            if depth < max_depth:
+                file.write(f".{zone_suffix(depth + 1)},127.0.0.1:{BENCH_PORT + depth + 1},NS\n")
+        paths.append(path)
+    return paths
+
+
+def wait_ready(port: int, query: str, timeout: float = 60.0):
+    """Wait until a server or the resolver answers, since a large zone takes a while to load"""
+    client = DNSClient('127.0.0.1', port)
+    client.sock.settimeout(0.2)
+    deadline = time.time() + timeout
+    try:
+        while client.query(query) is None:
+            if time.time() > deadline:
+                raise RuntimeError(f"nothing answers on port {port}")
+    finally:
+        client.close()
+
+
+class QueryMix:
+    """
+    Picks the queries of a client: a hit is one of the hot names that were resolved before the run,
+    a miss is a name that was not queried yet, and an NXDOMAIN is a name that is not in the zone.
+    All of them are at the same NS depth.
+    """
+    def __init__(self, hit_ratio: float, nx_ratio: float, depth: int, hot_set: int, records: int,
+                 client_id: int, clients: int):
+        self.hit_ratio = hit_ratio
+        self.nx_ratio = nx_ratio
+        self.suffix = zone_suffix(depth)
+        self.hot_set = hot_set
+        self.records = records
+        # Each client takes every clients-th miss name, so no two clients send the same one
+        self.next_index = client_id
+        self.step = clients
+
+    def next_query(self) -> Tuple[str, bool]:
+        """Return the next name to query, and whether it should have an answer"""
+        roll = random.random()
+        if roll < self.hit_ratio:
+            return f"host{random.randrange(self.hot_set)}.{self.suffix}", True
+        index = self.next_index
+        self.next_index += self.step
+        if roll < self.hit_ratio + self.nx_ratio:
+            return f"nx{index}.{self.suffix}", False
+        # Once the zone runs out of fresh names they wrap around and become hits
+        return f"host{self.hot_set + index % (self.records - self.hot_set)}.{self.suffix}", True
+
+
+def client_process(mix: QueryMix, port: int, duration: float, rate: float, window: int, results):
+    """
+    Query the resolver for the duration, at a fixed rate if one is given, otherwise with a window of
+    outstanding queries. Put the number of queries sent, their latencies and the wrong answers in the results.
+    The queries use the binary protocol, whose transaction ID matches each answer to its query.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    addr = ('127.0.0.1', port)
+    # txid -> (send time, whether the query should have an answer)
+    outstanding: Dict[int, Tuple[float, bool]] = {}
+    latencies: List[float] = []
+    errors = 0
+    sent = 0
+    next_txid = 0
+
+    def send(send_time: float):
+        nonlocal sent, next_txid
+        # Skip the IDs of the queries still waiting for an answer, so a late answer is not taken for a new query
+        for _ in range(0x10000):
+            if next_txid not in outstanding:
+                break
+            next_txid = (next_txid + 1) & 0xFFFF
+        txid = next_txid
+        next_txid = (next_txid + 1) & 0xFFFF
+        name, has_answer = mix.next_query()
+        outstanding[txid] = (send_time, has_answer)
+        sock.sendto(protocol.encode_query(txid, [name]), addr)
+        sent += 1
+
+    def receive() -> bool:
+        """Receive an answer and match it to its query. False if nothing arrived before the timeout."""
+        nonlocal errors
+        try:
+            data, _ = sock.recvfrom(protocol.MAX_DATAGRAM_SIZE)
+        except socket.timeout:
+            return False
+        try:
+            _, _, txid, answers = protocol.decode_response(data)
+        except protocol.ProtocolError:
+            return True
+        pending = outstanding.pop(txid, None)
+        if pending is None:
+            # The answer to a query that was already counted as lost
+            return True
+        latencies.append(time.monotonic() - pending[0])
+        if answers and (answers[0] is not None) != pending[1]:
+            errors += 1
+        return True
+
+    start = time.monotonic()
+    end = start + duration
+    if rate > 0:
+        # Open loop: the queries are sent on schedule whether or not the earlier ones were answered
+        stop = threading.Event()
+        sock.settimeout(0.1)
+
+        def receive_loop():
+            while not stop.is_set():
+                receive()
+
+        receiver = threading.Thread(target=receive_loop)
+        receiver.start()
+        interval = 1.0 / rate
+        scheduled = start
+        while scheduled < end:
+            now = time.monotonic()
+            if now < scheduled:
+                time.sleep(scheduled - now)
+            # Measure from the scheduled time, so a send that was held up by a slow resolver counts against it
+            send(scheduled)
+            scheduled += interval
+        time.sleep(DRAIN_TIME)
+        stop.set()
+        receiver.join()
+    else:
+        # Closed loop: a new query is sent each time one is answered
+        sock.settimeout(DRAIN_TIME)
+        while time.monotonic() < end:
+            while len(outstanding) < window:
+                send(time.monotonic())
+            if not receive():
+                # Nothing was answered for DRAIN_TIME, consider the outstanding queries lost
+                outstanding.clear()
+        while outstanding and receive():
+            pass
+
+    sock.close()
+    results.put((sent, latencies, errors))
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def run(hit_ratio: float, nx_ratio: float, depth: int, config: Dict) -> Dict:
+    """Start a fresh resolver, warm its hot set, replay the mix and return the results of the run"""
+    resolver = start_resolver(BENCH_RESOLVER_PORT, '127.0.0.1', BENCH_PORT, BENCH_CACHE_TIME,
+                              config["resolver_options"].split())
+    try:
+        wait_ready(BENCH_RESOLVER_PORT, f"host0.{zone_suffix(0)}")
+        # Resolve the hot names, so the hits are answered from the cache
+        client = DNSClient('127.0.0.1', BENCH_RESOLVER_PORT)
+        for i in range(config["hot_set"] if hit_ratio > 0 else 0):
+            client.query(f"host{i}.{zone_suffix(depth)}")
+        client.close()
+
+        clients = config["clients"]
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=client_process, args=(
+                    QueryMix(hit_ratio, nx_ratio, depth, config["hot_set"], config["records"], i, clients),
+                    BENCH_RESOLVER_PORT, config["duration"], config["rate"] / clients, config["window"], results))
+                 for i in range(clients)]
+        for p in procs:
+            p.start()
+        outcomes = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+    finally:
+        resolver.terminate()
+        resolver.wait()
+
+    sent = sum(outcome[0] for outcome in outcomes)
+    latencies = sorted(itertools.chain.from_iterable(outcome[1] for outcome in outcomes))
+    errors = sum(outcome[2] for outcome in outcomes)
+    return {
+        "hit_ratio": hit_ratio,
+        "nx_ratio": nx_ratio,
+        "depth": depth,
+        "sent": sent,
+        "answered": len(latencies),
+        "errors": errors,
+        "qps": round(len(latencies) / config["duration"], 1),
+        "loss": round(1 - len(latencies) / sent, 4) if sent else 0.0,
+        "latency_ms": {name: round(percentile(latencies, fraction) * 1000, 3)
+                       for name, fraction in (("p50", 0.5), ("p99", 0.99), ("p999", 0.999))},
+    }
+
+
+def split_resolver_options(args: List[str]) -> Tuple[List[str], List[str]]:
+    """
+    Take the resolver options out of the arguments, and return the rest and the resolver options.
+    They are everything after a bare "--", and the value of --resolver-options, given as "--resolver-options=OPTIONS"
+    or as the next argument. parse_options would take a value that starts with "--" for another option.
+    """
+    resolver_args = []
+    if "--" in args:
+        split = args.index("--")
+        args, resolver_args = args[:split], args[split + 1:]
+    rest = []
+    i = 0
+    while i < len(args):
+        if args[i].startswith("--resolver-options="):
+            resolver_args = args[i].split('=', 1)[1].split() + resolver_args
+        elif args[i] == "--resolver-options" and i + 1 < len(args):
+            resolver_args = args[i + 1].split() + resolver_args
+            i += 1
+        else:
+            rest.append(args[i])
+        i += 1
+    return rest, resolver_args
+
+
+def main():
+    # print("Usage: python bench_resolver.py [--hit-ratio R,...] [--nx-ratio R,...] [--depth N,...] "
+    #       "[--rate QPS] [--window N] [--clients N] [--duration SEC] [--records N] [--hot-set N] "
+    #       "[--resolver-options=\"OPTIONS\"] [--output PATH] [-- RESOLVER OPTIONS...]")
+    args, resolver_args = split_resolver_options(argv[1:])
+    options = parse_options(args)
+    # Every combination of the comma separated hit ratios, NXDOMAIN shares and NS depths is a run
+    hit_ratios = [float(r) for r in options.get("--hit-ratio", "0.9").split(',')]
+    nx_ratios = [float(r) for r in options.get("--nx-ratio", "0").split(',')]
+    depths = [int(d) for d in options.get("--depth", "0").split(',')]
+    config = {
+        # The total queries per second of all the clients, 0 runs closed loop with a window per client
+        "rate": float(options.get("--rate", 0)),
+        "window": int(options.get("--window", 8)),
+        "clients": int(options.get("--clients", os.cpu_count() or 1)),
+        "duration": float(options.get("--duration", 3)),
+        "records": int(options.get("--records", 100000)),
+        "hot_set": int(options.get("--hot-set", 1000)),
+        "resolver_options": " ".join(resolver_args),
+        "cpus": os.cpu_count(),
+    }
+    if config["hot_set"] >= config["records"]:
+        # print("The hot set must be smaller than the zones")
+        sys.exit()
+
+    servers = []
+    report = {"config": config, "runs": []}
+    with tempfile.TemporaryDirectory() as tmp:
+        try:
+            for depth, zone_path in enumerate(write_zones(tmp, config["records"], max(depths))):
+                servers.append(start_server(BENCH_PORT + depth, zone_path))
+                wait_ready(BENCH_PORT + depth, f"host0.{zone_suffix(depth)}")
+            for hit_ratio, nx_ratio, depth in itertools.product(hit_ratios, nx_ratios, depths):
+                report["runs"].append(run(hit_ratio, nx_ratio, depth, config))
+        finally:
+            for server in servers:
+                server.terminate()
+                server.wait()
+
+    output = json.dumps(report, indent=2)
+    if "--output" in options:
+        with open(options["--output"], 'w') as file:
+            file.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(1)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+"""
+Authoritative server throughput benchmark
+Starts server.py with a growing number of --workers and measures the queries per second it answers
+"""
+
+import multiprocessing
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from sys import argv
+
+from server import parse_options
+
+BENCH_PORT = 12400
+
+
+def write_zone(path: str, records: int):
+    """Write a synthetic zone file with the given number of A records"""
+    with open(path, 'w') as file:
+        for i in range(records):
+            file.write(f"host{i}.bench.com,10.{(i >> 16) & 255}.{(i >> 8) & 255}.{i & 255},A\n")
+
+
+def client_loop(port: int, records: int, duration: float, window: int, results):
+    """Keep a window of queries outstanding until the duration is over, and count the answers"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(0.2)
+    addr = ('127.0.0.1', port)
+    answered = 0
+    deadline = time.time() + duration
+    outstanding = 0
+    while time.time() < deadline:
+        while outstanding < window:
+            sock.sendto(f"host{random.randrange(records)}.bench.com".encode(), addr)
+            outstanding += 1
+        try:
+            sock.recvfrom(1024)
+            answered += 1
+            outstanding -= 1
+        except socket.timeout:
+            # Consider the outstanding queries lost
+            outstanding = 0
+    sock.close()
+    results.put(answered)
+
+
+def run(workers: int, clients: int, duration: float, records: int, zone_path: str, window: int,
+        batch: int = 0) -> float:
+    """Start the server with the given amount of workers and return the queries per second it answered"""
+    cmd = ['python3', 'server.py', str(BENCH_PORT), zone_path, '--workers', str(workers), '--batch', str(batch)]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # Give the server time to load the zone
+    time.sleep(1.0 + records / 200000)
+    try:
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=client_loop, args=(BENCH_PORT, records, duration, window, results))
+                 for _ in range(clients)]
+        for p in procs:
+            p.start()
+        total = sum(results.get() for _ in procs)
+        for p in procs:
+            p.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+    return total / duration
+
+
+def main():
+    options = parse_options(argv[1:])
+    worker_counts = [int(n) for n in options.get("--workers", "1,2,4").split(',')]
+    clients = int(options.get("--clients", os.cpu_count() or 1))
+    duration = float(options.get("--duration", 3))
+    records = int(options.get("--records", 100000))
+    window = int(options.get("--window", 8))
+    # Compare the one packet loop with the batched one, e.g. --batch 0,32
+    batch_sizes = [int(n) for n in options.get("--batch", "0").split(',')]
+
+    print(f"{records} records, {clients} client processes, window {window}, {duration}s per run, "
+          f"{os.cpu_count()} CPUs")
+    with tempfile.TemporaryDirectory() as tmp:
+        zone_path = os.path.join(tmp, 'bench_zone.txt')
+        write_zone(zone_path, records)
+        baseline = None
+        for batch in batch_sizes:
+            for workers in worker_counts:
+                qps = run(workers, clients, duration, records, zone_path, window, batch)
+                if baseline is None:
+                    baseline = qps
+                print(f"workers={workers:<3} batch={batch:<3} qps={qps:>10.0f}  "
+                      f"speedup={qps / baseline if baseline else 0:.2f}x")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(1)
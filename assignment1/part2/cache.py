@@ -0,0 +1,232 @@
+import heapq
+import os
+import struct
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from server import DomainList, DomainEntry
+
+# The entry type of a cached non-existent domain answer
+TYPE_NEGATIVE = "NXDOMAIN"
+
+# A cache file is the magic followed by the entries, from least to most recently used.
+# Each entry is its expire time (0 for never), the lengths of its domain, ip and type, and then those strings.
+# Expire times are wall clock times, so the remaining TTLs stay right across a restart.
+CACHE_MAGIC = b"DNSCACHE"
+CACHE_ENTRY = struct.Struct('<dHHB')
+
+
+def save_entries(entries: List[DomainEntry], path: str):
+    """Write the entries to a cache file, replacing it at once so a crash never leaves half a file."""
+    parts = [CACHE_MAGIC]
+    for entry in entries:
+        domain = entry.domain.encode()
+        ip = entry.ip.encode()
+        entry_type = entry.entry_type.encode()
+        expire_time = 0.0 if entry.expire_time is None else entry.expire_time
+        parts.append(CACHE_ENTRY.pack(expire_time, len(domain), len(ip), len(entry_type)))
+        parts.append(domain)
+        parts.append(ip)
+        parts.append(entry_type)
+    temp_path = path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(b"".join(parts))
+    os.replace(temp_path, path)
+
+
+def load_entries(path: str) -> List[DomainEntry]:
+    """Read the entries of a cache file that have not expired yet. A truncated last entry is ignored."""
+    with open(path, 'rb') as file:
+        data = file.read()
+    if not data.startswith(CACHE_MAGIC):
+        raise ValueError(f"{path} is not a cache file")
+    now = time.time()
+    entries = []
+    offset = len(CACHE_MAGIC)
+    while offset + CACHE_ENTRY.size <= len(data):
+        expire_time, domain_len, ip_len, type_len = CACHE_ENTRY.unpack_from(data, offset)
+        offset += CACHE_ENTRY.size
+        end = offset + domain_len + ip_len + type_len
+        if end > len(data):
+            break
+        if expire_time == 0.0 or expire_time > now:
+            domain = data[offset:offset + domain_len].decode()
+            ip = data[offset + domain_len:offset + domain_len + ip_len].decode()
+            entry_type = data[offset + domain_len + ip_len:end].decode()
+            entries.append(DomainEntry(domain, ip, entry_type, None if expire_time == 0.0 else expire_time))
+        offset = end
+    return entries
+
+
+class DomainCache(DomainList):
+    """
+    A DomainList for the resolver cache.
+    Entries with an expire time are kept in a min-heap, so a cleanup only pops the entries that actually expired.
+    If max_size is set, the least recently used entry is evicted once the cache grows past it.
+    Non-existent domain answers are cached too, as TYPE_NEGATIVE entries that lookups never return.
+    A newly added answer replaces the cached one for the same domain.
+    If stale_window is set, an A record is kept and still returned for that long after it expires,
+    so the resolver can answer with it while it refreshes it. The hits of each A record are counted.
+    """
+    def __init__(self, max_size: int = 0, stale_window: float = 0.0):
+        super().__init__()
+        self.max_size = max_size
+        self.stale_window = stale_window
+        # (type code, domain) -> how many lookups returned the entry since it was added
+        self.hits: Dict[Tuple[int, str], int] = {}
+        # domain -> negative entry
+        self.negative_records: Dict[str, DomainEntry] = {}
+        # (expire_time, insertion number, entry), the insertion number keeps ties from comparing entries
+        self.expiry_heap: List[Tuple[float, int, DomainEntry]] = []
+        self.insertions = 0
+        # (type code, domain) -> entry, ordered from least to most recently used
+        self.lru: "OrderedDict[Tuple[int, str], DomainEntry]" = OrderedDict()
+        # How many entries expired and how many were evicted, for the stats
+        self.expirations = 0
+        self.evictions = 0
+
+    def add(self, entry: DomainEntry):
+        """Add a new entry to the cache, then evict least recently used entries if it is too big."""
+        existing = self._stored(entry)
+        if existing is entry:
+            return
+        if existing is not None:
+            self.remove(existing)
+        if entry.entry_type == TYPE_NEGATIVE:
+            self.negative_records[entry.domain] = entry
+            # The domain does not exist anymore, drop its stale answer
+            self.remove_answer(entry.domain)
+        else:
+            super().add(entry)
+            # The domain exists after all
+            if entry.type_code == DomainEntry.CODE_A and entry.domain in self.negative_records:
+                self.remove(self.negative_records[entry.domain])
+        key = (entry.type_code, entry.domain)
+        # Only track entries the index took
+        if self._stored(entry) is not entry:
+            return
+        self.lru[key] = entry
+        self.lru.move_to_end(key)
+        if entry.expire_time is not None:
+            self.insertions += 1
+            # A records are removed only once they are too stale to be returned
+            remove_time = entry.expire_time
+            if entry.type_code == DomainEntry.CODE_A:
+                remove_time += self.stale_window
+            heapq.heappush(self.expiry_heap, (remove_time, self.insertions, entry))
+        if self.max_size > 0:
+            while len(self.lru) > self.max_size:
+                key, oldest = self.lru.popitem(last=False)
+                self.hits.pop(key, None)
+                self.remove_from_index(oldest)
+                self.evictions += 1
+        # Evicted and replaced entries stay in the heap until they expire, rebuild it if they pile up
+        if len(self.expiry_heap) > 2 * len(self.lru) + 64:
+            self.expiry_heap = [item for item in self.expiry_heap if self._stored(item[2]) is item[2]]
+            heapq.heapify(self.expiry_heap)
+
+    def remove(self, entry: DomainEntry):
+        """Remove an entry from the cache."""
+        if self._stored(entry) is entry:
+            key = (entry.type_code, entry.domain)
+            del self.lru[key]
+            self.hits.pop(key, None)
+        self.remove_from_index(entry)
+
+    def remove_from_index(self, entry: DomainEntry):
+        if entry.entry_type == TYPE_NEGATIVE:
+            if self.negative_records.get(entry.domain) is entry:
+                del self.negative_records[entry.domain]
+        else:
+            super().remove(entry)
+
+    def add_negative(self, domain: str, expire_time: float):
+        """Cache that a domain does not exist, until the expire time."""
+        self.add(DomainEntry(domain, "", TYPE_NEGATIVE, expire_time))
+
+    def remove_answer(self, domain: str):
+        """Remove the cached A record of a domain, stale or not, once the domain is known not to exist."""
+        entry = self.a_records.get(domain)
+        if entry is not None:
+            self.remove(entry)
+
+    def is_negative(self, domain: str) -> bool:
+        """Check if the cache holds a live non-existent domain answer for the domain."""
+        entry = self.negative_records.get(domain)
+        if entry is None:
+            return False
+        if entry.is_expired():
+            self.remove(entry)
+            return False
+        self.lru.move_to_end((entry.type_code, entry.domain))
+        return True
+
+    def remove_expired(self):
+        """Pop the expired entries off the heap and remove them from the cache."""
+        heap = self.expiry_heap
+        if not heap:
+            return
+        now = time.time()
+        while heap and heap[0][0] <= now:
+            _, _, entry = heapq.heappop(heap)
+            # The heap still holds the entries that were replaced or evicted, only count the stored ones
+            if self._stored(entry) is entry:
+                self.expirations += 1
+            self.remove(entry)
+
+    def lookup_a(self, query: str) -> Optional[DomainEntry]:
+        """Return the A record for exactly this domain, or None. It may be stale, up to the stale window."""
+        entry = self.a_records.get(query)
+        if entry is None:
+            return None
+        if entry.expire_time is not None and time.time() >= entry.expire_time + self.stale_window:
+            self.remove(entry)
+            self.expirations += 1
+            return None
+        key = (entry.type_code, entry.domain)
+        self.lru.move_to_end(key)
+        self.hits[key] = self.hits.get(key, 0) + 1
+        return entry
+
+    def hit_count(self, entry: DomainEntry) -> int:
+        """Return how many lookups returned the entry since it was added."""
+        return self.hits.get((entry.type_code, entry.domain), 0)
+
+    def lookup_ns(self, query: str) -> Optional[DomainEntry]:
+        entry = super().lookup_ns(query)
+        if entry is not None:
+            self.lru.move_to_end((entry.type_code, entry.domain))
+        return entry
+
+    def resolve(self, query: str) -> str:
+        """Remove the expired entries, then resolve the query like a DomainList. The answer may be stale."""
+        self.remove_expired()
+        return super().resolve(query)
+
+    def entries(self) -> List[DomainEntry]:
+        """Return the cached entries, from least to most recently used."""
+        return list(self.lru.values())
+
+    def save(self, path: str):
+        """Save the cache to a cache file."""
+        save_entries(self.entries(), path)
+
+    def load(self, path: str):
+        """Add the live entries of a cache file. Entries already in the cache are kept over the loaded ones."""
+        for entry in load_entries(path):
+            self.add_if_missing(entry)
+
+    def add_if_missing(self, entry: DomainEntry):
+        """Add an entry, unless the cache already holds one for its type and domain."""
+        if self._stored(entry) is None:
+            self.add(entry)
+
+    def get(self, entry_type: str, domain: str) -> Optional[DomainEntry]:
+        if entry_type == TYPE_NEGATIVE:
+            return self.negative_records.get(domain)
+        return super().get(entry_type, domain)
+
+    def _stored(self, entry: DomainEntry) -> Optional[DomainEntry]:
+        """Return the entry currently stored in the index for this entry's type and domain."""
+        return self.get(entry.entry_type, entry.domain)
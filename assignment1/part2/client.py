@@ -1,41 +1,249 @@
+import csv
+import selectors
 import socket
 import sys
+import time
 from sys import argv
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+import protocol
+from server import NO_DOMAIN_ENTRY_STR, parse_options
+
+# Batch mode defaults: how many queries to keep outstanding, how long to wait for each, and how many times to resend
+DEFAULT_WINDOW = 64
+DEFAULT_TIMEOUT = 1.0
+DEFAULT_RETRIES = 2
+
+# Printed for a name that got no answer after all the retries
+NO_ANSWER_STR = "no answer"
+
+
+def print_answer(answer: str):
+    """Print the IP of an answer, or the answer itself if it is not an entry."""
+    parts = answer.split(',')
+    if len(parts) == 3:
+        ip = parts[1]
+        print(ip)
+    else:
+        print(answer)
+
+
+def query_text(s: socket.socket, server_addr, query: str) -> str:
+    """Send a text query and return the answer."""
+    s.sendto(query.encode(), server_addr)
+    data, addr = s.recvfrom(protocol.MAX_DATAGRAM_SIZE)
+    return data.decode()
+
+
+def query_binary(s: socket.socket, server_addr, txid: int, names):
+    """
+    Send the names in one binary query and return the answers, one for each name.
+    The names whose answers did not fit in a truncated response get no answer.
+    Returns None if the server does not speak our version of the binary protocol.
+    """
+    s.sendto(protocol.encode_query(txid, names), server_addr)
+    while True:
+        data, addr = s.recvfrom(protocol.MAX_DATAGRAM_SIZE)
+        # A text answer means the server only speaks the text protocol
+        if not protocol.is_binary(data):
+            return None
+        try:
+            version, flags, answer_txid, records = protocol.decode_response(data)
+        except protocol.ProtocolError:
+            continue
+        # Skip late answers to earlier queries
+        if answer_txid != txid:
+            continue
+        if flags & protocol.FLAG_BAD_VERSION:
+            return None
+        answers = [NO_DOMAIN_ENTRY_STR if record is None else ",".join(record) for record in records]
+        return answers + [NO_ANSWER_STR] * (len(names) - len(answers))
+
+
+def read_names(path: str) -> Iterator[str]:
+    """Yield the names of a batch file, one per line, or of stdin if the path is empty or "-"."""
+    file = sys.stdin if path in ("", "-") else open(path, 'r')
+    try:
+        for line in file:
+            name = line.strip()
+            if name:
+                yield name
+    finally:
+        if file is not sys.stdin:
+            file.close()
+
+
+def resolve_batch(server_addr, names: Iterable[str], window: int = DEFAULT_WINDOW,
+                  timeout: float = DEFAULT_TIMEOUT, retries: int = DEFAULT_RETRIES
+                  ) -> Iterator[Tuple[int, str, Optional[str]]]:
+    """
+    Resolve the names with up to window text queries outstanding, and yield (input index, name, answer)
+    as the answers arrive, the answer being None if the server did not answer any of the tries.
+    Each outstanding query has its own socket connected to the server, since a text answer does not say
+    which query it is for. The socket of a query that was given up on, or that was sent more than once,
+    is replaced, so a late answer to another try cannot be taken for the answer of the next query.
+    """
+    def new_socket() -> socket.socket:
+        s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        s.connect(server_addr)
+        s.setblocking(False)
+        return s
+
+    selector = selectors.DefaultSelector()
+    free: List[socket.socket] = [new_socket() for _ in range(window)]
+    # socket -> [input index, name, tries so far, deadline of the current try]
+    pending: Dict[socket.socket, list] = {}
+    queue = enumerate(names)
+    more = True
+
+    def send(s: socket.socket, query: list):
+        query[2] += 1
+        query[3] = time.monotonic() + timeout
+        try:
+            s.send(query[1].encode())
+        except OSError:
+            # Like a lost datagram, the try times out
+            pass
+
+    try:
+        while True:
+            # Fill the window
+            while more and free:
+                item = next(queue, None)
+                if item is None:
+                    more = False
+                    break
+                s = free.pop()
+                pending[s] = [item[0], item[1], 0, 0.0]
+                selector.register(s, selectors.EVENT_READ)
+                send(s, pending[s])
+            if not pending:
+                return
+
+            wait = min(query[3] for query in pending.values()) - time.monotonic()
+            for key, _ in selector.select(max(wait, 0)):
+                s = key.fileobj
+                try:
+                    data = s.recv(protocol.MAX_DATAGRAM_SIZE)
+                except OSError:
+                    # An ICMP error for this try, it times out like a lost one
+                    continue
+                index, name, tries, _ = pending.pop(s)
+                selector.unregister(s)
+                if tries > 1:
+                    # The answer to another try may still arrive on this socket
+                    s.close()
+                    s = new_socket()
+                free.append(s)
+                yield index, name, data.decode()
+
+            now = time.monotonic()
+            for s, query in list(pending.items()):
+                if query[3] > now:
+                    continue
+                if query[2] <= retries:
+                    send(s, query)
+                    continue
+                del pending[s]
+                selector.unregister(s)
+                s.close()
+                free.append(new_socket())
+                yield query[0], query[1], None
+    finally:
+        for s in list(pending) + free:
+            s.close()
+        selector.close()
+
+
+def write_batch_results(results: Iterator[Tuple[int, str, Optional[str]]], as_csv: bool):
+    """
+    Print the results of a batch: as CSV rows of name, ip, type in the order they arrive,
+    or like the interactive mode in the input order.
+    """
+    if as_csv:
+        writer = csv.writer(sys.stdout)
+        writer.writerow(["name", "ip", "type"])
+        for _, name, answer in results:
+            parts = [] if answer is None else answer.split(',')
+            if len(parts) == 3:
+                writer.writerow([name, parts[1], parts[2]])
+            else:
+                writer.writerow([name, "", "NXDOMAIN" if answer == NO_DOMAIN_ENTRY_STR else "TIMEOUT"])
+        return
+
+    # The answers that arrived before the ones of earlier names
+    waiting: Dict[int, Optional[str]] = {}
+    next_index = 0
+    for index, _, answer in results:
+        waiting[index] = answer
+        while next_index in waiting:
+            answer = waiting.pop(next_index)
+            print_answer(NO_ANSWER_STR if answer is None else answer)
+            next_index += 1
+
 
 def main():
     # Check that the correct number of arguments are provided
     if len(argv) < 3:
-        # print("Usage: python client.py <serverIP> <serverPort>")
+        # print("Usage: python client.py <serverIP> <serverPort> [--binary] "
+        #       "[--batch [namesFile]] [--window N] [--timeout SEC] [--retries N] [--csv]")
         sys.exit()
 
     # Get the arguments into variables
     server_ip = argv[1]
     server_port = int(argv[2])
+    options = parse_options(argv[3:])
+    # In binary mode, all the names on an input line are resolved in one round trip
+    binary = "--binary" in options
+    # In batch mode, the names are read from the file, or from stdin, and resolved with a window of queries
+    batch_file = options.get("--batch")
+    window = int(options.get("--window", DEFAULT_WINDOW))
+    timeout = float(options.get("--timeout", DEFAULT_TIMEOUT))
+    retries = int(options.get("--retries", DEFAULT_RETRIES))
+    as_csv = "--csv" in options
 
     # Check that the port number is valid
     if server_port < 0 or server_port > 65535:
         # print("Server port number must be in range 0-65535")
         sys.exit()
 
+    server_addr = (server_ip, server_port)
+    if batch_file is not None:
+        try:
+            write_batch_results(resolve_batch(server_addr, read_names(batch_file), window, timeout, retries), as_csv)
+        except (KeyboardInterrupt, BrokenPipeError):
+            pass
+        except OSError as e:
+            # print(f"Error reading the names: {e}")
+            sys.exit(1)
+        return
+
     # Create the UDP socket
     s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    txid = 0
 
     try:
         while True:
             # Get the query from the user
             query = input()
-            # Send the query to the server
-            s.sendto(query.encode(), (server_ip, server_port))
-            data, addr = s.recvfrom(1024)
-            # Receive the answer from the server and print it
-            answer = data.decode()
-            parts = answer.split(',')
-            if len(parts) == 3:
-                ip = parts[1]
-                print(ip)
-            else:
-                print(answer)
-    except KeyboardInterrupt:
+            if binary:
+                names = query.split()
+                if not names:
+                    continue
+                txid = (txid + 1) & 0xFFFF
+                answers = query_binary(s, server_addr, txid, names)
+                if answers is not None:
+                    for answer in answers:
+                        print_answer(answer)
+                    continue
+                # The server does not speak the binary protocol, use the text one from now on
+                binary = False
+                for name in names:
+                    print_answer(query_text(s, server_addr, name))
+                continue
+            # Send the query to the server, then receive the answer and print it
+            print_answer(query_text(s, server_addr, query))
+    except (KeyboardInterrupt, EOFError):
         pass
 
     s.close()
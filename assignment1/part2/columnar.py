@@ -0,0 +1,156 @@
+import socket
+import struct
+import time
+from array import array
+from typing import Dict, Iterator, List, Optional
+
+from server import DomainList, DomainEntry
+
+# Stored in the expire time column for an entry that never expires
+NO_EXPIRE_TIME = 0.0
+
+IPV4 = struct.Struct('!I')
+
+
+def pack_ipv4(ip: str) -> Optional[int]:
+    """Pack a dotted IPv4 address into an int, None if the ip is anything else (like an NS ip:port)."""
+    try:
+        packed = socket.inet_aton(ip)
+    except OSError:
+        return None
+    # inet_aton also accepts short forms like "1.2", which would not come back the same
+    if socket.inet_ntoa(packed) != ip:
+        return None
+    return IPV4.unpack(packed)[0]
+
+
+class ColumnarDomainList(DomainList):
+    """
+    A DomainList that stores its entries column by column instead of as DomainEntry objects.
+    Each entry is a row: its domain is in a list of strings shared with the indexes,
+    and its IPv4 address, type code and expire time are packed in arrays. Other ips, like the ip:port of an NS entry,
+    are kept as strings in a dict of the rows that have them.
+    The indexes map a domain to its row, and a DomainEntry is only built for an entry a lookup returns.
+    Removed rows are not reused, which suits a zone that is loaded once.
+    """
+    def __init__(self):
+        super().__init__()
+        # The indexes map to row numbers instead of entries
+        self.a_records: Dict[str, int] = {}
+        self.ns_records: Dict[str, int] = {}
+        self.domains: List[str] = []
+        self.ipv4s = array('I')
+        # row -> ip, for the rows whose ip is not an IPv4 address
+        self.other_ips: Dict[int, str] = {}
+        self.type_codes = array('B')
+        self.expire_times = array('d')
+
+    def __iter__(self) -> Iterator[DomainEntry]:
+        for row in self.a_records.values():
+            yield self.entry_at(row)
+        for row in self.ns_records.values():
+            yield self.entry_at(row)
+
+    def entry_at(self, row: int) -> DomainEntry:
+        """Build the DomainEntry of a row."""
+        expire_time = self.expire_times[row]
+        entry = DomainEntry.__new__(DomainEntry)
+        entry.domain = self.domains[row]
+        entry.ip = self.ip_at(row)
+        entry.type_code = self.type_codes[row]
+        entry.expire_time = None if expire_time == NO_EXPIRE_TIME else expire_time
+        return entry
+
+    def ip_at(self, row: int) -> str:
+        ip = self.other_ips.get(row)
+        if ip is None:
+            ip = socket.inet_ntoa(IPV4.pack(self.ipv4s[row]))
+        return ip
+
+    def row_expired(self, row: int) -> bool:
+        expire_time = self.expire_times[row]
+        return expire_time != NO_EXPIRE_TIME and time.time() >= expire_time
+
+    def index_of(self, type_code: int) -> Optional[Dict[str, int]]:
+        if type_code == DomainEntry.CODE_A:
+            return self.a_records
+        if type_code == DomainEntry.CODE_NS:
+            return self.ns_records
+        return None
+
+    def add(self, entry: DomainEntry):
+        """Add a new domain entry as a row.
+         The first entry added for a domain wins, unless it has already expired."""
+        index = self.index_of(entry.type_code)
+        if index is None:
+            return
+        existing = index.get(entry.domain)
+        if existing is not None and not self.row_expired(existing):
+            return
+        row = len(self.domains)
+        self.domains.append(entry.domain)
+        ipv4 = pack_ipv4(entry.ip)
+        if ipv4 is None:
+            self.other_ips[row] = entry.ip
+            ipv4 = 0
+        self.ipv4s.append(ipv4)
+        self.type_codes.append(entry.type_code)
+        self.expire_times.append(NO_EXPIRE_TIME if entry.expire_time is None else entry.expire_time)
+        index[entry.domain] = row
+        if existing is None and entry.type_code == DomainEntry.CODE_NS:
+            self._add_ns_length(len(entry.domain))
+
+    def get(self, entry_type: str, domain: str) -> Optional[DomainEntry]:
+        index = self.index_of(DomainEntry.TYPE_CODES.get(entry_type, 0))
+        row = None if index is None else index.get(domain)
+        return None if row is None else self.entry_at(row)
+
+    def remove(self, entry: DomainEntry):
+        """Remove the row stored for the entry's type and domain, if it holds the same ip."""
+        index = self.index_of(entry.type_code)
+        row = None if index is None else index.get(entry.domain)
+        if row is None or self.ip_at(row) != entry.ip:
+            return
+        del index[entry.domain]
+        if entry.type_code == DomainEntry.CODE_NS:
+            self._remove_ns_length(len(entry.domain))
+
+    def copy(self) -> "ColumnarDomainList":
+        """Return a new ColumnarDomainList with the same rows."""
+        other = ColumnarDomainList()
+        other.a_records = self.a_records.copy()
+        other.ns_records = self.ns_records.copy()
+        other.ns_lengths = self.ns_lengths.copy()
+        other.ns_lengths_desc = list(self.ns_lengths_desc)
+        other.domains = list(self.domains)
+        other.ipv4s = array('I', self.ipv4s)
+        other.other_ips = self.other_ips.copy()
+        other.type_codes = array('B', self.type_codes)
+        other.expire_times = array('d', self.expire_times)
+        return other
+
+    def lookup_a(self, query: str) -> Optional[DomainEntry]:
+        row = self.a_records.get(query)
+        if row is None:
+            return None
+        if self.row_expired(row):
+            del self.a_records[query]
+            return None
+        return self.entry_at(row)
+
+    def lookup_ns(self, query: str) -> Optional[DomainEntry]:
+        query_len = len(query)
+        for length in self.ns_lengths_desc:
+            if length > query_len:
+                continue
+            suffix = query[query_len - length:]
+            row = self.ns_records.get(suffix)
+            if row is None:
+                continue
+            if self.row_expired(row):
+                # Drop it and keep looking for a shorter delegation
+                del self.ns_records[suffix]
+                self._remove_ns_length(length)
+                continue
+            return self.entry_at(row)
+        return None
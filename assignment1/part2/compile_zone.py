@@ -0,0 +1,22 @@
+import sys
+from sys import argv
+
+from zone_snapshot import compile_zone, read_zone_file
+
+
+def main():
+    # Check command line arguments
+    if len(argv) < 3:
+        # print("Usage: python compile_zone.py <zoneFileName> <snapshotFileName>")
+        sys.exit()
+
+    zone_file_name = argv[1]
+    snapshot_file_name = argv[2]
+
+    # Compile the zone file into a snapshot that server.py can memory-map instead of parsing
+    count = compile_zone(read_zone_file(zone_file_name), snapshot_file_name)
+    print(f"{count} records written to {snapshot_file_name}")
+
+
+if __name__ == "__main__":
+    main()
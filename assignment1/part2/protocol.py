@@ -0,0 +1,138 @@
+import struct
+from typing import List, Optional, Tuple
+
+# A record as it is carried by the binary protocol: (domain, ip, entry type)
+Record = Tuple[str, str, str]
+
+# A text query is a domain name, so it never starts with a NUL byte. A binary message always does.
+MAGIC = 0x00
+VERSION = 1
+
+# Header flags
+FLAG_RESPONSE = 0x01
+# Set in a response when the query's version is not supported, the header then carries the server's version
+FLAG_BAD_VERSION = 0x02
+# Set in a response that holds only the answers to the first questions, because all of them do not fit in a datagram
+FLAG_TRUNCATED = 0x04
+
+# magic, version, flags, transaction ID, number of questions or answers
+HEADER = struct.Struct('!BBBHH')
+LENGTH = struct.Struct('!H')
+
+# Entry types on the wire, 0 means there is no entry for the question
+TYPE_CODES = {"A": 1, "NS": 2}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+NO_ENTRY_CODE = 0
+
+# Big enough for any UDP datagram
+MAX_DATAGRAM_SIZE = 65535
+# The largest payload a UDP datagram over IPv4 can carry, a bigger response can't be sent
+MAX_RESPONSE_SIZE = 65507
+
+
+class ProtocolError(ValueError):
+    """Raised when a binary message is malformed."""
+
+
+def is_binary(data: bytes) -> bool:
+    """Check if a datagram is a binary protocol message rather than a text one."""
+    return len(data) > 0 and data[0] == MAGIC
+
+
+def encode_query(txid: int, names: List[str], version: int = VERSION) -> bytes:
+    """Encode a query message with a question for each name."""
+    parts = [HEADER.pack(MAGIC, version, 0, txid, len(names))]
+    for name in names:
+        encoded = name.encode()
+        parts.append(LENGTH.pack(len(encoded)))
+        parts.append(encoded)
+    return b"".join(parts)
+
+
+def decode_query(data: bytes) -> Tuple[int, int, List[str]]:
+    """Decode a query message into its version, transaction ID and names."""
+    magic, version, flags, txid, count = _unpack_header(data)
+    if flags & FLAG_RESPONSE:
+        raise ProtocolError("expected a query, got a response")
+    names = []
+    offset = HEADER.size
+    for _ in range(count):
+        name, offset = _read_string(data, offset)
+        names.append(name)
+    return version, txid, names
+
+
+def encode_response(txid: int, answers: List[Optional[Record]], flags: int = 0,
+                    max_size: int = MAX_RESPONSE_SIZE) -> bytes:
+    """
+    Encode a response message with an answer for each question, None for a non-existent domain.
+    If the answers don't all fit in max_size bytes, only the first ones that fit are encoded,
+    and the response is flagged as truncated.
+    """
+    parts = [b""]
+    size = HEADER.size
+    count = 0
+    for answer in answers:
+        if answer is None:
+            encoded = bytes((NO_ENTRY_CODE,))
+        else:
+            domain, ip, entry_type = answer
+            domain, ip = domain.encode(), ip.encode()
+            encoded = b"".join((bytes((TYPE_CODES[entry_type],)),
+                                LENGTH.pack(len(domain)), domain, LENGTH.pack(len(ip)), ip))
+        if size + len(encoded) > max_size:
+            flags |= FLAG_TRUNCATED
+            break
+        parts.append(encoded)
+        size += len(encoded)
+        count += 1
+    parts[0] = HEADER.pack(MAGIC, VERSION, FLAG_RESPONSE | flags, txid, count)
+    return b"".join(parts)
+
+
+def decode_response(data: bytes) -> Tuple[int, int, int, List[Optional[Record]]]:
+    """Decode a response message into its version, flags, transaction ID and answers."""
+    magic, version, flags, txid, count = _unpack_header(data)
+    if not flags & FLAG_RESPONSE:
+        raise ProtocolError("expected a response, got a query")
+    answers: List[Optional[Record]] = []
+    offset = HEADER.size
+    for _ in range(count):
+        if offset >= len(data):
+            raise ProtocolError("truncated answer")
+        type_code = data[offset]
+        offset += 1
+        if type_code == NO_ENTRY_CODE:
+            answers.append(None)
+            continue
+        if type_code not in TYPE_NAMES:
+            raise ProtocolError(f"unknown entry type {type_code}")
+        domain, offset = _read_string(data, offset)
+        ip, offset = _read_string(data, offset)
+        answers.append((domain, ip, TYPE_NAMES[type_code]))
+    return version, flags, txid, answers
+
+
+def _unpack_header(data: bytes) -> Tuple[int, int, int, int, int]:
+    if len(data) < HEADER.size:
+        raise ProtocolError("truncated header")
+    header = HEADER.unpack_from(data)
+    if header[0] != MAGIC:
+        raise ProtocolError("not a binary message")
+    return header
+
+
+def _read_string(data: bytes, offset: int) -> Tuple[str, int]:
+    """Read a length prefixed string, return it and the offset after it."""
+    if offset + LENGTH.size > len(data):
+        raise ProtocolError("truncated length")
+    (length,) = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    if offset + length > len(data):
+        raise ProtocolError("truncated string")
+    try:
+        # str() decodes a memoryview too, without copying it into bytes first
+        value = str(data[offset:offset + length], 'utf-8')
+    except UnicodeDecodeError as e:
+        raise ProtocolError("string is not UTF-8") from e
+    return value, offset + length
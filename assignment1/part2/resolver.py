@@ -1,67 +1,627 @@
+import asyncio
+import signal
 import socket
 import sys
 from sys import argv
 import time
+from typing import Dict, List, Optional, Set, Tuple
 
-from server import DomainList, DomainEntry, NO_DOMAIN_ENTRY_STR
+from server import DomainEntry, NO_DOMAIN_ENTRY_STR, parse_options
+from cache import DomainCache, load_entries, save_entries
+import protocol
+from batch_io import BatchedDatagramSocket
+from upstream import Address, UpstreamPool, parse_addresses
+from stats import Stats, DEFAULT_STATS_INTERVAL, StatsProtocol, dump_stats_periodically
 
+# Default time to wait for an upstream answer, and how many times to resend before giving up
+DEFAULT_UPSTREAM_TIMEOUT = 2.0
+DEFAULT_UPSTREAM_RETRIES = 2
 
-def resolve_ns_record(s: socket.socket, domain_list: DomainList, cache_time: int, ip_str: str, query: str) -> str:
+# Default time between saves of the cache to its cache file
+DEFAULT_CACHE_SAVE_INTERVAL = 60.0
+# How many loaded entries to add to the cache between serving queries
+CACHE_LOAD_CHUNK = 10000
+
+# How many hits make an A record popular enough to prefetch
+DEFAULT_PREFETCH_MIN_HITS = 2
+
+
+class UpstreamProtocol(asyncio.DatagramProtocol):
     """
-    Resolve an NS record by querying the nameserver specified in ip_str.
-    This function sends the query to the nameserver and processes the response.
-    If the response is an A record, it adds it to the domain list and returns the
-    answer. If the response is another NS record, it continues querying the new nameserver.
+    The protocol of the socket of a single upstream query.
+    The socket is connected to the queried server, so the first datagram it gets is the answer.
     """
-    # Unpack the IP and port from the ip_str
-    current_ns_ip, current_port_str = ip_str.split(':')
-    current_port = int(current_port_str)
+    def __init__(self, answer: asyncio.Future):
+        self.answer = answer
 
-    # While loop to handle multiple NS records
-    while True:
-        # Send the query to the current server
-        s.sendto(query.encode(), (current_ns_ip, current_port))
+    def datagram_received(self, data: bytes, addr):
+        if not self.answer.done():
+            self.answer.set_result(data.decode())
 
-        # Get the answer from the server
-        ns_answer_bytes, _ = s.recvfrom(1024)
-        answer = ns_answer_bytes.decode()
+    def error_received(self, exc: Exception):
+        # An ICMP error for a lost or refused datagram, the timeout takes care of it
+        pass
 
-        # If the answer is NO_DOMAIN_ENTRY_STR, break the loop
-        if answer == NO_DOMAIN_ENTRY_STR:
-            break
 
-        # Else, parse the answer
-        parts = answer.split(',')
+class BinaryUpstreamProtocol(asyncio.DatagramProtocol):
+    """
+    The protocol of the socket shared by all the binary upstream queries.
+    Each answer is matched to its query by the transaction ID in its header.
+    """
+    def __init__(self, resolver: "Resolver"):
+        self.resolver = resolver
+
+    def datagram_received(self, data: bytes, addr):
+        try:
+            _, flags, txid, answers = protocol.decode_response(data)
+        except protocol.ProtocolError:
+            return
+        pending = self.resolver.outstanding.get(txid)
+        # Drop answers to queries that are already done, or that were sent to another server
+        if pending is None or pending[0] != addr or pending[2].done():
+            return
+        if flags & protocol.FLAG_BAD_VERSION:
+            # The server does not speak our version, treat it like a server that does not answer
+            pending[2].set_result(None)
+        elif answers and answers[0] is not None:
+            pending[2].set_result(format_answer(answers[0]))
+        else:
+            pending[2].set_result(NO_DOMAIN_ENTRY_STR)
+
+    def error_received(self, exc: Exception):
+        pass
+
+
+def format_answer(record: protocol.Record) -> str:
+    """Format a binary protocol record as a text protocol answer."""
+    return ",".join(record)
+
 
-        # If it is not a valid entry, break the loop
-        if len(parts) != 3:
-            break
+def parse_answer(answer: str) -> Optional[protocol.Record]:
+    """Parse a text protocol answer into a binary protocol record, None for a non-existent domain."""
+    parts = answer.split(',')
+    if len(parts) != 3:
+        return None
+    return parts[0], parts[1], parts[2]
 
-        # Parse the parts
-        domain, ip, entry_type = parts[0], parts[1], parts[2]
 
-        # Set expire time and add to domain list
+class Resolver:
+    """
+    Resolves client queries from the cache, the parent server, and the NS servers it delegates to.
+    Every upstream query is tracked in the outstanding table under its own query ID until it is answered or times out,
+    so a slow server only delays the clients waiting on it.
+    Identical upstream queries are coalesced: while one is in flight, later ones wait for its answer instead of sending.
+    Upstream queries are sent in the text protocol, unless start_binary_upstream was called.
+    The parent and an NS delegation can have several servers: a query goes to the fastest healthy one,
+    and fails over to the next one when it times out.
+    """
+    def __init__(self, domain_list: DomainCache, parent_addrs: List[Address], cache_time: int,
+                 timeout: float = DEFAULT_UPSTREAM_TIMEOUT, retries: int = DEFAULT_UPSTREAM_RETRIES,
+                 negative_ttl: float = 0, delegation_ttl: Optional[float] = None,
+                 prefetch_window: float = 0, prefetch_min_hits: int = DEFAULT_PREFETCH_MIN_HITS,
+                 hedge_delay: float = 0, stats: Optional[Stats] = None):
+        self.domain_list = domain_list
+        self.parent_addrs = parent_addrs
+        self.cache_time = cache_time
+        # How long to cache non-existent domain answers, 0 does not cache them
+        self.negative_ttl = negative_ttl
+        # How long to cache NS delegations, None caches them for cacheTime like the A records
+        self.delegation_ttl = delegation_ttl
+        # An A record hit at least prefetch_min_hits times is refreshed when it is hit this long before it expires,
+        # 0 does not prefetch
+        self.prefetch_window = prefetch_window
+        self.prefetch_min_hits = prefetch_min_hits
+        # The queries being refreshed in the background, and their tasks
+        self.refreshing: Dict[str, asyncio.Task] = {}
+        self.timeout = timeout
+        self.retries = retries
+        # The smoothed RTT and health of each upstream server
+        self.pool = UpstreamPool(timeout)
+        # When a server has not answered after this long, also send the query to the next one, 0 does not
+        self.hedge_delay = hedge_delay
+        # The copies of queries sent to servers that were never measured, they run on after the query is answered
+        self.probes: Set[asyncio.Future] = set()
+        # query ID -> (server address, query, future of the answer)
+        self.outstanding: Dict[int, Tuple[Address, str, asyncio.Future]] = {}
+        self.next_query_id = 0
+        # (server addresses, query) -> task of the upstream query that is in flight for it
+        self.in_flight: Dict[Tuple[Tuple[Address, ...], str], asyncio.Future] = {}
+        # The socket shared by the binary upstream queries, None while upstream queries use the text protocol
+        self.upstream_transport = None
+        # None when stats are off, then nothing is measured
+        self.stats = stats
+        if stats is not None:
+            stats.gauge("cache_entries", lambda: len(domain_list.lru))
+            stats.gauge("cache_expirations", lambda: domain_list.expirations)
+            stats.gauge("cache_evictions", lambda: domain_list.evictions)
+            stats.gauge("upstream_in_flight", lambda: len(self.outstanding))
+            stats.gauge("upstream_srtt_ms", lambda: {
+                f"{ip}:{port}": None if server.srtt is None else round(server.srtt * 1000, 3)
+                for (ip, port), server in self.pool.servers.items()})
+
+    async def start_binary_upstream(self):
+        """Send the upstream queries in the binary protocol, over one shared socket."""
+        loop = asyncio.get_running_loop()
+        self.upstream_transport, _ = await loop.create_datagram_endpoint(
+            lambda: BinaryUpstreamProtocol(self), local_addr=('0.0.0.0', 0))
+
+    def allocate_query_id(self) -> int:
+        """Return the next 16 bit query ID that is not outstanding."""
+        while True:
+            self.next_query_id = (self.next_query_id + 1) & 0xFFFF
+            if self.next_query_id not in self.outstanding:
+                return self.next_query_id
+
+    async def query_upstream(self, addrs: List[Address], query: str) -> Optional[str]:
+        """
+        Return the answer of one of the upstream servers to a query.
+        If the same query to the same servers is already in flight, wait for its answer instead of sending another one.
+        """
+        key = (tuple(addrs), query)
+        pending = self.in_flight.get(key)
+        if pending is None:
+            pending = asyncio.ensure_future(self.query_servers(addrs, query))
+            self.in_flight[key] = pending
+            pending.add_done_callback(lambda _: self.in_flight.pop(key, None))
+        elif self.stats is not None:
+            self.stats.count("upstream_coalesced")
+        # Shield the shared query, so one waiter being cancelled does not cancel it for the others
+        return await asyncio.shield(pending)
+
+    async def query_servers(self, addrs: List[Address], query: str) -> Optional[str]:
+        """
+        Send a query to the best of the servers, and on each timeout to the next one, until one of them answers.
+        Each server is tried at least once, and a single server is tried retries + 1 times.
+        With a hedge delay, the next server is queried when the current one is slower than it, without waiting
+        for the timeout, and the first answer wins.
+        A server that was never measured, or not for a while, is probed with a copy of the query, sent along with
+        the one to the best server. Its answer may win too, and it is not cancelled when another server answers first, so its answer
+        or its timeout is measured.
+        None is returned if all the tries time out.
+        """
+        servers = self.pool.order(addrs)
+        attempts = max(self.retries + 1, len(servers))
+        # With a single server there is nothing to fail over to, so it gets the full timeout on each try
+        fixed_timeout = self.timeout if len(servers) == 1 else None
+        tries: Set[asyncio.Future] = set()
+        sent = 0
+        probe_addr = self.pool.start_probe(servers)
+        probe = None
+        if probe_addr is not None:
+            probe = asyncio.ensure_future(self.send_query(probe_addr, query, self.pool.timeout_for(probe_addr)))
+            probe.add_done_callback(lambda _: self.pool.end_probe(probe_addr))
+            # Keep a reference, the probe runs on after this query returns
+            self.probes.add(probe)
+            probe.add_done_callback(self.probes.discard)
+            tries.add(probe)
+            if self.stats is not None:
+                self.stats.count("upstream_probes")
+        try:
+            while True:
+                if sent < attempts:
+                    addr = servers[sent % len(servers)]
+                    timeout = fixed_timeout or self.pool.timeout_for(addr)
+                    if tries and self.stats is not None:
+                        self.stats.count("upstream_hedged")
+                    tries.add(asyncio.ensure_future(self.send_query(addr, query, timeout)))
+                    sent += 1
+                # Hedging only makes sense with another server to send to
+                hedge = self.hedge_delay if self.hedge_delay > 0 and len(servers) > 1 and sent < attempts else None
+                done, tries = await asyncio.wait(tries, timeout=hedge, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    answer = task.result()
+                    if answer is not None:
+                        return answer
+                if not tries and sent >= attempts:
+                    return None
+        finally:
+            for task in tries:
+                if task is not probe:
+                    task.cancel()
+
+    async def send_query(self, addr: Address, query: str, timeout: float) -> Optional[str]:
+        """
+        Send a query to an upstream server and return its answer, None if it does not answer in time.
+        The round trip time of the answer, or the timeout, is recorded in the pool.
+        """
+        loop = asyncio.get_running_loop()
+        answer = loop.create_future()
+
+        if self.upstream_transport is not None:
+            # The answer is matched to the query by its ID, in BinaryUpstreamProtocol
+            transport = self.upstream_transport
+            query_id = self.allocate_query_id()
+            data = protocol.encode_query(query_id, [query])
+        else:
+            # The text protocol carries no ID, so each query gets its own socket connected to the server,
+            # and the kernel drops any datagram that is not from that server
+            transport, _ = await loop.create_datagram_endpoint(
+                lambda: UpstreamProtocol(answer), remote_addr=addr)
+            query_id = self.allocate_query_id()
+            data = query.encode()
+
+        self.outstanding[query_id] = (addr, query, answer)
+        if self.stats is not None:
+            self.stats.count("upstream_queries")
+        try:
+            sent_time = time.monotonic()
+            if transport is self.upstream_transport:
+                transport.sendto(data, addr)
+            else:
+                transport.sendto(data)
+            try:
+                result = await asyncio.wait_for(asyncio.shield(answer), timeout)
+            except asyncio.TimeoutError:
+                self.pool.record_timeout(addr, timeout)
+                if self.stats is not None:
+                    self.stats.count("upstream_timeouts")
+                return None
+            except asyncio.CancelledError:
+                # Another server answered first
+                self.pool.record_no_answer_yet(addr, time.monotonic() - sent_time)
+                raise
+            if result is not None:
+                rtt = time.monotonic() - sent_time
+                self.pool.record_answer(addr, rtt)
+                if self.stats is not None:
+                    self.stats.observe_time("upstream_rtt", rtt)
+            return result
+        finally:
+            del self.outstanding[query_id]
+            if transport is not self.upstream_transport:
+                transport.close()
+
+    def cache_answer(self, domain: str, ip: str, entry_type: str):
+        """Add an answer to the cache, with an expire time if cacheTime (or the delegation TTL for NS) is set."""
+        ttl = self.cache_time
+        if entry_type == DomainEntry.TYPE_NS and self.delegation_ttl is not None:
+            ttl = self.delegation_ttl
         expire_time = None
-        if cache_time > 0:
-            expire_time = time.time() + cache_time
-        domain_list.add(DomainEntry(domain, ip, entry_type, expire_time))
+        if ttl > 0:
+            expire_time = time.time() + ttl
+        self.domain_list.add(DomainEntry(domain, ip, entry_type, expire_time))
+
+    def cache_negative(self, query: str):
+        """
+        Cache a non-existent domain answer, if negative caching is on.
+        Either way the cached A record of the query is dropped, so a stale answer is not served anymore.
+        """
+        if self.negative_ttl > 0:
+            self.domain_list.add_negative(query, time.time() + self.negative_ttl)
+        else:
+            self.domain_list.remove_answer(query)
 
-        # If it is an A record, return the answer
-        if entry_type == DomainEntry.TYPE_A:
-            break
+    def record_hops(self, hops: int):
+        """Count how many upstream servers were queried in turn to resolve a query."""
+        if self.stats is not None:
+            self.stats.observe_value("ns_hops", hops)
 
-        # If it is an NS record, update the current_ns_ip and current_port
-        elif entry_type == DomainEntry.TYPE_NS:
-            current_ns_ip, current_port_str = ip.split(':')
-            current_port = int(current_port_str)
+    async def resolve_ns_record(self, ip_str: str, query: str, hops: int = 0) -> str:
+        """
+        Resolve an NS record by querying the nameserver specified in ip_str.
+        This function sends the query to the nameserver and processes the response.
+        If the response is an A record, it adds it to the domain list and returns the
+        answer. If the response is another NS record, it continues querying the new nameserver.
+        hops is how many servers were already queried for it.
+        """
+        # Unpack the addresses of the nameservers from the ip_str
+        current_addrs = parse_addresses(ip_str)
 
-    return answer
+        # While loop to handle multiple NS records
+        while True:
+            # Send the query to the current nameservers and wait for an answer
+            answer = await self.query_upstream(current_addrs, query)
+            hops += 1
+
+            # If the server did not answer, give up on the query
+            if answer is None:
+                answer = NO_DOMAIN_ENTRY_STR
+                break
+
+            # If the answer is NO_DOMAIN_ENTRY_STR, cache it and break the loop
+            if answer == NO_DOMAIN_ENTRY_STR:
+                self.cache_negative(query)
+                break
+
+            # Else, parse the answer
+            parts = answer.split(',')
+
+            # If it is not a valid entry, break the loop
+            if len(parts) != 3:
+                break
+
+            # Parse the parts and add them to the cache
+            domain, ip, entry_type = parts[0], parts[1], parts[2]
+            self.cache_answer(domain, ip, entry_type)
+
+            # If it is an A record, return the answer
+            if entry_type == DomainEntry.TYPE_A:
+                break
+
+            # If it is an NS record, update the current nameservers
+            elif entry_type == DomainEntry.TYPE_NS:
+                current_addrs = parse_addresses(ip)
+
+        self.record_hops(hops)
+        return answer
+
+    async def resolve(self, query: str) -> str:
+        """
+        Resolve a client query, from the cache if possible, otherwise through the parent server.
+        A cached NS entry is the deepest known delegation of the query, so the resolution starts at its nameserver.
+        """
+        stats = self.stats
+        if stats is not None:
+            start = time.perf_counter()
+        self.domain_list.remove_expired()
+        entry = self.domain_list.lookup_a(query)
+        if entry is not None:
+            stale = False
+            if entry.expire_time is not None:
+                remaining = entry.expire_time - time.time()
+                stale = remaining <= 0
+                # A stale answer is served while it is refreshed, a popular one is refreshed before it expires
+                if stale or (remaining < self.prefetch_window and
+                             self.domain_list.hit_count(entry) >= self.prefetch_min_hits):
+                    self.refresh(query)
+            if stats is not None:
+                stats.count("cache_stale_hits" if stale else "cache_hits")
+                stats.observe_time("lookup", time.perf_counter() - start)
+            return entry.__str__()
+
+        # A cached non-existent domain answer
+        negative = self.domain_list.is_negative(query)
+        if stats is not None:
+            stats.count("cache_negative_hits" if negative else "cache_misses")
+            stats.observe_time("lookup", time.perf_counter() - start)
+        if negative:
+            return NO_DOMAIN_ENTRY_STR
+
+        if stats is None:
+            return await self.resolve_uncached(query)
+        start = time.perf_counter()
+        answer = await self.resolve_uncached(query)
+        stats.observe_time("upstream", time.perf_counter() - start)
+        return answer
+
+    def refresh(self, query: str):
+        """Resolve a query again in the background, unless it is already being refreshed."""
+        if query in self.refreshing:
+            return
+        task = asyncio.ensure_future(self.resolve_uncached(query))
+        self.refreshing[query] = task
+        if self.stats is not None:
+            self.stats.count("refreshes")
+        task.add_done_callback(lambda _: self.refreshing.pop(query, None))
+
+    async def resolve_uncached(self, query: str) -> str:
+        """Resolve a query without its cached A record, from the deepest cached delegation or the parent server."""
+        # For NS entries, we need to resolve the A record from the nameserver it delegates to
+        entry = self.domain_list.lookup_ns(query)
+        if entry is not None:
+            return await self.resolve_ns_record(entry.ip, query)
+
+        # Nothing is cached for the query, forward the request to the parent server
+        answer = await self.query_upstream(self.parent_addrs, query)
+        if answer is None:
+            self.record_hops(1)
+            return NO_DOMAIN_ENTRY_STR
+
+        if answer == NO_DOMAIN_ENTRY_STR:
+            self.cache_negative(query)
+
+        # Cache the response if it's not a non-existent domain
+        else:
+            parts = answer.split(',')
+            if len(parts) == 3:
+                domain, ip, entry_type = parts[0], parts[1], parts[2]
+                self.cache_answer(domain, ip, entry_type)
+
+                # For NS entries, we need to resolve the A record from the parent server
+                if entry_type == DomainEntry.TYPE_NS:
+                    return await self.resolve_ns_record(ip, query, 1)
+
+        self.record_hops(1)
+        return answer
+
+
+class ResolverProtocol(asyncio.DatagramProtocol):
+    """
+    The protocol of the socket the clients query.
+    Each query is resolved in its own task, so the clients do not wait for each other.
+    """
+    def __init__(self, resolver: Resolver):
+        self.resolver = resolver
+        self.transport = None
+        # Keep references to the running tasks so they are not garbage collected
+        self.tasks: Set[asyncio.Task] = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        stats = self.resolver.stats
+        # When stats are on, the time the query arrived, to time its stages from
+        start = None if stats is None else time.perf_counter()
+        # The datagram may be a memoryview into a buffer that is reused, so decode it before the task starts
+        if protocol.is_binary(data):
+            try:
+                version, txid, names = protocol.decode_query(data)
+            except protocol.ProtocolError:
+                return
+            # Tell the client which version we speak, so it can send the query again in it
+            if version != protocol.VERSION:
+                self.transport.sendto(protocol.encode_response(txid, [], protocol.FLAG_BAD_VERSION), addr)
+                return
+            task = asyncio.ensure_future(self.handle_binary_query(txid, names, addr, start))
+        else:
+            task = asyncio.ensure_future(self.handle_query(str(data, 'utf-8'), addr, start))
+        if stats is not None:
+            stats.count("queries_binary" if protocol.is_binary(data) else "queries_text")
+            stats.observe_time("decode", time.perf_counter() - start)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle_query(self, query: str, addr, start: Optional[float] = None):
+        answer = await self.resolver.resolve(query)
+        if start is None:
+            # Send the answer back to the client
+            self.transport.sendto(answer.encode(), addr)
+            return
+        encode_start = time.perf_counter()
+        data = answer.encode()
+        self.record_answered(start, encode_start)
+        self.transport.sendto(data, addr)
+
+    async def handle_binary_query(self, txid: int, names: List[str], addr, start: Optional[float] = None):
+        # Resolve all the questions of the message together
+        answers = await asyncio.gather(*(self.resolver.resolve(name) for name in names))
+        encode_start = None if start is None else time.perf_counter()
+        records = [parse_answer(answer) for answer in answers]
+        data = protocol.encode_response(txid, records)
+        if start is not None:
+            self.record_answered(start, encode_start)
+        self.transport.sendto(data, addr)
+
+    def record_answered(self, start: float, encode_start: float):
+        """Time the encoding of an answer, and the whole query from the time it arrived."""
+        now = time.perf_counter()
+        self.resolver.stats.observe_time("encode", now - encode_start)
+        self.resolver.stats.observe_time("total", now - start)
+
+
+class BatchedTransport:
+    """
+    A datagram transport for the clients' socket that reads it with a BatchedDatagramSocket.
+    Every time the socket is readable, all the ready datagrams are passed to the protocol,
+    and the replies queued during a loop iteration are flushed together at its end.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop, sock: socket.socket,
+                 datagram_protocol: asyncio.DatagramProtocol, batch_size: int):
+        self.loop = loop
+        self.batched = BatchedDatagramSocket(sock, batch_size)
+        self.protocol = datagram_protocol
+        self.flush_scheduled = False
+        self.protocol.connection_made(self)
+        self.loop.add_reader(self.batched.fileno(), self.read_ready)
+
+    def read_ready(self):
+        for data, addr in self.batched.receive_batch():
+            self.protocol.datagram_received(data, addr)
+
+    def sendto(self, data: bytes, addr):
+        self.batched.queue(data, addr)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        self.batched.flush()
+
+    def close(self):
+        self.loop.remove_reader(self.batched.fileno())
+        self.batched.sock.close()
+
+
+async def persist_cache(domain_list: DomainCache, cache_file: str, save_interval: float):
+    """
+    Warm the cache up from the cache file, then save the cache to it every save_interval seconds.
+    The file is read and parsed in a thread, and its entries are added in chunks, so queries are served meanwhile.
+    When the task is cancelled in the middle of a save, it waits for the thread to finish writing before it stops,
+    so the save on shutdown never writes the file at the same time.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        entries = await loop.run_in_executor(None, load_entries, cache_file)
+    except (OSError, ValueError):
+        # No cache file yet, or not a valid one, start cold
+        entries = []
+    for i in range(0, len(entries), CACHE_LOAD_CHUNK):
+        for entry in entries[i:i + CACHE_LOAD_CHUNK]:
+            domain_list.add_if_missing(entry)
+        await asyncio.sleep(0)
+
+    while save_interval > 0:
+        await asyncio.sleep(save_interval)
+        # Copy the entries in the loop, and write them in a thread
+        save = loop.run_in_executor(None, save_entries, domain_list.entries(), cache_file)
+        try:
+            await asyncio.shield(save)
+        except asyncio.CancelledError:
+            # Cancelling does not stop the thread, wait for it
+            await asyncio.wait([save])
+            raise
+
+
+async def serve(port: int, resolver: Resolver, upstream_binary: bool = False, batch_size: int = 0,
+                cache_file: Optional[str] = None, save_interval: float = DEFAULT_CACHE_SAVE_INTERVAL,
+                stats_port: Optional[int] = None, stats_file: Optional[str] = None,
+                stats_interval: float = DEFAULT_STATS_INTERVAL):
+    """Serve client queries on the given port until stopped.
+     If batch_size is set, the client datagrams are received and answered in batches.
+     If cache_file is set, the cache is loaded from it at startup, and saved to it periodically and on shutdown.
+     If the resolver keeps stats, they are served on stats_port and dumped to stats_file, when those are set."""
+    loop = asyncio.get_running_loop()
+    if upstream_binary:
+        await resolver.start_binary_upstream()
+
+    # Stop cleanly on SIGTERM too, so the cache gets saved
+    stopped = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, lambda: stopped.done() or stopped.set_result(None))
+
+    # Create UDP socket and bind to the specified port
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('', port))
+
+    if batch_size > 0:
+        transport = BatchedTransport(loop, s, ResolverProtocol(resolver), batch_size)
+    else:
+        transport, _ = await loop.create_datagram_endpoint(lambda: ResolverProtocol(resolver), sock=s)
+
+    persist_task = None
+    if cache_file is not None:
+        persist_task = asyncio.ensure_future(persist_cache(resolver.domain_list, cache_file, save_interval))
+
+    stats_transport = None
+    dump_task = None
+    if resolver.stats is not None:
+        if stats_port is not None:
+            stats_transport, _ = await loop.create_datagram_endpoint(
+                lambda: StatsProtocol(resolver.stats), local_addr=('127.0.0.1', stats_port))
+        if stats_file is not None:
+            dump_task = asyncio.ensure_future(dump_stats_periodically(resolver.stats, stats_file, stats_interval))
+    try:
+        await stopped
+    finally:
+        transport.close()
+        if stats_transport is not None:
+            stats_transport.close()
+        if dump_task is not None:
+            dump_task.cancel()
+            try:
+                resolver.stats.dump(stats_file)
+            except OSError:
+                pass
+        if persist_task is not None:
+            persist_task.cancel()
+            # Let a periodic save that is being written finish first
+            await asyncio.wait([persist_task])
+            try:
+                resolver.domain_list.save(cache_file)
+            except OSError as e:
+                # print(f"Error saving the cache: {e}")
+                pass
 
 
 def main():
     # Check the amount of command line arguments
     if len(argv) < 5:
-        # print("Usage: python resolver.py <myPort> <parentIP> <parentPort> <cacheTime>")
+        # print("Usage: python resolver.py <myPort> <parentIP> <parentPort> <cacheTime> "
+        #       "[--max-cache-size N] [--timeout SEC] [--retries N] [--upstream-protocol text|binary] [--batch N] "
+        #       "[--negative-ttl SEC] [--delegation-ttl SEC] [--cache-file PATH] [--cache-save-interval SEC] "
+        #       "[--prefetch SEC] [--prefetch-min-hits N] [--serve-stale SEC] [--upstreams IP:PORT,...] "
+        #       "[--hedge SEC] [--stats-port PORT] [--stats-file PATH] [--stats-interval SEC]")
         sys.exit()
 
     # Move the command line arguments into variables
@@ -69,6 +629,35 @@ def main():
     parent_ip = argv[2]
     parent_port = int(argv[3])
     cache_time = int(argv[4])
+    options = parse_options(argv[5:])
+    # 0 means the cache is only bounded by the entries' expire times
+    max_cache_size = int(options.get("--max-cache-size", 0))
+    timeout = float(options.get("--timeout", DEFAULT_UPSTREAM_TIMEOUT))
+    retries = int(options.get("--retries", DEFAULT_UPSTREAM_RETRIES))
+    # Only use the binary protocol upstream if all the servers speak it
+    upstream_binary = options.get("--upstream-protocol", "text") == "binary"
+    # How many client datagrams to receive at a time, 0 receives them one by one
+    batch_size = int(options.get("--batch", 0))
+    # How long to cache non-existent domain answers, 0 does not cache them
+    negative_ttl = float(options.get("--negative-ttl", 0))
+    # How long to cache NS delegations, by default as long as the other answers
+    delegation_ttl = float(options["--delegation-ttl"]) if "--delegation-ttl" in options else None
+    # Where to keep the cache across restarts
+    cache_file = options.get("--cache-file")
+    save_interval = float(options.get("--cache-save-interval", DEFAULT_CACHE_SAVE_INTERVAL))
+    # Refresh popular entries this long before they expire, 0 does not
+    prefetch_window = float(options.get("--prefetch", 0))
+    prefetch_min_hits = int(options.get("--prefetch-min-hits", DEFAULT_PREFETCH_MIN_HITS))
+    # Serve an expired answer for up to this long while it is refreshed, 0 does not
+    stale_window = float(options.get("--serve-stale", 0))
+    # More parent servers to fail over to, after the parentIP and parentPort one
+    extra_upstreams = parse_addresses(options.get("--upstreams", ""))
+    # Also query the next server when one has not answered after this long, 0 does not
+    hedge_delay = float(options.get("--hedge", 0))
+    # Where to expose the stats, they are off unless one is set
+    stats_port = int(options["--stats-port"]) if "--stats-port" in options else None
+    stats_file = options.get("--stats-file")
+    stats_interval = float(options.get("--stats-interval", DEFAULT_STATS_INTERVAL))
 
     # Check that port numbers are valid
     if port < 0 or port > 65535:
@@ -79,54 +668,20 @@ def main():
         # print("Parent port number must be in range 0-65535")
         sys.exit()
 
-    # Create UDP socket and bind to the specified port
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.bind(('', port))
-
-    # Create DomainList
-    domain_list = DomainList()
+    # Create the cache and the resolver
+    domain_list = DomainCache(max_cache_size, stale_window)
+    # Answers on the shared binary socket are matched by address, so it must be numeric
+    parent_addrs = [(socket.gethostbyname(host), host_port)
+                    for host, host_port in [(parent_ip, parent_port)] + extra_upstreams]
+    stats = Stats() if stats_port is not None or stats_file is not None else None
+    resolver = Resolver(domain_list, parent_addrs, cache_time, timeout, retries,
+                        negative_ttl, delegation_ttl, prefetch_window, prefetch_min_hits, hedge_delay, stats)
 
-    while True:
-        # Receive a query from a client and try to resolve it
-        data, addr = s.recvfrom(1024)
-        query = data.decode()
-        answer = domain_list.resolve(query)
-
-        # If the answer is not NO_DOMAIN_ENTRY_STR, check if it is an NS entry
-        if answer != NO_DOMAIN_ENTRY_STR:
-            # check if it is an NS entry
-            parts = answer.split(',')
-            if len(parts) == 3:
-                ip, entry_type = parts[1], parts[2]
-                # For NS entries, we need to resolve the A record from the parent server
-                if entry_type == DomainEntry.TYPE_NS:
-                    # If it is an NS entry, resolve it with the correct function
-                    answer = resolve_ns_record(s, domain_list, cache_time, ip, query)
-
-        # If the answer is NO_DOMAIN_ENTRY_STR, forward the request to the parent server
-        elif answer == NO_DOMAIN_ENTRY_STR:
-            # Forward the request to the parent server
-            s.sendto(data, (parent_ip, parent_port))
-            parent_answer, _ = s.recvfrom(1024)
-            answer = parent_answer.decode()
-
-            # Cache the response if it's not a non-existent domain
-            if answer != NO_DOMAIN_ENTRY_STR:
-                parts = answer.split(',')
-                if len(parts) == 3:
-                    domain, ip, entry_type = parts[0], parts[1], parts[2]
-                    # Set expire time and add to domain list
-                    expire_time = None
-                    if cache_time > 0:
-                        expire_time = time.time() + cache_time
-                    domain_list.add(DomainEntry(domain, ip, entry_type, expire_time))
-
-                    # For NS entries, we need to resolve the A record from the parent server
-                    if entry_type == DomainEntry.TYPE_NS:
-                        answer = resolve_ns_record(s, domain_list, cache_time, ip, query)
-
-        # Send the answer back to the client
-        s.sendto(answer.encode(), addr)
+    try:
+        asyncio.run(serve(port, resolver, upstream_binary, batch_size, cache_file, save_interval,
+                          stats_port, stats_file, stats_interval))
+    except KeyboardInterrupt:
+        pass
 
 
 if __name__ == "__main__":
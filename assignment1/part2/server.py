@@ -1,112 +1,628 @@
-import socket
-import time
-import sys
-from sys import argv
-from typing import List
-
-NO_DOMAIN_ENTRY_STR = "non-existent domain"
-
-
-class DomainEntry:
-    """
-    Represents a domain entry with domain name, IP address, entry type, and optional expiration time.
-    """
-    TYPE_NS = "NS"
-    TYPE_A = "A"
-
-    def __init__(self, domain: str, ip: str, entry_type: str, expire_time: float = None):
-        self.domain = domain.strip()
-        self.ip = ip.strip()
-        self.entry_type = entry_type.strip()
-        self.expire_time = expire_time
-
-    def __str__(self):
-        return f"{self.domain},{self.ip},{self.entry_type}"
-
-    def is_expired(self) -> bool:
-        """Check if the domain entry has expired."""
-        if self.expire_time is None:
-            return False
-        return time.time() >= self.expire_time
-
-
-class DomainList:
-    """
-    Manages a list of DomainEntry objects, allowing addition, removal of expired entries, and resolution of queries.
-    """
-    def __init__(self):
-        self.domains: List[DomainEntry] = []
-
-    def add(self, entry: DomainEntry):
-        """Add a new domain entry to the list."""
-        self.domains.append(entry)
-
-    def remove_expired(self):
-        """Remove expired domain entries from the list."""
-        self.domains = [entry for entry in self.domains if not entry.is_expired()]
-
-    def resolve(self, query: str) -> str:
-        """Resolve a domain query to its corresponding domain entry string.
-         Before the method returns, it removes expired entries,
-         First, it checks for A records, then NS records."""
-        self.remove_expired()
-        for domain_entry in self.domains:
-            # print(f"Checking domain entry: {domain_entry} for query: {query}, entry_type: {domain_entry.entry_type}")
-            # print(f"{domain_entry.domain == query}, {domain_entry.entry_type == DomainEntry.TYPE_A}")
-            if domain_entry.domain == query and domain_entry.entry_type == DomainEntry.TYPE_A:
-                return domain_entry.__str__()
-        for domain_entry in self.domains:
-            if query.endswith(domain_entry.domain) and domain_entry.entry_type == DomainEntry.TYPE_NS:
-                return domain_entry.__str__()
-        return NO_DOMAIN_ENTRY_STR
-
-
-def main():
-    # Check command line arguments
-    if len(argv) < 3:
-        # print("Usage: python server.py <myPort> <zoneFileName>")
-        sys.exit()
-
-    # Parse command line arguments
-    port = int(argv[1])
-    domain_file_name = argv[2]
-
-    # Validate port number
-    if port < 0 or port > 65535:
-        # print("Port number must be in range 0-65535")
-        sys.exit()
-
-    # Create UDP socket and bind to the specified port
-    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    s.bind(('', port))
-
-    # Create DomainList
-    domain_list = DomainList()
-
-    try:
-        # Load domain entries from the specified file
-        with open(domain_file_name, 'r') as file:
-            for line in file:
-                parts = line.split(',')
-                if len(parts) == 3:
-                    # parts[0] : domain name
-                    # parts[1] : domain ip
-                    # parts[2] : enty type
-                    domain_list.add(
-                        DomainEntry(parts[0], parts[1], parts[2])
-                    )
-    except Exception as e:
-        # print(f"Error reading domain file: {e}")
-        sys.exit()
-
-    while True:
-        # Get a query from a client
-        data, addr = s.recvfrom(1024)
-        query = data.decode()
-        # Try to resolve the query and send back the answer
-        answer = domain_list.resolve(query)
-        s.sendto(answer.encode(), addr)
-
-
-if __name__ == "__main__":
-    main()
+import gc
+import os
+import signal
+import socket
+import time
+import sys
+import threading
+from array import array
+from sys import argv
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import protocol
+from batch_io import BatchedDatagramSocket
+from stats import Stats, DEFAULT_STATS_INTERVAL, start_stats_threads
+
+NO_DOMAIN_ENTRY_STR = "non-existent domain"
+
+
+class DomainEntry:
+    """
+    Represents a domain entry with domain name, IP address, entry type, and optional expiration time.
+    Entries have no instance __dict__, and their type is stored as a small int code.
+    """
+    __slots__ = ('domain', 'ip', 'type_code', 'expire_time')
+
+    TYPE_NS = "NS"
+    TYPE_A = "A"
+
+    CODE_A = 1
+    CODE_NS = 2
+    # code -> type name, other types get the next code the first time they are seen
+    TYPE_NAMES = ["", TYPE_A, TYPE_NS]
+    TYPE_CODES = {TYPE_A: CODE_A, TYPE_NS: CODE_NS}
+
+    def __init__(self, domain: str, ip: str, entry_type: str, expire_time: float = None):
+        self.domain = domain.strip()
+        self.ip = ip.strip()
+        self.type_code = DomainEntry.code_of(entry_type.strip())
+        self.expire_time = expire_time
+
+    @staticmethod
+    def code_of(entry_type: str) -> int:
+        """Return the code of an entry type."""
+        code = DomainEntry.TYPE_CODES.get(entry_type)
+        if code is None:
+            code = len(DomainEntry.TYPE_NAMES)
+            DomainEntry.TYPE_NAMES.append(entry_type)
+            DomainEntry.TYPE_CODES[entry_type] = code
+        return code
+
+    @property
+    def entry_type(self) -> str:
+        return DomainEntry.TYPE_NAMES[self.type_code]
+
+    def __str__(self):
+        return f"{self.domain},{self.ip},{self.entry_type}"
+
+    def is_expired(self) -> bool:
+        """Check if the domain entry has expired."""
+        if self.expire_time is None:
+            return False
+        return time.time() >= self.expire_time
+
+
+class DomainList:
+    """
+    Manages an index of DomainEntry objects, allowing addition, removal of expired entries, and resolution of queries.
+    A records are kept in a hash map keyed by domain, NS records in a suffix map keyed by the delegated suffix.
+    """
+    def __init__(self):
+        # domain -> A entry, for exact matches
+        self.a_records: Dict[str, DomainEntry] = {}
+        # suffix -> NS entry, for delegations
+        self.ns_records: Dict[str, DomainEntry] = {}
+        # How many NS suffixes exist of each length, so a lookup only slices the query at those lengths
+        self.ns_lengths: Dict[int, int] = {}
+        # The NS suffix lengths sorted from longest to shortest
+        self.ns_lengths_desc: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.a_records) + len(self.ns_records)
+
+    def __iter__(self) -> Iterator[DomainEntry]:
+        yield from self.a_records.values()
+        yield from self.ns_records.values()
+
+    def add(self, entry: DomainEntry):
+        """Add a new domain entry to the index.
+         The first entry added for a domain wins, unless it has already expired."""
+        if entry.type_code == DomainEntry.CODE_A:
+            existing = self.a_records.get(entry.domain)
+            if existing is None or existing.is_expired():
+                self.a_records[entry.domain] = entry
+        elif entry.type_code == DomainEntry.CODE_NS:
+            existing = self.ns_records.get(entry.domain)
+            if existing is None:
+                self.ns_records[entry.domain] = entry
+                self._add_ns_length(len(entry.domain))
+            elif existing.is_expired():
+                self.ns_records[entry.domain] = entry
+
+    def get(self, entry_type: str, domain: str) -> Optional[DomainEntry]:
+        """Return the entry stored for a type and domain, expired or not, or None."""
+        if entry_type == DomainEntry.TYPE_A:
+            return self.a_records.get(domain)
+        if entry_type == DomainEntry.TYPE_NS:
+            return self.ns_records.get(domain)
+        return None
+
+    def copy(self) -> "DomainList":
+        """Return a new DomainList with the same entries. The entries themselves are shared."""
+        other = DomainList()
+        other.a_records = self.a_records.copy()
+        other.ns_records = self.ns_records.copy()
+        other.ns_lengths = self.ns_lengths.copy()
+        other.ns_lengths_desc = list(self.ns_lengths_desc)
+        return other
+
+    def remove(self, entry: DomainEntry):
+        """Remove a domain entry from the index, if it is still the one stored for its domain."""
+        if entry.type_code == DomainEntry.CODE_A:
+            if self.a_records.get(entry.domain) is entry:
+                del self.a_records[entry.domain]
+        elif entry.type_code == DomainEntry.CODE_NS:
+            if self.ns_records.get(entry.domain) is entry:
+                del self.ns_records[entry.domain]
+                self._remove_ns_length(len(entry.domain))
+
+    def remove_expired(self):
+        """Remove expired domain entries from the index."""
+        now = time.time()
+        for entry in [entry for entry in self if entry.expire_time is not None and entry.expire_time <= now]:
+            self.remove(entry)
+
+    def lookup_a(self, query: str) -> Optional[DomainEntry]:
+        """Return the live A record for exactly this domain, or None."""
+        entry = self.a_records.get(query)
+        if entry is not None and entry.is_expired():
+            self.remove(entry)
+            return None
+        return entry
+
+    def lookup_ns(self, query: str) -> Optional[DomainEntry]:
+        """Return the live NS record with the longest suffix matching the query, or None."""
+        query_len = len(query)
+        for length in self.ns_lengths_desc:
+            if length > query_len:
+                continue
+            entry = self.ns_records.get(query[query_len - length:])
+            if entry is None:
+                continue
+            if entry.is_expired():
+                # Drop it and keep looking for a shorter delegation
+                self.remove(entry)
+                continue
+            return entry
+        return None
+
+    def lookup(self, query: str) -> Optional[DomainEntry]:
+        """Return the entry that answers a query: its A record, or else its longest matching NS record."""
+        entry = self.lookup_a(query)
+        if entry is None:
+            entry = self.lookup_ns(query)
+        return entry
+
+    def resolve(self, query: str) -> str:
+        """Resolve a domain query to its corresponding domain entry string.
+         First, it checks for an A record, then for the longest matching NS record.
+         Expired entries found along the way are removed."""
+        entry = self.lookup(query)
+        if entry is None:
+            return NO_DOMAIN_ENTRY_STR
+        return entry.__str__()
+
+    def _add_ns_length(self, length: int):
+        count = self.ns_lengths.get(length, 0)
+        self.ns_lengths[length] = count + 1
+        if count == 0:
+            self.ns_lengths_desc = sorted(self.ns_lengths, reverse=True)
+
+    def _remove_ns_length(self, length: int):
+        count = self.ns_lengths[length] - 1
+        if count:
+            self.ns_lengths[length] = count
+        else:
+            del self.ns_lengths[length]
+            self.ns_lengths_desc = sorted(self.ns_lengths, reverse=True)
+
+
+def answer_datagram(domain_list: DomainList, data) -> Optional[bytes]:
+    """
+    Answer a query datagram in the protocol it was sent in.
+    The datagram may be bytes or a memoryview into a receive buffer.
+    A text query is a single domain name. A binary query may hold many, and each gets an answer.
+    Returns None for a malformed binary query, which is dropped.
+    """
+    if not protocol.is_binary(data):
+        return domain_list.resolve(str(data, 'utf-8')).encode()
+    try:
+        version, txid, names = protocol.decode_query(data)
+    except protocol.ProtocolError:
+        return None
+    # Tell the client which version we speak, so it can send the query again in it
+    if version != protocol.VERSION:
+        return protocol.encode_response(txid, [], protocol.FLAG_BAD_VERSION)
+    answers = []
+    for name in names:
+        entry = domain_list.lookup(name)
+        answers.append(None if entry is None else (entry.domain, entry.ip, entry.entry_type))
+    return protocol.encode_response(txid, answers)
+
+
+def answer_datagram_measured(domain_list: DomainList, data, stats: Stats) -> Optional[bytes]:
+    """
+    Answer a query datagram like answer_datagram does, and count it and time its stages in the stats.
+    Only used when stats are on, so answer_datagram stays free of any measuring.
+    """
+    start = time.perf_counter()
+    binary = protocol.is_binary(data)
+    if binary:
+        stats.count("queries_binary")
+        try:
+            version, txid, names = protocol.decode_query(data)
+        except protocol.ProtocolError:
+            stats.count("malformed")
+            return None
+        if version != protocol.VERSION:
+            stats.count("bad_version")
+            return protocol.encode_response(txid, [], protocol.FLAG_BAD_VERSION)
+    else:
+        stats.count("queries_text")
+        names = [str(data, 'utf-8')]
+    decoded = time.perf_counter()
+
+    entries = [domain_list.lookup(name) for name in names]
+    looked_up = time.perf_counter()
+
+    if binary:
+        answer = protocol.encode_response(txid, [None if entry is None else (entry.domain, entry.ip, entry.entry_type)
+                                                 for entry in entries])
+    else:
+        answer = (NO_DOMAIN_ENTRY_STR if entries[0] is None else entries[0].__str__()).encode()
+    encoded = time.perf_counter()
+
+    for entry in entries:
+        stats.count("nxdomain" if entry is None else "answers_" + entry.entry_type)
+    stats.observe_time("decode", decoded - start)
+    stats.observe_time("lookup", looked_up - decoded)
+    stats.observe_time("encode", encoded - looked_up)
+    stats.observe_time("total", encoded - start)
+    return answer
+
+
+def parse_options(args: List[str]) -> Dict[str, str]:
+    """
+    Parse the optional "--name value" arguments that follow the positional ones.
+    A flag with no value after it is stored as an empty string.
+    """
+    options = {}
+    i = 0
+    while i < len(args):
+        if args[i].startswith("--"):
+            if i + 1 < len(args) and not args[i + 1].startswith("--"):
+                options[args[i]] = args[i + 1]
+                i += 2
+                continue
+            options[args[i]] = ""
+        i += 1
+    return options
+
+
+def parse_zone_line(line: str) -> Optional[DomainEntry]:
+    """Parse a line of a zone file into a DomainEntry, None if it is not a valid entry line."""
+    parts = line.split(',')
+    if len(parts) != 3:
+        return None
+    # parts[0] : domain name
+    # parts[1] : domain ip
+    # parts[2] : enty type
+    return DomainEntry(parts[0], parts[1], parts[2])
+
+
+def line_fingerprint(line: str) -> Optional[int]:
+    """
+    Return a 64-bit fingerprint of a zone line, None if it is not a valid entry line.
+    It is the hash of the line as str() of its DomainEntry would write it, so an entry has the fingerprint of its line.
+    """
+    parts = line.split(',')
+    if len(parts) != 3:
+        return None
+    return hash(f"{parts[0].strip()},{parts[1].strip()},{parts[2].strip()}")
+
+
+def entry_fingerprint(entry: DomainEntry) -> int:
+    """Return the fingerprint of the zone line of an entry."""
+    return hash(str(entry))
+
+
+def load_zone(domain_file_name: str) -> DomainList:
+    """Load the domain entries of a zone file into a DomainList."""
+    domain_list = DomainList()
+    with open(domain_file_name, 'r') as file:
+        for line in file:
+            entry = parse_zone_line(line)
+            if entry is not None:
+                domain_list.add(entry)
+    return domain_list
+
+
+class ZoneReloader:
+    """
+    Holds the zone the server answers from, and answers lookups from it.
+    The zone is reloaded in a background thread on SIGHUP, or when the zone file changes if it is watched,
+    and the new zone is swapped in with a single assignment, so queries keep being answered during the reload.
+    A zone text file is reloaded incrementally: only the lines that changed since the last load are parsed,
+    and applied to a copy of the current index. A snapshot is simply mapped again.
+    Only a 64-bit fingerprint of each loaded line is kept to find what changed, not the line itself.
+    """
+    def __init__(self, domain_file_name: str, watch_interval: float = 0.0, columnar: bool = False):
+        self.domain_file_name = domain_file_name
+        # Load zone text files into a ColumnarDomainList instead of a DomainList
+        self.columnar = columnar
+        # How often to check if the zone file changed, 0 only reloads on SIGHUP
+        self.watch_interval = watch_interval
+        self.reload_requested = threading.Event()
+        # The fingerprints of the lines of the loaded zone text file, None for a snapshot
+        self.fingerprints: Optional[array] = None
+        # (entry type, domain) of the entries that more than one line defines, where the line order matters
+        self.duplicate_keys: Set[Tuple[str, str]] = set()
+        self.file_stat = self.stat()
+        self.zone = self.load_full()
+
+    def __len__(self) -> int:
+        return len(self.zone)
+
+    def lookup(self, query: str) -> Optional[DomainEntry]:
+        return self.zone.lookup(query)
+
+    def resolve(self, query: str) -> str:
+        return self.zone.resolve(query)
+
+    def stat(self) -> Optional[Tuple[int, int, int]]:
+        """Return what identifies a version of the zone file: its modification time, size and inode."""
+        try:
+            st = os.stat(self.domain_file_name)
+        except OSError:
+            return None
+        return st.st_mtime_ns, st.st_size, st.st_ino
+
+    def load_full(self):
+        """Load the whole zone, and remember the fingerprints of its lines for the next incremental reload."""
+        # zone_snapshot imports this module, so it is only imported once both are loaded
+        from zone_snapshot import ZoneSnapshot, is_snapshot
+        if is_snapshot(self.domain_file_name):
+            self.fingerprints = None
+            return ZoneSnapshot(self.domain_file_name)
+
+        domain_list = self.new_domain_list()
+        duplicate_keys = set()
+        fingerprints = set()
+        with open(self.domain_file_name, 'r') as file:
+            for line in file:
+                entry = parse_zone_line(line)
+                if entry is None:
+                    continue
+                if domain_list.get(entry.entry_type, entry.domain) is not None:
+                    duplicate_keys.add((entry.entry_type, entry.domain))
+                domain_list.add(entry)
+                fingerprints.add(entry_fingerprint(entry))
+        self.fingerprints = array('q', fingerprints)
+        self.duplicate_keys = duplicate_keys
+        return domain_list
+
+    def new_domain_list(self) -> DomainList:
+        if self.columnar:
+            # columnar imports this module, so it is only imported once both are loaded
+            from columnar import ColumnarDomainList
+            return ColumnarDomainList()
+        return DomainList()
+
+    def load_incremental(self):
+        """
+        Apply the lines that were removed from and added to the zone file to a copy of the current zone.
+        The entries of the removed lines are found by their fingerprints.
+        Falls back to a full load when a changed line is for a domain that several lines define,
+        since then which line wins depends on the order of the lines.
+        """
+        from zone_snapshot import is_snapshot
+        if self.fingerprints is None or is_snapshot(self.domain_file_name):
+            return self.load_full()
+
+        # fingerprint -> line, of the lines of the new zone file
+        new_lines: Dict[int, str] = {}
+        with open(self.domain_file_name, 'r') as file:
+            for line in file:
+                fingerprint = line_fingerprint(line)
+                if fingerprint is not None:
+                    new_lines.setdefault(fingerprint, line)
+        old_fingerprints = set(self.fingerprints)
+        removed = old_fingerprints.difference(new_lines)
+        added = [line for fingerprint, line in new_lines.items() if fingerprint not in old_fingerprints]
+        if not removed and not added:
+            return self.zone
+
+        domain_list = self.zone.copy()
+        if removed:
+            stored = [entry for entry in domain_list if entry_fingerprint(entry) in removed]
+            # A removed line that no stored entry came from lost to another line of its domain
+            if len(stored) != len(removed):
+                return self.load_full()
+            for entry in stored:
+                if (entry.entry_type, entry.domain) in self.duplicate_keys:
+                    return self.load_full()
+                domain_list.remove(entry)
+        for line in added:
+            entry = parse_zone_line(line)
+            if domain_list.get(entry.entry_type, entry.domain) is not None:
+                return self.load_full()
+            domain_list.add(entry)
+        self.fingerprints = array('q', new_lines.keys())
+        return domain_list
+
+    def reload(self):
+        """Build the new zone and swap it in. If the zone file cannot be read, keep serving the current zone."""
+        try:
+            self.zone = self.load_incremental()
+        except Exception as e:
+            # print(f"Error reloading domain file: {e}")
+            pass
+
+    def watch(self):
+        """Reload the zone whenever it is requested, or the zone file changed since the last check."""
+        timeout = self.watch_interval if self.watch_interval > 0 else None
+        while True:
+            self.reload_requested.wait(timeout)
+            requested = self.reload_requested.is_set()
+            self.reload_requested.clear()
+            stat = self.stat()
+            if requested or stat != self.file_stat:
+                self.file_stat = stat
+                self.reload()
+
+    def start(self):
+        """Reload on SIGHUP, and start the background thread that reloads the zone."""
+        signal.signal(signal.SIGHUP, lambda signum, frame: self.reload_requested.set())
+        threading.Thread(target=self.watch, daemon=True).start()
+
+
+def create_socket(port: int, reuse_port: bool = False) -> socket.socket:
+    """Create a UDP socket bound to the specified port.
+     With reuse_port, several sockets can bind the same port and the kernel spreads the datagrams between them."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    if reuse_port:
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    s.bind(('', port))
+    return s
+
+
+def serve(s: socket.socket, domain_list: DomainList, stats: Optional[Stats] = None):
+    """Answer the queries that arrive on the socket forever."""
+    while True:
+        # Get a query from a client
+        data, addr = s.recvfrom(protocol.MAX_DATAGRAM_SIZE)
+        # Try to resolve the query and send back the answer
+        if stats is None:
+            answer = answer_datagram(domain_list, data)
+        else:
+            answer = answer_datagram_measured(domain_list, data, stats)
+        if answer is not None:
+            try:
+                s.sendto(answer, addr)
+            except OSError:
+                # The answer cannot be sent, drop it like a lost datagram
+                pass
+
+
+def serve_batched(s: socket.socket, domain_list: DomainList, batch_size: int, stats: Optional[Stats] = None):
+    """Answer the queries that arrive on the socket forever, all the ready ones at a time."""
+    batched = BatchedDatagramSocket(s, batch_size)
+    while True:
+        batch = batched.receive_batch()
+        if not batch:
+            # Only wait when the socket is drained, so a busy server makes no extra syscall per batch
+            batched.wait_readable()
+            continue
+        if stats is not None:
+            stats.observe_value("batch_size", len(batch))
+        for data, addr in batch:
+            if stats is None:
+                answer = answer_datagram(domain_list, data)
+            else:
+                answer = answer_datagram_measured(domain_list, data, stats)
+            if answer is not None:
+                batched.queue(answer, addr)
+        batched.flush()
+
+
+def serve_socket(s: socket.socket, domain_list: DomainList, batch_size: int, stats: Optional[Stats] = None):
+    """Answer queries on the socket one datagram at a time, or in batches if batch_size is set."""
+    if batch_size > 0:
+        serve_batched(s, domain_list, batch_size, stats)
+    else:
+        serve(s, domain_list, stats)
+
+
+def start_stats(domain_list: DomainList, stats_port: Optional[int], stats_file: Optional[str],
+                stats_interval: float, worker: Optional[int] = None) -> Optional[Stats]:
+    """
+    Return the stats of this process, served on the stats port and dumped to the stats file,
+    or None if neither is set. A worker gets its own stats, on the port plus its number and in the file dot its number.
+    """
+    if stats_port is None and stats_file is None:
+        return None
+    if worker is not None:
+        stats_port = None if stats_port is None else stats_port + worker
+        stats_file = None if stats_file is None else f"{stats_file}.{worker}"
+    stats = Stats()
+    stats.gauge("zone_records", lambda: len(domain_list))
+    start_stats_threads(stats, stats_port, stats_file, stats_interval)
+    return stats
+
+
+def serve_workers(port: int, domain_list: DomainList, workers: int, batch_size: int = 0,
+                  stats_port: Optional[int] = None, stats_file: Optional[str] = None,
+                  stats_interval: float = DEFAULT_STATS_INTERVAL):
+    """
+    Fork worker processes that each bind the port with SO_REUSEPORT and answer queries.
+    The zone is loaded before the fork, so the workers start out sharing its pages copy-on-write.
+    The objects are moved out of the garbage collector's reach first, so its passes in the workers don't write to
+    every one of them. The reference counts a lookup changes still copy the pages it touches over time,
+    while a zone snapshot given instead of the zone file is memory-mapped and stays shared.
+    If the zone is a ZoneReloader, each worker runs its own reloader, and the parent passes SIGHUP on to them.
+    The parent waits for the workers, and stops them when it is stopped.
+    """
+    # Collect the garbage of the load once, and freeze what is left, so the workers never collect it
+    gc.collect()
+    gc.freeze()
+    children = []
+    for worker in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # Worker: the parent decides when to stop, so ignore the ctrl C it also gets
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            if isinstance(domain_list, ZoneReloader):
+                domain_list.start()
+            try:
+                stats = start_stats(domain_list, stats_port, stats_file, stats_interval, worker)
+                serve_socket(create_socket(port, reuse_port=True), domain_list, batch_size, stats)
+            finally:
+                os._exit(0)
+        children.append(pid)
+
+    def stop(signum, frame):
+        raise KeyboardInterrupt
+
+    def forward(signum, frame):
+        for pid in children:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGHUP, forward)
+    try:
+        for _ in children:
+            os.wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+
+def main():
+    # Check command line arguments
+    if len(argv) < 3:
+        # print("Usage: python server.py <myPort> <zoneFileName|zoneSnapshot> [--workers N] [--batch N] [--watch SEC] [--columnar] "
+        #       "[--stats-port PORT] [--stats-file PATH] [--stats-interval SEC]")
+        sys.exit()
+
+    # Parse command line arguments
+    port = int(argv[1])
+    domain_file_name = argv[2]
+    options = parse_options(argv[3:])
+    workers = int(options.get("--workers", 1))
+    # How many datagrams to receive at a time, 0 receives them one by one
+    batch_size = int(options.get("--batch", 0))
+    # How often to check the zone file for changes, 0 only reloads it on SIGHUP
+    watch_interval = float(options.get("--watch", 0))
+    columnar = "--columnar" in options
+    # Where to expose the stats, they are off unless one is set
+    stats_port = int(options["--stats-port"]) if "--stats-port" in options else None
+    stats_file = options.get("--stats-file")
+    stats_interval = float(options.get("--stats-interval", DEFAULT_STATS_INTERVAL))
+
+    # Validate port number
+    if port < 0 or port > 65535:
+        # print("Port number must be in range 0-65535")
+        sys.exit()
+
+    try:
+        # Load domain entries from the specified file, or map the snapshot compiled from it
+        domain_list = ZoneReloader(domain_file_name, watch_interval, columnar)
+    except Exception as e:
+        # print(f"Error reading domain file: {e}")
+        sys.exit()
+
+    if workers > 1:
+        serve_workers(port, domain_list, workers, batch_size, stats_port, stats_file, stats_interval)
+        return
+
+    # Create UDP socket and bind to the specified port
+    s = create_socket(port)
+    domain_list.start()
+    stats = start_stats(domain_list, stats_port, stats_file, stats_interval)
+    try:
+        serve_socket(s, domain_list, batch_size, stats)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
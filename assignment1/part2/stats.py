@@ -0,0 +1,185 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+# Default time between dumps of the stats to the stats file
+DEFAULT_STATS_INTERVAL = 10.0
+# A time histogram has a bucket for each power of two microseconds, the last one also counts anything slower
+HISTOGRAM_BUCKETS = 25
+
+
+class Histogram:
+    """
+    Counts durations in power of two microsecond buckets: bucket i counts the ones under 2 ** i microseconds.
+    Observing a duration is a few integer operations, and the percentiles are estimated from the buckets.
+    """
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = [0] * HISTOGRAM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction: float) -> float:
+        """Return the upper bound of the bucket the percentile falls in, in milliseconds."""
+        rank = fraction * self.count
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(2 ** i / 1000, self.max * 1000)
+        return self.max * 1000
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "mean_ms": round(self.total / self.count * 1000, 3) if self.count else 0.0,
+            "p50_ms": round(self.percentile(0.5), 3),
+            "p99_ms": round(self.percentile(0.99), 3),
+            "max_ms": round(self.max * 1000, 3),
+            # upper bound in microseconds -> count, for the buckets that have any
+            "buckets_us": {2 ** i: count for i, count in enumerate(self.buckets) if count},
+        }
+
+
+class Stats:
+    """
+    The counters, time histograms and value distributions of a server or a resolver.
+    Gauges are functions that are only called when a snapshot is taken, for values the code already keeps,
+    like the size of the cache, so they cost nothing per query.
+    When stats are off the code holds None instead of a Stats, and skips the measuring entirely.
+    """
+    def __init__(self):
+        self.started = time.time()
+        self.counters: Dict[str, int] = {}
+        self.histograms: Dict[str, Histogram] = {}
+        # name -> value -> how many times it was seen, for small integer values like the NS hops of a query
+        self.distributions: Dict[str, Dict[int, int]] = {}
+        self.gauges: Dict[str, Callable[[], object]] = {}
+
+    def count(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    def observe_time(self, name: str, seconds: float):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_value(self, name: str, value: int):
+        distribution = self.distributions.get(name)
+        if distribution is None:
+            distribution = self.distributions[name] = {}
+        distribution[value] = distribution.get(value, 0) + 1
+
+    def gauge(self, name: str, function: Callable[[], object]):
+        self.gauges[name] = function
+
+    def reset(self):
+        """Zero the counters, histograms and distributions. The gauges are kept."""
+        self.started = time.time()
+        self.counters = {}
+        self.histograms = {}
+        self.distributions = {}
+
+    def snapshot(self) -> Dict:
+        # Copy before iterating, the stats may be updated by another thread meanwhile
+        return {
+            "pid": os.getpid(),
+            "uptime": round(time.time() - self.started, 3),
+            "counters": dict(self.counters),
+            "histograms": {name: histogram.to_dict() for name, histogram in list(self.histograms.items())},
+            "distributions": {name: dict(sorted(distribution.items()))
+                              for name, distribution in list(self.distributions.items())},
+            "gauges": {name: function() for name, function in list(self.gauges.items())},
+        }
+
+    def to_json(self) -> bytes:
+        return json.dumps(self.snapshot(), indent=2).encode()
+
+    def answer_request(self, request: bytes) -> bytes:
+        """Answer a datagram sent to the stats port: "reset" zeroes the stats, anything else gets a snapshot."""
+        if request.strip() == b"reset":
+            self.reset()
+        return self.to_json()
+
+    def dump(self, path: str):
+        """Write a snapshot to the stats file, through a temporary file so a reader never sees half of one."""
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(self.to_json())
+        os.replace(temp_path, path)
+
+
+def create_stats_socket(port: int) -> socket.socket:
+    """Create the UDP socket of the stats port. It only listens on the loopback interface."""
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    s.bind(('127.0.0.1', port))
+    return s
+
+
+def start_stats_threads(stats: Stats, port: Optional[int], path: Optional[str],
+                        interval: float = DEFAULT_STATS_INTERVAL) -> List[threading.Thread]:
+    """
+    Serve the stats on a UDP port and dump them to a file periodically, in daemon threads,
+    for a server whose main loop blocks.
+    """
+    threads = []
+    if port is not None:
+        s = create_stats_socket(port)
+
+        def serve_stats():
+            while True:
+                request, addr = s.recvfrom(1024)
+                s.sendto(stats.answer_request(request), addr)
+
+        threads.append(threading.Thread(target=serve_stats, daemon=True))
+    if path is not None:
+
+        def dump_stats():
+            while True:
+                time.sleep(interval)
+                try:
+                    stats.dump(path)
+                except OSError:
+                    pass
+
+        threads.append(threading.Thread(target=dump_stats, daemon=True))
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+class StatsProtocol(asyncio.DatagramProtocol):
+    """The protocol of the stats port of an asyncio server: each datagram is answered with a snapshot."""
+    def __init__(self, stats: Stats):
+        self.stats = stats
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data: bytes, addr):
+        self.transport.sendto(self.stats.answer_request(data), addr)
+
+
+async def dump_stats_periodically(stats: Stats, path: str, interval: float = DEFAULT_STATS_INTERVAL):
+    """Dump the stats to a file every interval seconds, for an asyncio server."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            stats.dump(path)
+        except OSError:
+            pass
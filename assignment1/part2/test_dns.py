@@ -4,11 +4,22 @@ Comprehensive DNS Resolver Test Script
 Tests all scenarios: direct A records, NS delegation, caching, and non-existent domains
 """
 
+import json
+import os
+import shutil
+import signal
 import socket
 import subprocess
+import tempfile
+import threading
 import time
 import sys
-from typing import Optional
+import zlib
+from typing import Callable, Dict, List, Optional, Tuple
+
+import protocol
+from upstream import REPROBE_INTERVAL, UpstreamPool
+from zone_snapshot import table_size
 
 # Configuration
 RESOLVER_PORT = 5555
@@ -16,6 +27,12 @@ PARENT_SERVER_PORT = 12345
 CHILD_SERVER_PORT = 22222
 GRANDCHILD_SERVER_PORT = 33333
 CACHE_TIMEOUT = 20
+# The server and resolver a test starts for itself, on zones it writes
+EXTRA_SERVER_PORT = 44444
+EXTRA_RESOLVER_PORT = 45555
+EXTRA_STATS_PORT = 45556
+# A port nothing listens on, for a dead upstream server
+DEAD_SERVER_PORT = 44445
 
 class DNSClient:
     """Simple DNS client for testing"""
@@ -37,6 +54,18 @@ class DNSClient:
         except Exception as e:
             # print(f"Error querying {domain}: {e}")
             return None
+
+    def query_binary(self, domains: List[str], txid: int = 1) -> Optional[List[str]]:
+        """Send the domains in one binary protocol query and return the answers"""
+        try:
+            self.sock.sendto(protocol.encode_query(txid, domains), (self.server_ip, self.server_port))
+            data, _ = self.sock.recvfrom(protocol.MAX_DATAGRAM_SIZE)
+            _, _, answer_txid, records = protocol.decode_response(data)
+            if answer_txid != txid:
+                return None
+            return ["non-existent domain" if record is None else ",".join(record) for record in records]
+        except (socket.timeout, protocol.ProtocolError):
+            return None
     
     def close(self):
         self.sock.close()
@@ -50,14 +79,81 @@ def start_server(port: int, zone_file: str) -> subprocess.Popen:
     return proc
 
 
-def start_resolver(port: int, parent_ip: str, parent_port: int, cache_timeout: int) -> subprocess.Popen:
-    """Start a DNS resolver process"""
-    cmd = ['python3', 'resolver.py', str(port), parent_ip, str(parent_port), str(cache_timeout)]
+def start_resolver(port: int, parent_ip: str, parent_port: int, cache_timeout: int,
+                   options: List[str] = ()) -> subprocess.Popen:
+    """Start a DNS resolver process, with extra command line options if given"""
+    cmd = ['python3', 'resolver.py', str(port), parent_ip, str(parent_port), str(cache_timeout)] + list(options)
     proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
     time.sleep(0.5)  # Give resolver time to start
     return proc
 
 
+def write_zone(directory: str, name: str, lines: List[str]) -> str:
+    """Write a zone file for a test, return its path"""
+    path = os.path.join(directory, name)
+    with open(path, 'w') as file:
+        file.write("\n".join(lines) + "\n")
+    return path
+
+
+def query_stats(port: int) -> Optional[dict]:
+    """Get a snapshot of the stats of a server or resolver started with --stats-port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.settimeout(3.0)
+    try:
+        sock.sendto(b"stats", ('127.0.0.1', port))
+        data, _ = sock.recvfrom(protocol.MAX_DATAGRAM_SIZE)
+        return json.loads(data)
+    except (socket.timeout, ValueError):
+        return None
+    finally:
+        sock.close()
+
+
+def start_delayed_server(port: int, answers: Dict[str, Tuple[str, float]]) -> Callable[[], None]:
+    """
+    Answer each text query with its answer after its delay, in threads, so the answers arrive out of order.
+    Call the returned function to stop it and free the port
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', port))
+    # Closing the socket does not wake a thread blocked in recvfrom, which would keep the port bound,
+    # so the server checks if it was stopped between short waits
+    sock.settimeout(0.05)
+    stopped = threading.Event()
+
+    def answer(name: str, addr):
+        ip, delay = answers.get(name, ("", 0.0))
+        time.sleep(delay)
+        try:
+            sock.sendto(f"{name},{ip},A".encode() if ip else b"non-existent domain", addr)
+        except OSError:
+            pass
+
+    def serve():
+        while not stopped.is_set():
+            try:
+                data, addr = sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+            threading.Thread(target=answer, args=(data.decode(), addr), daemon=True).start()
+
+    server_thread = threading.Thread(target=serve, daemon=True)
+    server_thread.start()
+
+    def stop():
+        stopped.set()
+        server_thread.join()
+        sock.close()
+
+    return stop
+
+
+def stop_process(proc: subprocess.Popen):
+    proc.terminate()
+    proc.wait()
+
+
 def extract_ip(response: Optional[str]) -> str:
     """Extract IP from DNS response"""
     if response is None:
@@ -99,6 +195,8 @@ def run_tests():
     
     # Create test client
     client = DNSClient('127.0.0.1', RESOLVER_PORT)
+    # The zone files the tests write
+    zone_dir = tempfile.mkdtemp()
     
     # Test counters
     total_tests = 0
@@ -244,6 +342,311 @@ def run_tests():
     else:
         print(f"   ✗ FAIL: Expected 1.2.3.14, got {ip} (response: {response})")
     
+    # Test 13: Several domains in one binary protocol query
+    print("\n[Test 13] Binary batch lookup (biu.ac.il, mail.google.co.il, db.internal.co.il, notfound.com)")
+    total_tests += 1
+    responses = client.query_binary(['biu.ac.il', 'mail.google.co.il', 'db.internal.co.il', 'notfound.com'])
+    ips = [extract_ip(response) for response in responses] if responses else None
+    expected = ['1.2.3.4', '1.2.3.9', '1.2.3.14', 'non-existent domain']
+    if ips == expected:
+        print(f"   ✓ PASS: Got correct answers {ips}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected {expected}, got {ips} (responses: {responses})")
+    
+    # Test 14: A binary query whose answers don't fit in a datagram gets a truncated answer from the server
+    print("\n[Test 14] Oversized binary query (5000 x biu.ac.il) to the parent server")
+    total_tests += 1
+    server_client = DNSClient('127.0.0.1', PARENT_SERVER_PORT)
+    responses = server_client.query_binary(['biu.ac.il'] * 5000)
+    ips = {extract_ip(response) for response in responses} if responses else None
+    # The server must still be up and answering
+    after = extract_ip(server_client.query('biu.ac.il'))
+    server_client.close()
+    if responses and len(responses) < 5000 and ips == {'1.2.3.4'} and after == '1.2.3.4':
+        print(f"   ✓ PASS: Got the first {len(responses)} answers, and the server still answers")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected a truncated answer, got {len(responses) if responses else responses} answers "
+              f"and {after} after it")
+    
+    # Test 15: The NS entry with the longest matching suffix wins, wherever it is in the zone file
+    print("\n[Test 15] Longest-suffix NS lookup (www.google.co.il, .co.il listed before .google.co.il)")
+    total_tests += 1
+    zone_path = write_zone(zone_dir, 'ns_zone.txt', ['.co.il,127.0.0.1:1111,NS', '.google.co.il,127.0.0.1:2222,NS'])
+    extra_server = start_server(EXTRA_SERVER_PORT, zone_path)
+    server_client = DNSClient('127.0.0.1', EXTRA_SERVER_PORT)
+    response = server_client.query('www.google.co.il')
+    server_client.close()
+    stop_process(extra_server)
+    ip = extract_ip(response)
+    if ip == '127.0.0.1:2222':
+        print(f"   ✓ PASS: Got the .google.co.il nameserver {ip}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected 127.0.0.1:2222, got {ip} (response: {response})")
+    
+    # Test 16: A bounded cache evicts the least recently used entry
+    print("\n[Test 16] LRU eviction with --max-cache-size 2")
+    total_tests += 1
+    zone_path = write_zone(zone_dir, 'lru_zone.txt', ['a.lru.com,5.5.5.1,A', 'b.lru.com,5.5.5.2,A', 'c.lru.com,5.5.5.3,A'])
+    extra_server = start_server(EXTRA_SERVER_PORT, zone_path)
+    extra_resolver = start_resolver(EXTRA_RESOLVER_PORT, '127.0.0.1', EXTRA_SERVER_PORT, CACHE_TIMEOUT,
+                                    ['--max-cache-size', '2', '--timeout', '0.3', '--retries', '0'])
+    resolver_client = DNSClient('127.0.0.1', EXTRA_RESOLVER_PORT)
+    # a is used again after b, so c evicts b
+    for name in ['a.lru.com', 'b.lru.com', 'a.lru.com', 'c.lru.com']:
+        resolver_client.query(name)
+    # Only cached answers can come back once the server is gone
+    stop_process(extra_server)
+    ips = [extract_ip(resolver_client.query(name)) for name in ['a.lru.com', 'b.lru.com', 'c.lru.com']]
+    resolver_client.close()
+    stop_process(extra_resolver)
+    expected = ['5.5.5.1', 'non-existent domain', '5.5.5.3']
+    if ips == expected:
+        print(f"   ✓ PASS: b.lru.com was evicted, a.lru.com and c.lru.com are cached {ips}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected {expected}, got {ips}")
+    
+    # Test 17: SIGHUP reloads an edited zone without a restart
+    print("\n[Test 17] Zone reload on SIGHUP (reload.com 6.6.6.1 -> 6.6.6.2, new.reload.com added)")
+    total_tests += 1
+    zone_path = write_zone(zone_dir, 'reload_zone.txt', ['reload.com,6.6.6.1,A'])
+    extra_server = start_server(EXTRA_SERVER_PORT, zone_path)
+    server_client = DNSClient('127.0.0.1', EXTRA_SERVER_PORT)
+    before = extract_ip(server_client.query('reload.com'))
+    write_zone(zone_dir, 'reload_zone.txt', ['reload.com,6.6.6.2,A', 'new.reload.com,6.6.6.3,A'])
+    extra_server.send_signal(signal.SIGHUP)
+    time.sleep(0.5)
+    after = [extract_ip(server_client.query(name)) for name in ['reload.com', 'new.reload.com']]
+    server_client.close()
+    stop_process(extra_server)
+    if before == '6.6.6.1' and after == ['6.6.6.2', '6.6.6.3']:
+        print(f"   ✓ PASS: Got {before} before the reload and {after} after it")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected 6.6.6.1 then ['6.6.6.2', '6.6.6.3'], got {before} then {after}")
+    
+    # Test 18: A cached non-existent domain answer is served without asking upstream again
+    print("\n[Test 18] Negative caching with --negative-ttl (nx.neg.com twice)")
+    total_tests += 1
+    zone_path = write_zone(zone_dir, 'neg_zone.txt', ['neg.com,7.7.7.1,A'])
+    extra_server = start_server(EXTRA_SERVER_PORT, zone_path)
+    extra_resolver = start_resolver(EXTRA_RESOLVER_PORT, '127.0.0.1', EXTRA_SERVER_PORT, CACHE_TIMEOUT,
+                                    ['--negative-ttl', '30', '--stats-port', str(EXTRA_STATS_PORT)])
+    resolver_client = DNSClient('127.0.0.1', EXTRA_RESOLVER_PORT)
+    responses = [resolver_client.query('nx.neg.com') for _ in range(2)]
+    stats = query_stats(EXTRA_STATS_PORT)
+    resolver_client.close()
+    stop_process(extra_resolver)
+    stop_process(extra_server)
+    counters = stats["counters"] if stats else {}
+    if (responses == ["non-existent domain"] * 2 and counters.get("upstream_queries") == 1
+            and counters.get("cache_negative_hits") == 1):
+        print(f"   ✓ PASS: Both answers are non-existent, with a single upstream query")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected 2 non-existent answers and 1 upstream query, got {responses} "
+              f"and {counters.get('upstream_queries')} upstream queries")
+    
+    # Test 19: An expired answer is still served within the serve-stale window when the server is gone
+    print("\n[Test 19] Serve-stale with --serve-stale 30 (stale.com after its 1s TTL, server stopped)")
+    total_tests += 1
+    zone_path = write_zone(zone_dir, 'stale_zone.txt', ['stale.com,8.8.8.1,A'])
+    extra_server = start_server(EXTRA_SERVER_PORT, zone_path)
+    extra_resolver = start_resolver(EXTRA_RESOLVER_PORT, '127.0.0.1', EXTRA_SERVER_PORT, 1,
+                                    ['--serve-stale', '30', '--timeout', '0.3', '--retries', '0'])
+    resolver_client = DNSClient('127.0.0.1', EXTRA_RESOLVER_PORT)
+    before = extract_ip(resolver_client.query('stale.com'))
+    stop_process(extra_server)
+    time.sleep(1.5)
+    after = extract_ip(resolver_client.query('stale.com'))
+    resolver_client.close()
+    stop_process(extra_resolver)
+    if before == '8.8.8.1' and after == '8.8.8.1':
+        print(f"   ✓ PASS: Got the expired answer {after}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected 8.8.8.1 before and after expiry, got {before} then {after}")
+
+    # Test 20: Batch mode prints the answers in the input order, whatever order they arrive in
+    print("\n[Test 20] Client --batch order (the first name is answered last)")
+    total_tests += 1
+    stop_delayed = start_delayed_server(EXTRA_SERVER_PORT, {'slow.com': ('9.9.9.1', 0.5), 'fast1.com': ('9.9.9.2', 0.0),
+                                                       'fast2.com': ('9.9.9.3', 0.1)})
+    names_path = write_zone(zone_dir, 'names.txt', ['slow.com', 'fast1.com', 'nx.com', 'fast2.com'])
+    result = subprocess.run(['python3', 'client.py', '127.0.0.1', str(EXTRA_SERVER_PORT), '--batch', names_path,
+                             '--window', '4'], capture_output=True, text=True, timeout=30)
+    stop_delayed()
+    lines = result.stdout.splitlines()
+    expected = ['9.9.9.1', '9.9.9.2', 'non-existent domain', '9.9.9.3']
+    if lines == expected:
+        print(f"   ✓ PASS: Got the answers in the input order {lines}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected {expected}, got {lines}")
+    
+    # Test 21: A stale answer is dropped once its refresh finds the domain no longer exists
+    print("\n[Test 21] Serve-stale drops a removed domain (gone.com removed from the zone after its 1s TTL)")
+    total_tests += 1
+    zone_path = write_zone(zone_dir, 'gone_zone.txt', ['gone.com,8.8.8.2,A'])
+    extra_server = start_server(EXTRA_SERVER_PORT, zone_path)
+    extra_resolver = start_resolver(EXTRA_RESOLVER_PORT, '127.0.0.1', EXTRA_SERVER_PORT, 1,
+                                    ['--serve-stale', '30', '--timeout', '0.3', '--retries', '0'])
+    resolver_client = DNSClient('127.0.0.1', EXTRA_RESOLVER_PORT)
+    before = extract_ip(resolver_client.query('gone.com'))
+    write_zone(zone_dir, 'gone_zone.txt', ['other.com,8.8.8.3,A'])
+    extra_server.send_signal(signal.SIGHUP)
+    time.sleep(1.5)
+    # The first query after the TTL gets the stale answer and starts its refresh
+    stale = extract_ip(resolver_client.query('gone.com'))
+    time.sleep(0.5)
+    after = [resolver_client.query('gone.com') for _ in range(2)]
+    resolver_client.close()
+    stop_process(extra_resolver)
+    stop_process(extra_server)
+    if before == '8.8.8.2' and stale == '8.8.8.2' and after == ['non-existent domain'] * 2:
+        print(f"   ✓ PASS: Got the stale answer {stale} once, then {after}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected 8.8.8.2, 8.8.8.2, then non-existent domain twice, got {before}, {stale}, {after}")
+
+    # Test 22: The upstream pool ranks and probes servers, and a timeout does not rank a fast server last for good
+    print("\n[Test 22] UpstreamPool order and start_probe (fast server loses a packet, then answers again)")
+    total_tests += 1
+    pool = UpstreamPool(1.0)
+    fast, slow, new = ('127.0.0.1', 1), ('127.0.0.1', 2), ('127.0.0.1', 3)
+    pool.record_answer(fast, 0.001)
+    pool.record_answer(slow, 0.010)
+    steps = [pool.order([slow, new, fast]), pool.start_probe(pool.order([slow, new, fast]))]
+    pool.end_probe(new)
+    pool.record_timeout(fast, 0.05)
+    order = pool.order([slow, fast])
+    # Just sampled, so not probed yet
+    steps += [order, pool.start_probe(order)]
+    pool.servers[fast].sampled_at -= REPROBE_INTERVAL
+    steps.append(pool.start_probe(order))
+    pool.end_probe(fast)
+    pool.record_answer(fast, 0.001)
+    steps.append(pool.order([slow, fast]))
+    expected = [[fast, slow, new], new, [slow, fast], None, fast, [fast, slow]]
+    if steps == expected:
+        print(f"   ✓ PASS: Got {steps}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected {expected}, got {steps}")
+
+    # Test 23: With the first upstream dead, the resolver fails over and then goes to the live one first
+    print("\n[Test 23] Failover from a dead first upstream (parent port is dead, --upstreams is live)")
+    total_tests += 1
+    zone_path = write_zone(zone_dir, 'failover_zone.txt', ['failover1.com,7.7.7.1,A', 'failover2.com,7.7.7.2,A'])
+    extra_server = start_server(EXTRA_SERVER_PORT, zone_path)
+    extra_resolver = start_resolver(EXTRA_RESOLVER_PORT, '127.0.0.1', DEAD_SERVER_PORT, CACHE_TIMEOUT,
+                                    ['--upstreams', f'127.0.0.1:{EXTRA_SERVER_PORT}', '--timeout', '0.5',
+                                     '--retries', '0'])
+    resolver_client = DNSClient('127.0.0.1', EXTRA_RESOLVER_PORT)
+    first = extract_ip(resolver_client.query('failover1.com'))
+    start = time.time()
+    second = extract_ip(resolver_client.query('failover2.com'))
+    elapsed = time.time() - start
+    resolver_client.close()
+    stop_process(extra_resolver)
+    stop_process(extra_server)
+    if first == '7.7.7.1' and second == '7.7.7.2' and elapsed < 0.25:
+        print(f"   ✓ PASS: Got {first} after failing over, then {second} in {elapsed * 1000:.0f}ms")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected 7.7.7.1 then 7.7.7.2 in under 250ms, got {first} then {second} "
+              f"in {elapsed * 1000:.0f}ms")
+
+    # Test 24: A compiled zone snapshot answers like the zone file, also for names that collide in its hash tables
+    print("\n[Test 24] Zone snapshot from compile_zone.py (colliding A and NS names, longest suffix, NXDOMAIN)")
+    total_tests += 1
+    # host1 and host4 fall in the same slot of the 4 slot A table, and host9, which is not in the zone, too.
+    # .sub.snap.com and .y.snap.com fall in the same slot of the 8 slot NS table
+    zone_path = write_zone(zone_dir, 'snapshot_zone.txt', [
+        'host1.snap.com,5.5.5.1,A', 'host4.snap.com,5.5.5.4,A',
+        '.sub.snap.com,127.0.0.1:1111,NS', '.y.snap.com,127.0.0.1:2222,NS', '.deep.sub.snap.com,127.0.0.1:3333,NS'])
+    a_slots = {zlib.crc32(name.encode()) & (table_size(2) - 1)
+               for name in ['host1.snap.com', 'host4.snap.com', 'host9.snap.com']}
+    ns_slots = {zlib.crc32(name.encode()) & (table_size(3) - 1) for name in ['.sub.snap.com', '.y.snap.com']}
+    snapshot_path = os.path.join(zone_dir, 'snapshot.zone')
+    subprocess.run(['python3', 'compile_zone.py', zone_path, snapshot_path], capture_output=True, timeout=30)
+    extra_server = start_server(EXTRA_SERVER_PORT, snapshot_path)
+    server_client = DNSClient('127.0.0.1', EXTRA_SERVER_PORT)
+    queries = ['host1.snap.com', 'host4.snap.com', 'host9.snap.com', 'a.sub.snap.com', 'a.y.snap.com',
+               'a.deep.sub.snap.com']
+    answers = [server_client.query(name) for name in queries]
+    server_client.close()
+    stop_process(extra_server)
+    expected = ['host1.snap.com,5.5.5.1,A', 'host4.snap.com,5.5.5.4,A', 'non-existent domain',
+                '.sub.snap.com,127.0.0.1:1111,NS', '.y.snap.com,127.0.0.1:2222,NS',
+                '.deep.sub.snap.com,127.0.0.1:3333,NS']
+    if len(a_slots) == 1 and len(ns_slots) == 1 and answers == expected:
+        print(f"   ✓ PASS: Got {answers}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected colliding names and {expected}, got slots {a_slots} {ns_slots} and {answers}")
+
+    # Test 25: The cache is saved on SIGTERM and loaded on restart, without the entries that expired meanwhile
+    print("\n[Test 25] Cache persistence with --cache-file (short.com with a 2s TTL, long.com with 30s, server stopped)")
+    total_tests += 1
+    zone_path = write_zone(zone_dir, 'persist_zone.txt', ['short.com,9.1.1.1,A', 'long.com,9.1.1.2,A'])
+    cache_path = os.path.join(zone_dir, 'resolver.cache')
+    options = ['--cache-file', cache_path, '--timeout', '0.3', '--retries', '0']
+    extra_server = start_server(EXTRA_SERVER_PORT, zone_path)
+    # Each resolver saves its cache on SIGTERM, and the next one starts from it
+    answers = []
+    for name, ttl in [('short.com', 2), ('long.com', 30)]:
+        extra_resolver = start_resolver(EXTRA_RESOLVER_PORT, '127.0.0.1', EXTRA_SERVER_PORT, ttl, options)
+        resolver_client = DNSClient('127.0.0.1', EXTRA_RESOLVER_PORT)
+        answers.append(extract_ip(resolver_client.query(name)))
+        resolver_client.close()
+        stop_process(extra_resolver)
+    stop_process(extra_server)
+    time.sleep(2)
+    extra_resolver = start_resolver(EXTRA_RESOLVER_PORT, '127.0.0.1', EXTRA_SERVER_PORT, 30, options)
+    resolver_client = DNSClient('127.0.0.1', EXTRA_RESOLVER_PORT)
+    answers += [extract_ip(resolver_client.query(name)) for name in ['long.com', 'short.com']]
+    resolver_client.close()
+    stop_process(extra_resolver)
+    expected = ['9.1.1.1', '9.1.1.2', '9.1.1.2', 'non-existent domain']
+    if answers == expected:
+        print(f"   ✓ PASS: Got {answers}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected {expected}, got {answers}")
+
+    # Test 26: Concurrent queries for the same name share one upstream query
+    print("\n[Test 26] Coalescing of in-flight queries (5 clients ask for slow.com, answered after 0.5s)")
+    total_tests += 1
+    stop_delayed = start_delayed_server(EXTRA_SERVER_PORT, {'slow.com': ('9.2.2.1', 0.5)})
+    extra_resolver = start_resolver(EXTRA_RESOLVER_PORT, '127.0.0.1', EXTRA_SERVER_PORT, CACHE_TIMEOUT,
+                                    ['--timeout', '2', '--retries', '0', '--stats-port', str(EXTRA_STATS_PORT)])
+    resolver_clients = [DNSClient('127.0.0.1', EXTRA_RESOLVER_PORT) for _ in range(5)]
+    # Send all the queries before reading any answer, so they are in flight together
+    for resolver_client in resolver_clients:
+        resolver_client.sock.sendto(b'slow.com', ('127.0.0.1', EXTRA_RESOLVER_PORT))
+    ips = []
+    for resolver_client in resolver_clients:
+        try:
+            ips.append(extract_ip(resolver_client.sock.recvfrom(1024)[0].decode()))
+        except socket.timeout:
+            ips.append("no response")
+        resolver_client.close()
+    stats = query_stats(EXTRA_STATS_PORT)
+    stop_process(extra_resolver)
+    stop_delayed()
+    counters = stats["counters"] if stats else {}
+    if ips == ['9.2.2.1'] * 5 and counters.get("upstream_queries") == 1 and counters.get("upstream_coalesced", 0) > 0:
+        print(f"   ✓ PASS: All 5 got 9.2.2.1 from 1 upstream query, {counters['upstream_coalesced']} coalesced")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected 5 answers of 9.2.2.1 from 1 upstream query, got {ips}, "
+              f"{counters.get('upstream_queries')} upstream queries and "
+              f"{counters.get('upstream_coalesced')} coalesced")
+    
     # Cleanup
     print("\n" + "=" * 60)
     
@@ -256,6 +659,7 @@ def run_tests():
     child_server.terminate()
     grandchild_server.terminate()
     resolver.terminate()
+    shutil.rmtree(zone_dir, ignore_errors=True)
     
     time.sleep(0.5)
     
@@ -0,0 +1,164 @@
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+Address = Tuple[str, int]
+
+# Separates the addresses of an NS entry that has several nameservers, like "1.2.3.4:53;5.6.7.8:53".
+# A comma would split the entry itself in the text protocol.
+ADDRESS_SEPARATOR = ';'
+
+# The shortest time to wait for a server before failing over to the next one
+MIN_FAILOVER_TIMEOUT = 0.05
+# How many timeouts in a row mark a server as down, and the longest it stays down before it is tried again
+DOWN_AFTER_FAILURES = 3
+MAX_DOWN_TIME = 30.0
+# How long a healthy server that is not the best one goes without a query before it is probed again
+REPROBE_INTERVAL = 5.0
+
+
+def parse_addresses(ip_str: str) -> List[Address]:
+    """Parse the "ip:port" addresses of an NS entry or of the --upstreams option."""
+    addresses = []
+    for part in ip_str.replace(',', ADDRESS_SEPARATOR).split(ADDRESS_SEPARATOR):
+        part = part.strip()
+        if not part:
+            continue
+        ip, port_str = part.rsplit(':', 1)
+        addresses.append((ip, int(port_str)))
+    return addresses
+
+
+class ServerStats:
+    """What the pool knows about one upstream server."""
+    __slots__ = ('srtt', 'rttvar', 'penalized', 'failures', 'down_until', 'sampled_at')
+
+    def __init__(self):
+        # The smoothed round trip time and its variation, None until the server answers once
+        self.srtt: Optional[float] = None
+        self.rttvar = 0.0
+        # The RTT was raised by a timeout or a lost race instead of measured, the next answer replaces it
+        self.penalized = False
+        # Timeouts in a row
+        self.failures = 0
+        self.down_until = 0.0
+        # When the last answer, timeout or lost race of the server was recorded
+        self.sampled_at = 0.0
+
+
+class UpstreamPool:
+    """
+    Tracks the round trip time of each upstream server, like TCP does, to pick the server to query first.
+    A server that answers is ranked by its smoothed RTT. One that was never measured is ranked after those,
+    so a query does not wait behind a server that may be dead, and is probed with a copy of a query instead.
+    One that timed out DOWN_AFTER_FAILURES times in a row is tried last until its down time passes.
+    A timeout or a lost race only raises a server's RTT until it answers again, and a healthy server that is
+    not the best one is probed again every REPROBE_INTERVAL, so one lost packet does not rank a server last for good.
+    """
+    def __init__(self, max_timeout: float):
+        self.max_timeout = max_timeout
+        self.servers: Dict[Address, ServerStats] = {}
+        # The servers a probe is in flight to
+        self.probing: Set[Address] = set()
+
+    def stats(self, addr: Address) -> ServerStats:
+        stats = self.servers.get(addr)
+        if stats is None:
+            stats = self.servers[addr] = ServerStats()
+        return stats
+
+    def is_down(self, addr: Address) -> bool:
+        stats = self.servers.get(addr)
+        return stats is not None and time.time() < stats.down_until
+
+    def is_measured(self, addr: Address) -> bool:
+        stats = self.servers.get(addr)
+        return stats is not None and stats.srtt is not None
+
+    def order(self, addrs: List[Address]) -> List[Address]:
+        """
+        Return the servers from the best to the worst: healthy before down, measured before never measured,
+        then by smoothed RTT.
+        """
+        if len(addrs) < 2:
+            return addrs
+
+        def rank(addr: Address):
+            stats = self.servers.get(addr)
+            if stats is None or stats.srtt is None:
+                return False, True, 0.0
+            return self.is_down(addr), False, stats.srtt
+
+        return sorted(addrs, key=rank)
+
+    def start_probe(self, addrs: List[Address]) -> Optional[Address]:
+        """
+        Return a server of the list, ordered by order(), to send a copy of a query to, and mark it as probed.
+        A server that was never measured is probed first, then a healthy one after the best that was not
+        sampled for REPROBE_INTERVAL.
+        None if there is none, if a probe to it is in flight, or if no healthy server is measured yet,
+        since then the query goes to a server that was never measured anyway.
+        """
+        if not any(self.is_measured(addr) and not self.is_down(addr) for addr in addrs):
+            return None
+        for addr in addrs:
+            if not self.is_measured(addr) and addr not in self.probing:
+                self.probing.add(addr)
+                return addr
+        now = time.time()
+        for addr in addrs[1:]:
+            stats = self.servers[addr]
+            if addr not in self.probing and not self.is_down(addr) and now - stats.sampled_at >= REPROBE_INTERVAL:
+                self.probing.add(addr)
+                return addr
+        return None
+
+    def end_probe(self, addr: Address):
+        self.probing.discard(addr)
+
+    def timeout_for(self, addr: Address) -> float:
+        """Return how long to wait for a server before failing over: its RTT plus four deviations, like a TCP RTO."""
+        stats = self.servers.get(addr)
+        if stats is None or stats.srtt is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(MIN_FAILOVER_TIMEOUT, stats.srtt + 4 * stats.rttvar))
+
+    def record_answer(self, addr: Address, rtt: float):
+        """
+        Fold the round trip time of an answer into the server's smoothed RTT, and mark the server healthy.
+        The first answer, and the first one after a penalty, starts the smoothed RTT over from the measured one.
+        """
+        stats = self.stats(addr)
+        if stats.srtt is None or stats.penalized:
+            stats.srtt = rtt
+            stats.rttvar = rtt / 2
+            stats.penalized = False
+        else:
+            stats.rttvar = 0.75 * stats.rttvar + 0.25 * abs(stats.srtt - rtt)
+            stats.srtt = 0.875 * stats.srtt + 0.125 * rtt
+        stats.failures = 0
+        stats.down_until = 0.0
+        stats.sampled_at = time.time()
+
+    def record_no_answer_yet(self, addr: Address, elapsed: float):
+        """Rank a server that was slower than another one, and whose query was cancelled, as at least that slow."""
+        stats = self.stats(addr)
+        if elapsed > (stats.srtt or 0.0):
+            stats.srtt = elapsed
+            stats.penalized = True
+        stats.sampled_at = time.time()
+
+    def record_timeout(self, addr: Address, timeout: float):
+        """
+        Count a timeout of the server, and mark it as down for a while after too many in a row.
+        Its RTT is raised to at least the timeout, so the servers that answer are ranked before it.
+        """
+        stats = self.stats(addr)
+        if timeout > (stats.srtt or 0.0):
+            stats.srtt = timeout
+            stats.penalized = True
+        stats.sampled_at = time.time()
+        stats.failures += 1
+        if stats.failures >= DOWN_AFTER_FAILURES:
+            # Back off exponentially, so a dead server is probed less and less often
+            down_time = min(MAX_DOWN_TIME, 2.0 ** (stats.failures - DOWN_AFTER_FAILURES))
+            stats.down_until = time.time() + down_time
@@ -0,0 +1,199 @@
+"""
+A zone snapshot is a zone file compiled into a binary file that the server memory-maps and answers from directly.
+
+Layout, all integers little endian:
+    header        magic, record count, A table slots, NS table slots, NS length count, string table size
+    NS lengths    the distinct lengths of the NS domains, longest first, so a lookup only slices the query at them
+    records       (domain offset, domain length, ip offset, ip length, type code) for each record, sorted by domain
+    A table       open addressing hash table of the A records: record index + 1, or 0 for an empty slot
+    NS table      the same for the NS records, keyed by the delegated suffix
+    strings       the domains and ips, in the order of the records
+The hash is CRC32, which unlike hash() is the same in every process.
+"""
+
+import mmap
+import os
+import struct
+import zlib
+from typing import Iterable, List, Optional, Tuple
+
+from server import DomainEntry, NO_DOMAIN_ENTRY_STR
+
+
+SNAPSHOT_MAGIC = b"DNSZONE1"
+HEADER = struct.Struct('<8sIIIII')
+NS_LENGTH = struct.Struct('<H')
+RECORD = struct.Struct('<IHIHB')
+SLOT = struct.Struct('<I')
+
+TYPE_CODES = {DomainEntry.TYPE_A: 1, DomainEntry.TYPE_NS: 2}
+TYPE_NAMES = {code: name for name, code in TYPE_CODES.items()}
+
+
+def is_snapshot(path: str) -> bool:
+    """Check if a file is a zone snapshot rather than a zone text file."""
+    with open(path, 'rb') as file:
+        return file.read(len(SNAPSHOT_MAGIC)) == SNAPSHOT_MAGIC
+
+
+def table_size(count: int) -> int:
+    """Return a power of two hash table size that keeps the table at most half full."""
+    size = 1
+    while size < count * 2:
+        size *= 2
+    return size
+
+
+def build_table(keys: List[Tuple[bytes, int]]) -> List[int]:
+    """Build an open addressing hash table of (key, record index) pairs."""
+    size = table_size(len(keys))
+    mask = size - 1
+    table = [0] * size
+    for key, index in keys:
+        slot = zlib.crc32(key) & mask
+        while table[slot]:
+            slot = (slot + 1) & mask
+        table[slot] = index + 1
+    return table
+
+
+def compile_zone(entries: Iterable[Tuple[str, str, str]], snapshot_path: str) -> int:
+    """
+    Write a zone snapshot of the (domain, ip, entry type) entries, return how many records it holds.
+    Like a DomainList, the first entry of a domain wins.
+    """
+    seen = set()
+    records = []
+    for domain, ip, entry_type in entries:
+        domain, ip, entry_type = domain.strip(), ip.strip(), entry_type.strip()
+        if entry_type not in TYPE_CODES or (entry_type, domain) in seen:
+            continue
+        seen.add((entry_type, domain))
+        records.append((domain.encode(), ip.encode(), TYPE_CODES[entry_type]))
+    records.sort()
+
+    strings = bytearray()
+    packed_records = []
+    a_keys = []
+    ns_keys = []
+    ns_lengths = set()
+    for index, (domain, ip, type_code) in enumerate(records):
+        domain_offset = len(strings)
+        strings += domain
+        ip_offset = len(strings)
+        strings += ip
+        packed_records.append(RECORD.pack(domain_offset, len(domain), ip_offset, len(ip), type_code))
+        if type_code == TYPE_CODES[DomainEntry.TYPE_A]:
+            a_keys.append((domain, index))
+        else:
+            ns_keys.append((domain, index))
+            ns_lengths.add(len(domain))
+
+    a_table = build_table(a_keys)
+    ns_table = build_table(ns_keys)
+    lengths = sorted(ns_lengths, reverse=True)
+
+    # Write to a temporary file and rename it over the snapshot, so a server that maps the old one is not affected
+    temp_path = snapshot_path + '.tmp'
+    with open(temp_path, 'wb') as file:
+        file.write(HEADER.pack(SNAPSHOT_MAGIC, len(records), len(a_table), len(ns_table), len(lengths), len(strings)))
+        file.write(b"".join(NS_LENGTH.pack(length) for length in lengths))
+        file.write(b"".join(packed_records))
+        file.write(struct.pack(f'<{len(a_table)}I', *a_table))
+        file.write(struct.pack(f'<{len(ns_table)}I', *ns_table))
+        file.write(strings)
+    os.replace(temp_path, snapshot_path)
+    return len(records)
+
+
+def read_zone_file(zone_path: str) -> Iterable[Tuple[str, str, str]]:
+    """Yield the (domain, ip, entry type) entries of a zone text file."""
+    with open(zone_path, 'r') as file:
+        for line in file:
+            parts = line.split(',')
+            if len(parts) == 3:
+                yield parts[0], parts[1], parts[2]
+
+
+class ZoneSnapshot:
+    """
+    Answers queries straight from a memory-mapped zone snapshot, with the same lookup methods as a DomainList.
+    Nothing is built per record when it is opened, and worker processes forked after it share its pages.
+    A snapshot is read only and its entries never expire.
+    """
+    def __init__(self, snapshot_path: str):
+        with open(snapshot_path, 'rb') as file:
+            self.mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.record_count, self.a_slots, self.ns_slots, ns_length_count, strings_size = \
+            HEADER.unpack_from(self.mm)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError(f"{snapshot_path} is not a zone snapshot")
+
+        offset = HEADER.size
+        self.ns_lengths_desc = [NS_LENGTH.unpack_from(self.mm, offset + i * NS_LENGTH.size)[0]
+                                for i in range(ns_length_count)]
+        offset += ns_length_count * NS_LENGTH.size
+        self.records_offset = offset
+        offset += self.record_count * RECORD.size
+        self.a_table_offset = offset
+        offset += self.a_slots * SLOT.size
+        self.ns_table_offset = offset
+        offset += self.ns_slots * SLOT.size
+        self.strings_offset = offset
+        if offset + strings_size != len(self.mm):
+            raise ValueError(f"{snapshot_path} is truncated")
+
+    def __len__(self) -> int:
+        return self.record_count
+
+    def close(self):
+        self.mm.close()
+
+    def find(self, key: bytes, table_offset: int, slots: int) -> Optional[DomainEntry]:
+        """Look a domain up in one of the hash tables, return its entry or None."""
+        if slots == 0:
+            return None
+        mm = self.mm
+        mask = slots - 1
+        slot = zlib.crc32(key) & mask
+        strings = self.strings_offset
+        while True:
+            (index,) = SLOT.unpack_from(mm, table_offset + slot * SLOT.size)
+            if index == 0:
+                return None
+            domain_offset, domain_len, ip_offset, ip_len, type_code = \
+                RECORD.unpack_from(mm, self.records_offset + (index - 1) * RECORD.size)
+            if domain_len == len(key) and mm[strings + domain_offset:strings + domain_offset + domain_len] == key:
+                ip = mm[strings + ip_offset:strings + ip_offset + ip_len].decode()
+                return DomainEntry(key.decode(), ip, TYPE_NAMES[type_code])
+            slot = (slot + 1) & mask
+
+    def lookup_a(self, query: str) -> Optional[DomainEntry]:
+        """Return the A record for exactly this domain, or None."""
+        return self.find(query.encode(), self.a_table_offset, self.a_slots)
+
+    def lookup_ns(self, query: str) -> Optional[DomainEntry]:
+        """Return the NS record with the longest suffix matching the query, or None."""
+        key = query.encode()
+        key_len = len(key)
+        for length in self.ns_lengths_desc:
+            if length > key_len:
+                continue
+            entry = self.find(key[key_len - length:], self.ns_table_offset, self.ns_slots)
+            if entry is not None:
+                return entry
+        return None
+
+    def lookup(self, query: str) -> Optional[DomainEntry]:
+        """Return the entry that answers a query: its A record, or else its longest matching NS record."""
+        entry = self.lookup_a(query)
+        if entry is None:
+            entry = self.lookup_ns(query)
+        return entry
+
+    def resolve(self, query: str) -> str:
+        """Resolve a domain query to its corresponding domain entry string."""
+        entry = self.lookup(query)
+        if entry is None:
+            return NO_DOMAIN_ENTRY_STR
+        return entry.__str__()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+"""
+HTTP server throughput benchmark
+Starts server.py serially and with worker pools, and measures the pages and requests per second it serves
+to clients that load a page's files over a keep-alive connection, like a browser
+"""
+
+import multiprocessing
+import os
+import socket
+import subprocess
+import sys
+import time
+
+from server import parse_options
+
+BENCH_PORT = 18080
+
+
+def read_response(sock, buffer):
+    """Read one response framed by its Content-Length, return its status code and the bytes read past it"""
+    while b"\r\n\r\n" not in buffer:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed")
+        buffer += chunk
+    header, rest = buffer.split(b"\r\n\r\n", 1)
+    lines = header.split(b"\r\n")
+    status = int(lines[0].split()[1])
+    length = 0
+    for line in lines[1:]:
+        name, _, value = line.partition(b":")
+        if name.strip().lower() == b"content-length":
+            length = int(value)
+    while len(rest) < length:
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise ConnectionError("connection closed")
+        rest += chunk
+    return status, rest[length:]
+
+
+def client_loop(port, paths, duration, idle, results):
+    """Load the page over and over until the duration is over, and report the page load times"""
+    page_times = []
+    requests = 0
+    errors = 0
+    deadline = time.time() + duration
+    while time.time() < deadline:
+        start = time.time()
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+            buffer = b""
+            for path in paths:
+                sock.sendall(f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nConnection: keep-alive\r\n\r\n".encode())
+                status, buffer = read_response(sock, buffer)
+                requests += 1
+                if status != 200:
+                    errors += 1
+            page_times.append(time.time() - start)
+            # A browser keeps the connection open a while after the page loaded, then closes it
+            time.sleep(idle)
+            sock.close()
+        except (OSError, ValueError, IndexError):
+            errors += 1
+    results.put((page_times, requests, errors))
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def run(workers, clients, duration, paths, idle):
+    """Start the server with the given amount of workers (0 is the serial loop) and load pages from it"""
+    cmd = ['python3', 'server.py', str(BENCH_PORT), '--workers', str(workers), '--backlog', str(max(clients, 5))]
+    proc = subprocess.Popen(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    time.sleep(1.0)
+    try:
+        results = multiprocessing.Queue()
+        procs = [multiprocessing.Process(target=client_loop, args=(BENCH_PORT, paths, duration, idle, results))
+                 for _ in range(clients)]
+        for p in procs:
+            p.start()
+        outcomes = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+    finally:
+        proc.terminate()
+        proc.wait()
+    page_times = [t for outcome in outcomes for t in outcome[0]]
+    requests = sum(outcome[1] for outcome in outcomes)
+    errors = sum(outcome[2] for outcome in outcomes)
+    return len(page_times) / duration, requests / duration, percentile(page_times, 0.5), \
+        percentile(page_times, 0.99), errors
+
+
+def main():
+    # print("Usage: python bench_server.py [--workers 0,4,16] [--clients N] [--duration SEC] [--paths /a,/b] "
+    #       "[--idle SEC]")
+    options = parse_options(sys.argv[1:])
+    # 0 is the serial loop
+    worker_counts = [int(n) for n in options.get("--workers", "0,4,16").split(',')]
+    clients = int(options.get("--clients", 8))
+    duration = float(options.get("--duration", 3))
+    paths = options.get("--paths", "/c/Footube.html,/c/footube.css,/c/footube.js").split(',')
+    # How long each client keeps its connection open after a page, like a browser does
+    idle = float(options.get("--idle", 0.05))
+
+    print(f"{clients} clients, {len(paths)} files per page, {idle}s idle after each page, {duration}s per run, "
+          f"{os.cpu_count()} CPUs")
+    for workers in worker_counts:
+        pages, requests, p50, p99, errors = run(workers, clients, duration, paths, idle)
+        mode = "serial" if workers == 0 else f"workers={workers}"
+        print(f"{mode:<11} pages/s={pages:>8.1f}  requests/s={requests:>8.1f}  "
+              f"page p50={p50 * 1000:>7.1f}ms  p99={p99 * 1000:>7.1f}ms  errors={errors}")
+
+
+if __name__ == "__main__":
+    try:
+        main()
+    except KeyboardInterrupt:
+        sys.exit(1)
@@ -1,15 +1,538 @@
+import io
+import json
+import posixpath
 import socket
 import sys
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from html.parser import HTMLParser
+from urllib.parse import urljoin, urlsplit
+
+from server import parse_options
+
+# How many bytes to read from a connection at a time, also the size of its receive buffer
+RECV_SIZE = 65536
+# The largest response head we wait for, it must fit in the receive buffer
+MAX_HEAD_SIZE = RECV_SIZE
+# How many idle connections to keep for each host:port
+MAX_IDLE_CONNECTIONS = 4
+# How many connections a page fetch uses at a time, like a browser does per host
+DEFAULT_PAGE_CONNECTIONS = 6
+
+# Responses that never have a body, whatever their headers say
+NO_BODY_STATUSES = (204, 304)
+
+# The tags that reference the assets of a page, and the attribute that holds the reference
+ASSET_ATTRIBUTES = {"img": "src", "script": "src", "link": "href"}
+
+
+class Response:
+    """A response read off a connection."""
+    def __init__(self, first_line, status, headers, body, length):
+        self.first_line = first_line
+        self.status = status
+        # Header names are lowercase
+        self.headers = headers
+        # None when the body was written to a file instead
+        self.body = body
+        self.length = length
+
+
+class HTTPConnection:
+    """
+    A keep-alive connection to a server. Responses are framed by their Content-Length,
+    so the next response can be read off the same connection without waiting for the server to close it.
+    Everything is received with recv_into into one buffer allocated with the connection, so reading a response
+    costs no allocation per read, and a body is passed on from the buffer as it arrives, never accumulated.
+    Bytes received past the end of a head are kept in the buffer for the body or the next response.
+    """
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.sock = socket.create_connection((host, port))
+        # Requests are small, don't let Nagle hold one back waiting for the ACK of the one before
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.buffer = bytearray(RECV_SIZE)
+        self.view = memoryview(self.buffer)
+        # The bytes received and not read yet are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # False once the server said it closes the connection, or closed it
+        self.reusable = True
+
+    def send_requests(self, paths, keep_alive=True, conditions=None):
+        """
+        Send a GET request for each path, all in one write so pipelined requests share segments.
+        conditions may give extra header lines for each path, like the validators of a conditional request.
+        """
+        connection = "keep-alive" if keep_alive else "close"
+        if conditions is None:
+            conditions = [""] * len(paths)
+        requests = "".join(
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {self.host}:{self.port}\r\n"
+            f"Connection: {connection}\r\n"
+            f"{condition}"
+            f"\r\n"
+            for path, condition in zip(paths, conditions)
+        )
+        self.sock.sendall(requests.encode())
+
+    def pending(self):
+        """How many bytes were received and not read yet."""
+        return self.end - self.start
+
+    def receive(self, limit=RECV_SIZE):
+        """
+        Read at most limit more bytes into the free end of the buffer, moving the unread bytes to its front first
+        if they are at the end. Return how many were read, 0 if the server closed the connection.
+        """
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buffer):
+            pending = self.end - self.start
+            self.buffer[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        count = self.sock.recv_into(self.view[self.end:], min(limit, len(self.buffer) - self.end))
+        if not count:
+            self.reusable = False
+        self.end += count
+        return count
+
+    def read_head(self):
+        """Read the status line and headers of the next response. Return the first line, status and headers."""
+        # How many of the unread bytes were already searched for the end of the head.
+        # It is counted from the start, since receive may move the unread bytes to the front of the buffer
+        scanned = 0
+        while True:
+            end = self.buffer.find(b"\r\n\r\n", self.start + max(scanned - 3, 0), self.end)
+            if end >= 0:
+                break
+            if self.pending() >= MAX_HEAD_SIZE:
+                raise ValueError("response head too large")
+            scanned = self.pending()
+            if not self.receive():
+                raise ConnectionError("connection closed before the response")
+        header_lines = bytes(self.view[self.start:end]).decode('utf-8', errors='ignore').split('\r\n')
+        self.start = end + 4
+
+        first_line = header_lines[0]
+        parts = first_line.split()
+        status = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+        headers = {}
+        for line in header_lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if headers.get("connection", "").lower() == "close":
+            self.reusable = False
+        return first_line, status, headers
+
+    def read_body(self, length, out):
+        """
+        Write the next length bytes of the connection to out, or until the server closes it if length is None.
+        The reads are bounded by what is left of the body, so they never take bytes of the next response.
+        Return how many bytes were written.
+        """
+        written = 0
+        while length is None or written < length:
+            if self.start == self.end:
+                left = RECV_SIZE if length is None else length - written
+                if not self.receive(left):
+                    if length is None:
+                        break
+                    raise ConnectionError("connection closed in the middle of the body")
+            count = self.pending() if length is None else min(self.pending(), length - written)
+            out.write(self.view[self.start:self.start + count])
+            self.start += count
+            written += count
+        return written
+
+    def read_response(self, save_to=None):
+        """
+        Read the next response. If save_to is a path and the response is 200 OK, the body is streamed to that file
+        instead of kept in memory. Raises ConnectionError if the connection closes before the response ends.
+        """
+        first_line, status, headers = self.read_head()
+        length = headers.get("content-length")
+        # Without a Content-Length, the body ends when the server closes the connection
+        length = None if length is None else int(length)
+        if status in NO_BODY_STATUSES or status < 200:
+            length = 0
+
+        if save_to is not None and status == 200:
+            os.makedirs(os.path.dirname(save_to) or ".", exist_ok=True)
+            with open(save_to, "wb") as f:
+                length = self.read_body(length, f)
+            return Response(first_line, status, headers, None, length)
+
+        body = io.BytesIO()
+        length = self.read_body(length, body)
+        return Response(first_line, status, headers, body.getvalue(), length)
+
+    def close(self):
+        self.reusable = False
+        self.sock.close()
+
+
+class ValidatorCache:
+    """
+    Remembers the ETag and Last-Modified of each file that was saved, in a JSON file that is kept between runs,
+    so a path that is fetched again is asked for with If-None-Match and If-Modified-Since.
+    When the saved file is still the server's version, the server answers 304 Not Modified without the body,
+    and the file on disk is kept. The size and mtime of the file as it was saved are remembered too,
+    so the validators are only sent while the file on disk is still that copy, and not one that was
+    overwritten by another path saved under the same name, or cut short. It may be shared by threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        # "host:port path" -> {"file": where it was saved, "size" and "mtime_ns": of the file as it was saved,
+        #                      "etag": ..., "last_modified": ...}
+        self.entries = {}
+        self.lock = threading.Lock()
+        try:
+            with open(path, "r") as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def conditions(self, host, port, path, file_path):
+        """Return the header lines that make the request for a path conditional, empty if there is no copy of it."""
+        if file_path is None:
+            return ""
+        with self.lock:
+            entry = self.entries.get(f"{host}:{port} {path}")
+        if entry is None or entry["file"] != os.path.normpath(file_path):
+            return ""
+        # Only ask for a 304 if the file we would keep is still the one we saved
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return ""
+        if entry.get("size") != st.st_size or entry.get("mtime_ns") != st.st_mtime_ns:
+            return ""
+        condition = ""
+        if entry.get("etag"):
+            condition += f"If-None-Match: {entry['etag']}\r\n"
+        if entry.get("last_modified"):
+            condition += f"If-Modified-Since: {entry['last_modified']}\r\n"
+        return condition
+
+    def update(self, host, port, path, file_path, response):
+        """Remember the validators of a file that was saved, forget them if the file changed in another way."""
+        key = f"{host}:{port} {path}"
+        if response.status == 304:
+            return
+        if response.status != 200 or file_path is None:
+            with self.lock:
+                self.entries.pop(key, None)
+            return
+
+        etag = response.headers.get("etag")
+        last_modified = response.headers.get("last-modified")
+        file_path = os.path.normpath(file_path)
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            st = None
+        with self.lock:
+            # The file was overwritten, the paths that were saved to it before no longer have their copy
+            self.forget_file(file_path)
+            self.entries.pop(key, None)
+            if st is not None and (etag or last_modified):
+                self.entries[key] = {"file": file_path, "size": st.st_size, "mtime_ns": st.st_mtime_ns,
+                                     "etag": etag, "last_modified": last_modified}
+
+    def discard(self, host, port, path, file_path):
+        """Forget a path whose response could not be read, the file it was being saved to may be cut short."""
+        with self.lock:
+            self.entries.pop(f"{host}:{port} {path}", None)
+            if file_path is not None:
+                self.forget_file(os.path.normpath(file_path))
+
+    def forget_file(self, file_path):
+        """Forget every path that was saved to the file. Called with the lock held."""
+        for key in [key for key, entry in self.entries.items() if entry["file"] == file_path]:
+            del self.entries[key]
+
+    def save(self):
+        """Write the validators to their file, through a temporary file so a crash never leaves half of one."""
+        with self.lock:
+            data = json.dumps(self.entries, indent=2)
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            f.write(data)
+        os.replace(temp_path, self.path)
+
+
+class ConnectionPool:
+    """
+    Keeps the idle keep-alive connections of each host:port, to reuse them for the next requests.
+    It may be shared by threads, each connection is used by one thread at a time.
+    """
+    def __init__(self, max_idle=MAX_IDLE_CONNECTIONS, validator_cache=None):
+        self.max_idle = max_idle
+        # Makes the requests for files that were saved before conditional, if it is given
+        self.validator_cache = validator_cache
+        # (host, port) -> idle connections
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def get(self, host, port):
+        """Return an idle connection to the server, or a new one. The second value tells if it was reused."""
+        with self.lock:
+            connections = self.idle.get((host, port))
+            if connections:
+                return connections.pop(), True
+        return HTTPConnection(host, port), False
+
+    def release(self, connection):
+        """Give a connection back once its responses were read, it is kept if the server keeps it open."""
+        with self.lock:
+            connections = self.idle.setdefault((connection.host, connection.port), [])
+            if connection.reusable and len(connections) < self.max_idle:
+                connections.append(connection)
+                return
+        connection.close()
+
+    def close(self):
+        with self.lock:
+            idle = self.idle
+            self.idle = {}
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def fetch(self, host, port, paths, save_to=None):
+        """
+        Get the paths over one connection, pipelined: all the requests are sent before the responses are read.
+        Return the responses in the order of the paths. When the server closes the connection before answering
+        them all, as it does after a 404, the rest are sent again on another connection.
+        An idle connection the server closed meanwhile is retried on a new one.
+        save_to may give a file for each path, that its body is streamed to if it is 200 OK.
+        """
+        if save_to is None:
+            save_to = [None] * len(paths)
+        conditions = None
+        if self.validator_cache is not None:
+            # All the requests are sent before any response is saved, so a path whose file another path of the
+            # batch also saves to is not made conditional, the copy it would keep may be overwritten first
+            conditions = [self.validator_cache.conditions(host, port, path, file_path)
+                          if file_path is None or save_to.count(file_path) == 1 else ""
+                          for path, file_path in zip(paths, save_to)]
+        responses = []
+        while len(responses) < len(paths):
+            done = len(responses)
+            pending = paths[done:]
+            connection, reused = self.get(host, port)
+            try:
+                connection.send_requests(pending, conditions=None if conditions is None else conditions[done:])
+                for path, file_path in zip(pending, save_to[done:]):
+                    try:
+                        response = connection.read_response(file_path)
+                    except Exception:
+                        if self.validator_cache is not None:
+                            self.validator_cache.discard(host, port, path, file_path)
+                        raise
+                    responses.append(response)
+                    if self.validator_cache is not None:
+                        self.validator_cache.update(host, port, path, file_path, response)
+                    if not connection.reusable:
+                        break
+            except OSError:
+                connection.close()
+                # A new connection that fails without a single response will not do better the next time,
+                # one that answered some of the requests is retried for the rest
+                if not reused and len(responses) == done and not connection.pending():
+                    raise
+                continue
+            self.release(connection)
+        return responses
+
+
+def file_name(path):
+    """Return the name of the file a 200 OK response to the path is saved to."""
+    # we will get the filename from the path
+    filename = os.path.basename(path)
+
+    # if the path is / or empty, name it index.html
+    if not filename:
+        filename = "index.html"
+    return filename
+
+
+class AssetParser(HTMLParser):
+    """Collects the references of a page to its images, scripts and stylesheets, in the order they appear."""
+    def __init__(self):
+        super().__init__()
+        self.references = []
+
+    def handle_starttag(self, tag, attrs):
+        attribute = ASSET_ATTRIBUTES.get(tag)
+        if attribute is None:
+            return
+        for name, value in attrs:
+            if name == attribute and value:
+                self.references.append(value)
+
+
+def find_assets(page, host, port, page_path):
+    """
+    Return the (host, port, path) of each asset of an HTML page, without duplicates,
+    and the references that can't be fetched, like https ones.
+    """
+    parser = AssetParser()
+    parser.feed(page.decode('utf-8', errors='ignore'))
+    parser.close()
+
+    base = f"http://{host}:{port}{page_path}"
+    assets = []
+    skipped = []
+    for reference in parser.references:
+        url = urlsplit(urljoin(base, reference))
+        if url.scheme != "http" or not url.hostname:
+            skipped.append(reference)
+            continue
+        path = url.path or "/"
+        if url.query:
+            path += "?" + url.query
+        asset = (url.hostname, url.port or 80, path)
+        if asset not in assets:
+            assets.append(asset)
+    return assets, skipped
+
+
+def local_path(output_dir, path):
+    """Return where to save the file of a path, under the output directory, keeping the path's directories."""
+    path = posixpath.normpath("/" + path.split("?", 1)[0]).lstrip("/")
+    if not path or path.endswith("/"):
+        path += "index.html"
+    return os.path.join(output_dir, *path.split("/"))
+
+
+def fetch_file(pool, host, port, path, output_dir):
+    """Get a file over a pooled connection, streaming it to disk if it is 200 OK. Return the response and time."""
+    start = time.time()
+    response = pool.fetch(host, port, [path], [local_path(output_dir, path)])[0]
+    return response, time.time() - start
+
+
+def fetch_page(host, port, page_path, connections, output_dir, validator_cache=None):
+    """
+    Get an HTML page, then its assets concurrently over at most the given number of connections,
+    writing each file to disk as it arrives. Print each file as it is done, and the total page load time.
+    Files that were saved before are only sent again if they changed, when a validator cache is given.
+    """
+    pool = ConnectionPool(connections, validator_cache)
+    start = time.time()
+    try:
+        response, elapsed = fetch_file(pool, host, port, page_path, output_dir)
+        print(f"{response.first_line}  {page_path}  {response.length} bytes  {elapsed * 1000:.1f} ms")
+        if response.status not in (200, 304):
+            return
+        # The page was written to disk as it arrived, read it back to find its assets
+        with open(local_path(output_dir, page_path), "rb") as f:
+            assets, skipped = find_assets(f.read(), host, port, page_path)
+        total_bytes = response.length
+        failed = 0
+        not_modified = 1 if response.status == 304 else 0
+
+        with ThreadPoolExecutor(connections) as executor:
+            futures = {executor.submit(fetch_file, pool, asset_host, asset_port, path, output_dir):
+                       (asset_host, asset_port, path) for asset_host, asset_port, path in assets}
+            for future in as_completed(futures):
+                path = futures[future][2]
+                try:
+                    response, elapsed = future.result()
+                except (OSError, ValueError) as e:
+                    failed += 1
+                    print(f"failed  {path}  {e}")
+                    continue
+                total_bytes += response.length
+                if response.status == 304:
+                    not_modified += 1
+                print(f"{response.first_line}  {path}  {response.length} bytes  {elapsed * 1000:.1f} ms")
+
+        for reference in skipped:
+            print(f"skipped  {reference}")
+        print(f"Page loaded in {time.time() - start:.3f} s: {1 + len(assets) - failed} files, {total_bytes} bytes, "
+              f"{not_modified} not modified, {connections} connections, {failed} failed, {len(skipped)} skipped")
+    finally:
+        pool.close()
+
+
+def read_paths(count):
+    """Read up to count paths from the user, fewer only at the end of the input."""
+    paths = []
+    while len(paths) < count:
+        try:
+            paths.append(input())
+        except EOFError:
+            break
+    return paths
+
+
+def main_keep_alive(server_ip, server_port, pipeline, validator_cache=None):
+    """Get the paths the user enters over pooled keep-alive connections, pipeline of them at a time."""
+    pool = ConnectionPool(validator_cache=validator_cache)
+    try:
+        while True:
+            paths = read_paths(pipeline)
+            if not paths:
+                break
+            try:
+                responses = pool.fetch(server_ip, server_port, paths, [file_name(path) for path in paths])
+            except (OSError, ValueError):
+                # The server can't be reached, skip these paths like the one connection mode does
+                continue
+            for response in responses:
+                print(response.first_line)
+    finally:
+        pool.close()
 
 
 def main():
     # Check argument amount
     if len(sys.argv) < 3:
+        # print("Usage: python client.py <serverIP> <serverPort> [--keep-alive] [--pipeline N] "
+        #       "[--page PATH [--connections N] [--output DIR]] [--validators FILE]")
         return
 
     server_ip = sys.argv[1]
     server_port = int(sys.argv[2])
+    options = parse_options(sys.argv[3:])
+    # The validators of the files saved by earlier runs, to only get the ones that changed since
+    validator_cache = None
+    if options.get("--validators"):
+        validator_cache = ValidatorCache(options["--validators"])
+    try:
+        fetch_paths(server_ip, server_port, options, validator_cache)
+    finally:
+        if validator_cache is not None:
+            try:
+                validator_cache.save()
+            except OSError:
+                pass
+
+
+def fetch_paths(server_ip, server_port, options, validator_cache):
+    """Get the page, or the paths the user enters, the way the options say."""
+    # Page mode gets the page and all its assets instead of reading paths from the user
+    if "--page" in options:
+        connections = int(options.get("--connections", DEFAULT_PAGE_CONNECTIONS))
+        try:
+            fetch_page(server_ip, server_port, options["--page"] or "/", connections, options.get("--output", "."),
+                       validator_cache)
+        except (OSError, ValueError) as e:
+            print(f"Error getting the page: {e}")
+        return
+
+    # Pipelining sends that many requests on a connection before reading their responses, and implies keep-alive
+    pipeline = int(options.get("--pipeline", 1))
+    if "--keep-alive" in options or pipeline > 1:
+        main_keep_alive(server_ip, server_port, max(pipeline, 1), validator_cache)
+        return
 
     # Infinite loop to get paths from the user
     while True:
@@ -18,63 +541,40 @@ def main():
         except EOFError:
             break
 
-        # Create a TCP socket
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
+        connection = None
         try:
             # Connect to the server
-            sock.connect((server_ip, server_port))
+            connection = HTTPConnection(server_ip, server_port)
 
             # We create the GET request for the file and send it to the server
             # We close the connection right after.
-            request = (
-                f"GET {path} HTTP/1.1\r\n"
-                f"Host: {server_ip}:{server_port}\r\n"
-                f"Connection: close\r\n"
-                f"\r\n"
-            )
-
-            sock.sendall(request.encode())
-
-            # Get back the response data
-            response_data = b""
-            while True:
-                chunk = sock.recv(4096)
-                if not chunk:
-                    break
-                response_data += chunk
-
-            sock.close()
-
-            # Get the header and body parts by splitting on two newlines
-            parts = response_data.split(b'\r\n\r\n', 1)
+            # If we saved this file before, we ask for it only if it changed
+            filename = file_name(path)
+            conditions = None
+            if validator_cache is not None:
+                conditions = [validator_cache.conditions(server_ip, server_port, path, filename)]
+            connection.send_requests([path], keep_alive=False, conditions=conditions)
 
-            header_bytes = parts[0]
+            # The header is parsed as soon as it arrives, and in case of 200 response
+            # the body is written to the file as it is received, never held in memory as a whole
+            try:
+                response = connection.read_response(filename)
+            except Exception:
+                if validator_cache is not None:
+                    validator_cache.discard(server_ip, server_port, path, filename)
+                raise
+            if validator_cache is not None:
+                validator_cache.update(server_ip, server_port, path, filename, response)
 
             # Print the first line of the response
-            first_line = header_bytes.decode('utf-8', errors='ignore').split('\r\n')[0]
-            print(first_line)
-
-            # In case of 200 response, we will save the body content to a file
-            # we will get the filename from the path
-            if len(parts) > 1:
-                body_content = parts[1]
-
-                if "200 OK" in first_line:
-                    filename = os.path.basename(path)
-
-                    # if the path is / or empty, name it index.html
-                    if not filename:
-                        filename = "index.html"
-
-                    # Save the body content to the file
-                    with open(filename, "wb") as f:
-                        f.write(body_content)
+            print(response.first_line)
 
         except Exception as e:
             # If there was an error we close the connection
-            if sock:
-                sock.close()
+            pass
+        finally:
+            if connection is not None:
+                connection.close()
 
 
 if __name__ == "__main__":
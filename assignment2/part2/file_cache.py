@@ -0,0 +1,146 @@
+import os
+import stat
+import threading
+import time
+from collections import OrderedDict
+from email.utils import formatdate
+
+# Defaults: how many bytes of files to keep, the largest file to keep (bigger ones are streamed from disk),
+# and how long a cached file is served before its mtime and size are checked again
+DEFAULT_CACHE_SIZE = 16 * 1024 * 1024
+DEFAULT_MAX_FILE_SIZE = 1024 * 1024
+DEFAULT_CHECK_INTERVAL = 1.0
+# How many versions of files that are not cached to keep the validators of
+DEFAULT_MAX_VALIDATORS = 1024
+
+
+class Validators:
+    """
+    The ETag and Last-Modified of one version of a file, a version being its mtime and size,
+    and the response headers built with them.
+    """
+    __slots__ = ('etag', 'last_modified', 'mtime_ns', 'size', 'headers')
+
+    def __init__(self, mtime_ns, size):
+        self.etag = f'"{size:x}-{mtime_ns:x}"'
+        self.last_modified = formatdate(mtime_ns / 1e9, usegmt=True)
+        self.mtime_ns = mtime_ns
+        self.size = size
+        # (status, Connection header value) -> response header bytes, filled in by the server when it first needs one
+        self.headers = {}
+
+
+class CachedFile:
+    """The content of a file as of one version of it, and its validators."""
+    __slots__ = ('body', 'size', 'mtime_ns', 'checked', 'validators')
+
+    def __init__(self, body, mtime_ns, checked):
+        self.body = body
+        self.size = len(body)
+        self.mtime_ns = mtime_ns
+        # When the file was last checked for changes
+        self.checked = checked
+        self.validators = Validators(mtime_ns, self.size)
+
+
+class ValidatorCache:
+    """
+    Keeps the validators of the files that are streamed from disk instead of cached, keyed by path,
+    so they are built once for each version of a file, not for each request.
+    The caller stats the file anyway, so a version is looked up by its mtime and size.
+    It holds at most max_entries paths, and evicts the least recently used ones past that.
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_VALIDATORS):
+        self.max_entries = max_entries
+        # path -> Validators, ordered from least to most recently used
+        self.files = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, file_path, mtime_ns, size):
+        with self.lock:
+            validators = self.files.get(file_path)
+            if validators is not None and validators.mtime_ns == mtime_ns and validators.size == size:
+                self.files.move_to_end(file_path)
+                return validators
+
+            validators = Validators(mtime_ns, size)
+            self.files[file_path] = validators
+            self.files.move_to_end(file_path)
+            while len(self.files) > self.max_entries:
+                self.files.popitem(last=False)
+            return validators
+
+
+class FileCache:
+    """
+    Keeps the content of small files in memory, keyed by path, so a hot file is served without touching the disk.
+    A cached file is served without any system call for check_interval seconds, then its mtime and size are checked,
+    and it is read again if they changed. Files bigger than max_file_size are not cached, so they can be streamed.
+    The cache holds at most max_size bytes, and evicts the least recently used files past that.
+    It is shared by the worker threads, so it is guarded by a lock.
+    """
+    def __init__(self, max_size=DEFAULT_CACHE_SIZE, max_file_size=DEFAULT_MAX_FILE_SIZE,
+                 check_interval=DEFAULT_CHECK_INTERVAL):
+        self.max_size = max_size
+        self.max_file_size = min(max_file_size, max_size)
+        self.check_interval = check_interval
+        # path -> CachedFile, ordered from least to most recently used
+        self.files = OrderedDict()
+        self.total_size = 0
+        self.lock = threading.Lock()
+
+    def get(self, file_path):
+        """Return the cached file at the path, reading it if needed. None if it is not a file or is too big."""
+        now = time.monotonic()
+        with self.lock:
+            cached = self.files.get(file_path)
+            if cached is not None and now - cached.checked < self.check_interval:
+                self.files.move_to_end(file_path)
+                return cached
+
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            st = None
+        if st is None or not stat.S_ISREG(st.st_mode) or st.st_size > self.max_file_size:
+            self.discard(file_path)
+            return None
+
+        if cached is not None and cached.mtime_ns == st.st_mtime_ns and cached.size == st.st_size:
+            # Not changed, trust it for another interval
+            with self.lock:
+                cached.checked = now
+                if file_path in self.files:
+                    self.files.move_to_end(file_path)
+            return cached
+
+        try:
+            with open(file_path, "rb") as f:
+                # Take the version from the file we opened, so it matches what we read
+                mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+                body = f.read(self.max_file_size + 1)
+        except OSError:
+            self.discard(file_path)
+            return None
+        if len(body) > self.max_file_size:
+            # It grew since the stat
+            self.discard(file_path)
+            return None
+
+        cached = CachedFile(body, mtime_ns, now)
+        with self.lock:
+            old = self.files.pop(file_path, None)
+            if old is not None:
+                self.total_size -= old.size
+            self.files[file_path] = cached
+            self.total_size += cached.size
+            while self.total_size > self.max_size:
+                _, evicted = self.files.popitem(last=False)
+                self.total_size -= evicted.size
+        return cached
+
+    def discard(self, file_path):
+        with self.lock:
+            old = self.files.pop(file_path, None)
+            if old is not None:
+                self.total_size -= old.size
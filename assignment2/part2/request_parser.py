@@ -0,0 +1,107 @@
+CRLF = b"\r\n"
+HEADER_END = b"\r\n\r\n"
+
+# The largest request head we wait for, past it the request is rejected
+MAX_HEAD_SIZE = 64 * 1024
+
+CONNECTION = b"connection:"
+CONTENT_LENGTH = b"content-length:"
+IF_NONE_MATCH = b"if-none-match:"
+IF_MODIFIED_SINCE = b"if-modified-since:"
+
+
+class BadRequest(ValueError):
+    """Raised when a request cannot be parsed."""
+
+
+class Request:
+    """The parts of a request the server uses."""
+    __slots__ = ('method', 'path', 'connection', 'if_none_match', 'if_modified_since', 'head')
+
+    def __init__(self, method, path, connection, head, if_none_match=None, if_modified_since=None):
+        self.method = method
+        self.path = path
+        # "keep-alive" or "close"
+        self.connection = connection
+        # The validators of a conditional request, None when the header is not there
+        self.if_none_match = if_none_match
+        self.if_modified_since = if_modified_since
+        # The raw request line and headers
+        self.head = head
+
+
+class RequestParser:
+    """
+    Splits the bytes of a connection into requests, however they were segmented.
+    The bytes received are appended to a buffer, and each complete request is taken off its front,
+    so several pipelined requests that arrived in one read come out one by one, in order.
+    The end of the head is searched for in the bytes without decoding them, starting where the last search
+    stopped, and only the request line and the Connection, Content-Length, If-None-Match and If-Modified-Since
+    headers are parsed.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        # How far the buffer was already searched for the end of the head
+        self.scanned = 0
+
+    def feed(self, data):
+        self.buffer += data
+
+    def next_request(self):
+        """Return the next complete request in the buffer, or None if more bytes are needed."""
+        buffer = self.buffer
+        # The end marker may straddle the bytes searched last time and the new ones
+        end = buffer.find(HEADER_END, max(self.scanned - 3, 0))
+        if end < 0:
+            self.scanned = len(buffer)
+            if len(buffer) > MAX_HEAD_SIZE:
+                raise BadRequest("request head too large")
+            return None
+
+        head = bytes(buffer[:end])
+        line_end = head.find(CRLF)
+        request_line = (head if line_end < 0 else head[:line_end]).split()
+        if len(request_line) < 2:
+            raise BadRequest("malformed request line")
+
+        connection = "keep-alive"
+        content_length = 0
+        if_none_match = None
+        if_modified_since = None
+        if line_end >= 0:
+            for line in head[line_end + 2:].split(CRLF):
+                # Only lowercase the names of the headers we look for
+                first = line[:1]
+                if first in (b"c", b"C"):
+                    name = line[:len(CONTENT_LENGTH)].lower()
+                    if name.startswith(CONNECTION):
+                        value = line[len(CONNECTION):].lower()
+                        if b"close" in value:
+                            connection = "close"
+                        elif b"keep-alive" in value:
+                            connection = "keep-alive"
+                    elif name == CONTENT_LENGTH:
+                        try:
+                            content_length = int(line[len(CONTENT_LENGTH):])
+                        except ValueError:
+                            raise BadRequest("malformed Content-Length")
+                        if content_length < 0:
+                            raise BadRequest("negative Content-Length")
+                elif first in (b"i", b"I"):
+                    name = line[:len(IF_MODIFIED_SINCE)].lower()
+                    if name.startswith(IF_NONE_MATCH):
+                        if_none_match = line[len(IF_NONE_MATCH):].strip().decode('ascii', errors='ignore')
+                    elif name == IF_MODIFIED_SINCE:
+                        if_modified_since = line[len(IF_MODIFIED_SINCE):].strip().decode('ascii', errors='ignore')
+
+        # Wait for the body too, the server does not use it but it must be skipped to find the next request
+        request_end = end + len(HEADER_END) + content_length
+        if len(buffer) < request_end:
+            self.scanned = end
+            return None
+        del buffer[:request_end]
+        self.scanned = 0
+
+        method = request_line[0].decode('ascii', errors='ignore')
+        path = request_line[1].decode('utf-8', errors='ignore')
+        return Request(method, path, connection, head, if_none_match, if_modified_since)
@@ -1,13 +1,96 @@
+import queue
 import socket
 import sys
 import os
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+from file_cache import FileCache, ValidatorCache, Validators, DEFAULT_CACHE_SIZE, DEFAULT_MAX_FILE_SIZE, \
+    DEFAULT_CHECK_INTERVAL
+from request_parser import RequestParser, BadRequest
+
+# Default listen backlog, the connections the kernel holds until we accept them
+DEFAULT_BACKLOG = 5
+
+# How many bytes to read from a connection at a time
+RECV_SIZE = 65536
+
+# Tells the kernel more data follows the header, so it goes out in the same segment as the start of the body
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
+
+
+def parse_options(args):
+    """
+    Parse the optional "--name value" arguments that follow the positional ones.
+    A flag with no value after it is stored as an empty string.
+    """
+    options = {}
+    i = 0
+    while i < len(args):
+        if args[i].startswith("--"):
+            if i + 1 < len(args) and not args[i + 1].startswith("--"):
+                options[args[i]] = args[i + 1]
+                i += 2
+                continue
+            options[args[i]] = ""
+        i += 1
+    return options
+
+
+class ConnectionPool:
+    """
+    A fixed number of worker threads that each handle one client connection at a time.
+    At most max_connections connections are accepted and not yet closed, the ones that wait for a free worker
+    are queued. Past the limit, the accept loop stops accepting, and new connections wait in the listen backlog.
+    """
+    def __init__(self, workers, max_connections, file_cache=None, validator_cache=None):
+        self.file_cache = file_cache
+        self.validator_cache = validator_cache
+        self.connections = queue.Queue()
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.threads = [threading.Thread(target=self.work, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def work(self):
+        while True:
+            client_socket = self.connections.get()
+            try:
+                handle_client_connection(client_socket, self.file_cache, self.validator_cache)
+            finally:
+                self.slots.release()
+
+    def wait_for_slot(self, timeout):
+        """Wait until another connection may be accepted, return False if the timeout passed first."""
+        return self.slots.acquire(timeout=timeout)
+
+    def release_slot(self):
+        self.slots.release()
+
+    def submit(self, client_socket):
+        self.connections.put(client_socket)
+
 
 def main():
     # Check argument amount
     if len(sys.argv) < 2:
+        # print("Usage: python server.py <port> [--workers N] [--max-connections N] [--backlog N] "
+        #       "[--cache-size BYTES] [--cache-max-file BYTES] [--cache-check SEC]")
         return
 
     server_port = int(sys.argv[1])
+    options = parse_options(sys.argv[2:])
+    # How many connections to handle at the same time, 0 handles them one after the other
+    workers = int(options.get("--workers", 0))
+    # How many connections may be accepted at a time, by default one for each worker
+    max_connections = int(options.get("--max-connections", workers))
+    backlog = int(options.get("--backlog", DEFAULT_BACKLOG))
+    # How many bytes of small files to keep in memory, 0 turns the cache off
+    cache_size = int(options.get("--cache-size", DEFAULT_CACHE_SIZE))
+    # Bigger files are always streamed from disk
+    cache_max_file = int(options.get("--cache-max-file", DEFAULT_MAX_FILE_SIZE))
+    # How long a cached file is served before checking if it changed on disk
+    cache_check = float(options.get("--cache-check", DEFAULT_CHECK_INTERVAL))
 
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 
@@ -16,14 +99,32 @@ def main():
 
     try:
         server_socket.bind(('', server_port))
-        server_socket.listen(5)
+        server_socket.listen(backlog)
         # Allow us to press ctrl C in order to stop the program
         server_socket.settimeout(0.5)
     except Exception as e:
         return
 
+    file_cache = None
+    if cache_size > 0:
+        file_cache = FileCache(cache_size, cache_max_file, cache_check)
+    # The ETag and Last-Modified of the files that are streamed from disk
+    validator_cache = ValidatorCache()
+
+    pool = None
+    if workers > 0:
+        pool = ConnectionPool(workers, max_connections or workers, file_cache, validator_cache)
+
     while True:
+        # Whether this iteration holds a pool slot, and the connection it accepted, until a worker takes them
+        has_slot = False
+        client_socket = None
         try:
+            # Don't accept more connections than the pool may hold
+            if pool is not None:
+                if not pool.wait_for_slot(0.5):
+                    continue
+                has_slot = True
             try:
                 # Accept a new connection
                 client_socket, client_address = server_socket.accept()
@@ -35,66 +136,157 @@ def main():
 
             # Configure a timeout of 1 second for client socket
             client_socket.settimeout(1.0)
+            # Send each response as soon as it is written, so a small one does not wait behind the one before it
+            # for a delayed ACK when requests are pipelined. MSG_MORE still keeps a header with its body.
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if pool is not None:
+                # A worker handles the connection while we accept the next one, and releases the slot
+                pool.submit(client_socket)
+                has_slot = False
+                client_socket = None
+                continue
             # Handle the client connection
-            handle_client_connection(client_socket)
+            handle_client_connection(client_socket, file_cache, validator_cache)
 
         except KeyboardInterrupt:
             break
         except Exception as e:
+            # Close a connection that no worker took
+            if client_socket is not None:
+                client_socket.close()
             continue
+        finally:
+            if has_slot:
+                pool.release_slot()
 
     server_socket.close()
 
 
-def handle_client_connection(client_socket):
+def ok_header(connection_header_val, content_length, validators=None):
+    """Build the header of a 200 OK response, with the validators of the file if they are given."""
+    header = (
+        f"HTTP/1.1 200 OK\r\n"
+        f"Connection: {connection_header_val}\r\n"
+        f"Content-Length: {content_length}\r\n"
+    )
+    if validators is not None:
+        header += (
+            f"ETag: {validators.etag}\r\n"
+            f"Last-Modified: {validators.last_modified}\r\n"
+        )
+    return (header + "\r\n").encode()
+
+
+def not_modified_header(connection_header_val, validators):
+    """Build the header of a 304 Not Modified response, it has no body."""
+    header = (
+        f"HTTP/1.1 304 Not Modified\r\n"
+        f"Connection: {connection_header_val}\r\n"
+        f"ETag: {validators.etag}\r\n"
+        f"Last-Modified: {validators.last_modified}\r\n"
+        f"\r\n"
+    )
+    return header.encode()
+
+
+def file_header(validators, status, connection_header_val):
+    """Return the header of a 200 or 304 response for a version of a file, it is built once for each version."""
+    header = validators.headers.get((status, connection_header_val))
+    if header is None:
+        if status == 304:
+            header = not_modified_header(connection_header_val, validators)
+        else:
+            header = ok_header(connection_header_val, validators.size, validators)
+        validators.headers[(status, connection_header_val)] = header
+    return header
+
+
+def is_not_modified(request, validators):
+    """Tell if the client already has this version of the file, from the validators of a conditional request."""
+    if request.if_none_match is not None:
+        # If-None-Match decides alone when it is there
+        if request.if_none_match == "*":
+            return True
+        for tag in request.if_none_match.split(","):
+            tag = tag.strip()
+            # A weak ETag matches too, the comparison of a GET is weak
+            if tag.startswith("W/"):
+                tag = tag[2:]
+            if tag == validators.etag:
+                return True
+        return False
+
+    if request.if_modified_since is not None:
+        # A client usually sends back the Last-Modified it got, then there is nothing to parse
+        if request.if_modified_since == validators.last_modified:
+            return True
+        date = parsedate_tz(request.if_modified_since)
+        if date is None:
+            return False
+        # Last-Modified only has whole seconds
+        return validators.mtime_ns // 1000000000 <= mktime_tz(date)
+
+    return False
+
+
+def send_buffers(client_socket, buffers):
+    """Send the buffers back to back with vectored writes, resuming after a partial one."""
+    views = [memoryview(buffer) for buffer in buffers]
+    while views:
+        sent = client_socket.sendmsg(views)
+        # Drop what was sent
+        while views and sent >= len(views[0]):
+            sent -= len(views[0])
+            views.pop(0)
+        if views:
+            views[0] = views[0][sent:]
+
+
+def handle_client_connection(client_socket, file_cache=None, validator_cache=None):
     """
     Handles the client connection, processing multiple requests if keep-alive is used.
+    Small files are served from the file cache, if one is given.
+    Files are sent with an ETag and a Last-Modified, and a conditional request for the version the client
+    already has is answered with 304 Not Modified and no body.
+    The requests are taken from a buffer of the bytes received, so a request may span several reads,
+    and pipelined requests that arrived together are answered one after the other.
     """
+    parser = RequestParser()
     while True:
         try:
-            # Read the request data
             try:
-                request_data = client_socket.recv(4096)
-            except socket.timeout:
-                # if there is a timeout, close the connection
-                client_socket.close()
-                return
-            except Exception:
+                request = parser.next_request()
+            except BadRequest:
                 client_socket.close()
                 return
 
-            # If there was no data received, close the connection
-            if not request_data:
-                client_socket.close()
-                return
-
-            request_str = request_data.decode('utf-8', errors='ignore')
-
-            # Print the request
-            print(request_str)
+            if request is None:
+                # Read more of the request data
+                try:
+                    request_data = client_socket.recv(RECV_SIZE)
+                except socket.timeout:
+                    # if there is a timeout, close the connection
+                    client_socket.close()
+                    return
+                except Exception:
+                    client_socket.close()
+                    return
 
-            lines = request_str.split('\r\n')
-            if not lines:
-                client_socket.close()
-                return
+                # If there was no data received, close the connection
+                if not request_data:
+                    client_socket.close()
+                    return
 
-            request_line = lines[0].split()
+                parser.feed(request_data)
+                continue
 
-            if len(request_line) < 2:
-                client_socket.close()
-                return
+            # Print the request
+            print(request.head.decode('utf-8', errors='ignore'))
 
-            path = request_line[1]
+            path = request.path
 
-            # Test if the type of connection the client wants, default is keep-alive
-            connection_header_val = "keep-alive"
-            for line in lines:
-                if line.lower().startswith("connection:"):
-                    if "close" in line.lower():
-                        connection_header_val = "close"
-                    elif "keep-alive" in line.lower():
-                        connection_header_val = "keep-alive"
-                    break
+            # The type of connection the client wants, default is keep-alive
+            connection_header_val = request.connection
 
 
             # Redirect case
@@ -122,23 +314,49 @@ def handle_client_connection(client_socket):
             # Otherwise, extract the file from the files directory
             file_path = os.path.join("files", filename)
 
-            # Check if such file exists
-            if os.path.isfile(file_path):
-                filesize = os.path.getsize(file_path)
+            # A small file may be in the cache, then it is served from memory
+            cached = None if file_cache is None else file_cache.get(file_path)
+            if cached is not None:
+                validators = cached.validators
+                if is_not_modified(request, validators):
+                    # The client has this version, only send the header
+                    client_socket.sendall(file_header(validators, 304, connection_header_val))
+                else:
+                    # Send the header and the file content with vectored writes, without joining them
+                    send_buffers(client_socket, [file_header(validators, 200, connection_header_val), cached.body])
 
-                # Read the file content
-                with open(file_path, "rb") as f:
-                    file_content = f.read()
-
-                # Send 200 OK response with file content and set the connection header as the same we had before
-                header = (
-                    f"HTTP/1.1 200 OK\r\n"
-                    f"Connection: {connection_header_val}\r\n"
-                    f"Content-Length: {filesize}\r\n"
-                    f"\r\n"
-                )
+                if connection_header_val == "close":
+                    client_socket.close()
+                    return
 
-                client_socket.sendall(header.encode() + file_content)
+            # Check if such file exists
+            elif os.path.isfile(file_path):
+                with open(file_path, "rb") as f:
+                    # Take the size and version from the file we opened, so they match what we send
+                    st = os.fstat(f.fileno())
+                    filesize = st.st_size
+                    if validator_cache is not None:
+                        validators = validator_cache.get(file_path, st.st_mtime_ns, filesize)
+                    else:
+                        validators = Validators(st.st_mtime_ns, filesize)
+
+                    if is_not_modified(request, validators):
+                        # The client has this version, only send the header
+                        client_socket.sendall(file_header(validators, 304, connection_header_val))
+                        sent = filesize = 0
+                    else:
+                        # Send 200 OK response header and set the connection header as the same we had before
+                        client_socket.sendall(file_header(validators, 200, connection_header_val), MSG_MORE)
+
+                        # Send the file content. sendfile has the kernel copy it from the file to the socket,
+                        # and where it can't, it falls back to sending it in small chunks, so the file is never
+                        # read into memory as a whole
+                        sent = client_socket.sendfile(f, 0, filesize)
+
+                # The file shrank while we sent it, the client would wait for the rest forever
+                if sent < filesize:
+                    client_socket.close()
+                    return
 
                 # if the client wanted to close the connection, we close it
                 # if the connection type wanted was keep alive, we just stay in the loop
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+HTTP Server Test Script
+Tests the request parser: requests split across reads, pipelined requests, bodies and the head size limit,
+and the conditional requests that get a 304 Not Modified
+"""
+
+import sys
+from email.utils import formatdate
+from typing import List
+
+from file_cache import Validators
+from request_parser import BadRequest, MAX_HEAD_SIZE, RequestParser
+from server import is_not_modified
+
+# The version of the file the conditional requests are checked against
+FILE_MTIME_NS = 1700000000500000000
+FILE_SIZE = 1234
+
+
+def feed_all(parser: RequestParser, chunks: List[bytes]) -> List[str]:
+    """Feed the chunks one by one, and return the path of each request that came out, in order"""
+    paths = []
+    for chunk in chunks:
+        parser.feed(chunk)
+        request = parser.next_request()
+        while request is not None:
+            paths.append(request.path)
+            request = parser.next_request()
+    return paths
+
+
+def conditional_request(headers: List[str]):
+    """Parse a GET request with the given header lines"""
+    parser = RequestParser()
+    parser.feed(("GET /a.html HTTP/1.1\r\n" + "".join(line + "\r\n" for line in headers) + "\r\n").encode())
+    return parser.next_request()
+
+
+def check_conditionals(validators: Validators, cases) -> List[str]:
+    """Return a description of each (headers, expected) case that is_not_modified gets wrong"""
+    wrong = []
+    for headers, expected in cases:
+        result = is_not_modified(conditional_request(headers), validators)
+        if result != expected:
+            wrong.append(f"{headers} -> {result}")
+    return wrong
+
+
+def run_tests():
+    """Run the HTTP tests"""
+    print("=" * 60)
+    print("HTTP Server Test Suite")
+    print("=" * 60)
+
+    # Test counters
+    total_tests = 0
+    passed_tests = 0
+
+    # Test 1: A request split across reads, with the end of the head split too
+    print("\n[Test 1] Request split across reads (one byte at a time around the blank line)")
+    total_tests += 1
+    parser = RequestParser()
+    data = b"GET /split.html HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n"
+    chunks = [data[:10], data[10:-3], data[-3:-2], data[-2:-1], data[-1:]]
+    parser.feed(chunks[0])
+    early = parser.next_request()
+    for chunk in chunks[1:-1]:
+        parser.feed(chunk)
+        early = early or parser.next_request()
+    parser.feed(chunks[-1])
+    request = parser.next_request()
+    if early is None and request is not None and request.path == "/split.html" and request.connection == "close":
+        print(f"   ✓ PASS: Got {request.method} {request.path} only once the head was complete")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected one close request for /split.html at the last read, got {early} then {request}")
+
+    # Test 2: Several pipelined requests in one read come out one by one, in order
+    print("\n[Test 2] Pipelined requests in one read (3 requests, the last one split)")
+    total_tests += 1
+    parser = RequestParser()
+    data = (b"GET /1 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            b"GET /2 HTTP/1.1\r\nHost: localhost\r\n\r\n"
+            b"GET /3 HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+    paths = feed_all(parser, [data[:-5], data[-5:]])
+    if paths == ["/1", "/2", "/3"] and not parser.buffer:
+        print(f"   ✓ PASS: Got {paths}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected ['/1', '/2', '/3'] and an empty buffer, got {paths} and {bytes(parser.buffer)}")
+
+    # Test 3: A body is skipped with its Content-Length, also when it arrives later
+    print("\n[Test 3] Body skipped with Content-Length (a 10 byte body that looks like a request, then a request)")
+    total_tests += 1
+    parser = RequestParser()
+    body = b"GET /x\r\n\r\n"
+    data = (b"POST /form HTTP/1.1\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body +
+            b"GET /after HTTP/1.1\r\n\r\n")
+    head_end = data.index(b"\r\n\r\n") + 4
+    paths = feed_all(parser, [data[:head_end], data[head_end:head_end + 4], data[head_end + 4:]])
+    if paths == ["/form", "/after"]:
+        print(f"   ✓ PASS: Got {paths}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected ['/form', '/after'], got {paths}")
+
+    # Test 4: A head that grows past the limit without ending is rejected
+    print(f"\n[Test 4] Head size limit ({MAX_HEAD_SIZE // 1024} KiB of headers and no blank line)")
+    total_tests += 1
+    parser = RequestParser()
+    parser.feed(b"GET / HTTP/1.1\r\n")
+    header = b"X-Filler: " + b"a" * 1000 + b"\r\n"
+    while len(parser.buffer) + len(header) <= MAX_HEAD_SIZE:
+        parser.feed(header)
+    # Just under the limit more bytes are still waited for
+    try:
+        waiting = parser.next_request() is None
+    except BadRequest:
+        waiting = False
+    parser.feed(header)
+    try:
+        parser.next_request()
+        outcome = "no error"
+    except BadRequest as e:
+        outcome = f"BadRequest: {e}"
+    if waiting and outcome.startswith("BadRequest"):
+        print(f"   ✓ PASS: Got {outcome} once the head passed the limit")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Expected BadRequest only past the limit, got {outcome}")
+
+    validators = Validators(FILE_MTIME_NS, FILE_SIZE)
+    etag = validators.etag
+
+    # Test 5: If-None-Match matches the ETag, a weak one or any, and decides alone when it is there
+    print("\n[Test 5] If-None-Match (exact, weak W/, in a list, *, other tag, precedence over If-Modified-Since)")
+    total_tests += 1
+    wrong = check_conditionals(validators, [
+        ([f"If-None-Match: {etag}"], True),
+        ([f"If-None-Match: W/{etag}"], True),
+        ([f'If-None-Match: "other", {etag}'], True),
+        (["If-None-Match: *"], True),
+        (['If-None-Match: "other"'], False),
+        # A stale tag wins over a matching date
+        (['If-None-Match: "other"', f"If-Modified-Since: {validators.last_modified}"], False),
+        ([f"If-None-Match: {etag}", "If-Modified-Since: Thu, 01 Jan 1970 00:00:00 GMT"], True),
+        ([], False),
+    ])
+    if not wrong:
+        print(f"   ✓ PASS: All cases matched for ETag {etag}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Wrong answers for {wrong}")
+
+    # Test 6: If-Modified-Since is compared in whole seconds, and a date that does not parse never matches
+    print("\n[Test 6] If-Modified-Since (exact Last-Modified, later date, earlier date, garbage)")
+    total_tests += 1
+    seconds = FILE_MTIME_NS // 1000000000
+    wrong = check_conditionals(validators, [
+        ([f"If-Modified-Since: {validators.last_modified}"], True),
+        ([f"If-Modified-Since: {formatdate(seconds + 3600, usegmt=True)}"], True),
+        ([f"If-Modified-Since: {formatdate(seconds - 1, usegmt=True)}"], False),
+        (["If-Modified-Since: not a date"], False),
+    ])
+    if not wrong:
+        print(f"   ✓ PASS: All cases matched for Last-Modified {validators.last_modified}")
+        passed_tests += 1
+    else:
+        print(f"   ✗ FAIL: Wrong answers for {wrong}")
+
+    # Summary
+    print("\n" + "=" * 60)
+    print("Test Summary")
+    print("=" * 60)
+    print(f"Total Tests: {total_tests}")
+    print(f"Passed: {passed_tests}")
+    print(f"Failed: {total_tests - passed_tests}")
+    print(f"Success Rate: {(passed_tests/total_tests)*100:.1f}%")
+    print("=" * 60)
+
+    if passed_tests == total_tests:
+        print("\n✓ ALL TESTS PASSED!")
+        return 0
+    else:
+        print(f"\n✗ {total_tests - passed_tests} TEST(S) FAILED")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(run_tests())